@@ -14,20 +14,90 @@
 #  * limitations under the License.
 import os
 import json
-import string
-import random
-import logging
-import unittest
+import time
+import socket
+import threading
 from functools import wraps
 
-import boto.ec2 as aws_client
+# boto and cloudify are imported on first use, loading boto and its
+# region endpoints takes longer than the rest of the plugin.
+from aws_plugin_common import metrics
+from aws_plugin_common import scheduler
+
+# Connection pool defaults
+POOL_MAX_IDLE_PER_KEY = 8
+POOL_MAX_IDLE_TIME = 300
+POOL_HEALTH_CHECK_INTERVAL = 60
+
+# Seconds between stat() calls on a cached configuration file
+CONFIG_CHECK_INTERVAL = 5
+
+# Instances per page of paginated describe calls
+DESCRIBE_PAGE_SIZE = 100
+# Max values of a single describe filter accepted by EC2
+MAX_FILTER_VALUES = 200
+# Error codes of calls failing for some of the resources they were given,
+# besides InvalidInstanceID.*
+RESOURCE_ERROR_CODES = ('IncorrectInstanceState', 'InvalidID')
+
+class _ConfigCache(object):
+    """
+    Parsed configuration files, keyed by path.
+
+    A cached file is stat()-ed at most once per check_interval seconds and
+    re-read only when its mtime, size or inode changed, so rotated
+    credentials are picked up without restarting workers while hot
+    operations do no file I/O. Symbolic links are resolved on every
+    check, so swapping a link to a new file, as secret mounts do, counts
+    as a change.
+    """
+
+    def __init__(self, check_interval=CONFIG_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # config path -> [resolved path, stamp, cfg, checked_at]
+        self._entries = {}
+
+    def get(self, config_path):
+        entry = self._entries.get(config_path)
+        now = time.time()
+        if entry is not None and now - entry[3] < self.check_interval:
+            return entry[2]
+        with self._lock:
+            entry = self._entries.get(config_path)
+            resolved = os.path.realpath(config_path)
+            stamp = _file_stamp(resolved)
+            if entry is not None and entry[:2] == [resolved, stamp]:
+                entry[3] = now
+                return entry[2]
+            with open(resolved) as f:
+                cfg = json.loads(f.read())
+            # Stamp taken before reading, a write racing the read will
+            # be seen as a change on the next check.
+            self._entries[config_path] = [resolved, stamp, cfg, now]
+            return cfg
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 
-import cloudify.manager
-import cloudify.decorators
+def _file_stamp(path):
+    st = os.stat(path)
+    return st.st_mtime, st.st_size, st.st_ino
+
+
+config_cache = _ConfigCache()
 
-PREFIX_RANDOM_CHARS = 3
 
 class Config(object):
+    """
+    Configuration file reader.
+
+    Returned configuration is cached and shared between callers,
+    it must not be modified.
+    """
+
     def get(self):
         which = self.__class__.which
         env_name = which.upper() + '_CONFIG_PATH'
@@ -35,9 +105,8 @@ class Config(object):
         default_location = os.path.expanduser(default_location_tpl)
         config_path = os.getenv(env_name, default_location)
         try:
-            with open(config_path) as f:
-                cfg = json.loads(f.read())
-        except IOError:
+            cfg = config_cache.get(config_path)
+        except (IOError, OSError):
             raise RuntimeError(
                 "Failed to read {0} configuration from file '{1}'."
                 "The configuration is looked up in {2}. If defined, "
@@ -55,32 +124,443 @@ class TestsConfig(Config):
     which = 'os_tests'
 
 
+class ClientPool(object):
+    """
+    Process-wide pool of reusable AWS connections.
+
+    Clients are kept per key (region and credentials), so a checked out
+    client always talks to the region and account the caller asked for.
+    At most max_idle_per_key idle clients are kept per key, clients idle
+    longer than max_idle_time are closed, and clients idle longer than
+    health_check_interval are probed before being handed out again.
+    """
+
+    def __init__(self, max_idle_per_key=POOL_MAX_IDLE_PER_KEY,
+                 max_idle_time=POOL_MAX_IDLE_TIME,
+                 health_check_interval=POOL_HEALTH_CHECK_INTERVAL):
+        self.max_idle_per_key = max_idle_per_key
+        self.max_idle_time = max_idle_time
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        # key -> list of (client, released_at), most recently used last
+        self._idle = {}
+        # id(client) -> key, for clients currently checked out
+        self._in_use = {}
+
+    def acquire(self, key, factory):
+        while True:
+            with self._lock:
+                self._evict_expired()
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                client, released_at = idle.pop()
+                self._in_use[id(client)] = key
+            if time.time() - released_at < self.health_check_interval or \
+                    self._is_healthy(client):
+                return client
+            self.release(client, discard=True)
+        client = factory()
+        with self._lock:
+            self._in_use[id(client)] = key
+        return client
+
+    def release(self, client, discard=False):
+        with self._lock:
+            key = self._in_use.pop(id(client), None)
+            if key is None:
+                return
+            idle = self._idle.setdefault(key, [])
+            if not discard and len(idle) < self.max_idle_per_key:
+                idle.append((client, time.time()))
+                return
+        _close_client(client)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for clients in idle.values():
+            for client, _ in clients:
+                _close_client(client)
+
+    def _evict_expired(self):
+        # Must be called with self._lock held
+        deadline = time.time() - self.max_idle_time
+        for key, idle in self._idle.items():
+            expired = [c for c, released_at in idle if released_at < deadline]
+            if expired:
+                idle[:] = [(c, r) for c, r in idle if r >= deadline]
+                for client in expired:
+                    _close_client(client)
+
+    def _is_healthy(self, client):
+        try:
+            client.get_all_regions()
+        except Exception:
+            return False
+        return True
+
+
+def _close_client(client):
+    try:
+        client.close()
+    except Exception:
+        pass
+
+
+def _is_connection_error(e):
+    return isinstance(e, (socket.error, IOError))
+
+
+client_pool = ClientPool()
+
+# (id(static config), overrides) -> (static config, merged config)
+_merged_configs = {}
+_MERGED_CONFIGS_MAX = 128
+
+
+def _merge_config(static_config, config):
+    if not config:
+        return static_config
+    key = (id(static_config), json.dumps(config, sort_keys=True))
+    memo = _merged_configs.get(key)
+    # Holding static config in the value guards against id() reuse
+    if memo is not None and memo[0] is static_config:
+        return memo[1]
+    cfg = {}
+    cfg.update(static_config)
+    cfg.update(config)
+    if len(_merged_configs) >= _MERGED_CONFIGS_MAX:
+        _merged_configs.clear()
+    _merged_configs[key] = (static_config, cfg)
+    return cfg
+
+
 class AwsClient(object):
+    pool = client_pool
+
     def get(self, config=None, *args, **kw):
         static_config = self.__class__.config().get()
-        cfg = {}
-        cfg.update(static_config)
-        if config:
-            cfg.update(config)
-        ret = self.connect(cfg, *args, **kw)
+        cfg = _merge_config(static_config, config)
+        ret = self.pool.acquire(self.pool_key(cfg),
+                                lambda: self.connect(cfg, *args, **kw))
         ret.format = 'json'
         return ret
 
+    def release(self, client, discard=False):
+        self.pool.release(client, discard=discard)
+
+
+class PerClient(object):
+    """
+    Registry of objects shared by all clients of one region and account.
+
+    Pooled clients are interchangeable, so caches and pollers built on top
+    of them are kept per (region, access key) rather than per client.
+    """
+
+    def __init__(self, factory, pass_key=False):
+        self._factory = factory
+        self._pass_key = pass_key
+        self._lock = threading.Lock()
+        self._objects = {}
+
+    def get(self, client):
+        key = (client.region.name, client.aws_access_key_id)
+        obj = self._objects.get(key)
+        if obj is None:
+            with self._lock:
+                obj = self._objects.get(key)
+                if obj is None:
+                    obj = self._factory(*key) if self._pass_key \
+                        else self._factory()
+                    self._objects[key] = obj
+        return obj
+
+    def values(self):
+        with self._lock:
+            return list(self._objects.values())
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs concurrent calls sharing a key once.
+
+    The first caller for a key runs the function, callers arriving while
+    it is in flight wait for it and get the same result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, f):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = f()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+
+def _freeze(value):
+    # Hashable equivalent of call arguments
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    hash(value)
+    return value
+
+
+class CoalescingClient(object):
+    """
+    Client proxy sharing concurrent identical read-only calls.
+
+    A describe call made while the same call, with the same arguments,
+    is in flight in another thread waits for it and returns its result
+    instead of calling EC2 again. Mutations are never shared. Shared
+    results must not be modified by callers.
+    """
+
+    def __init__(self, client, flights):
+        self.wrapped_client = client
+        self._flights = flights
+
+    def __getattr__(self, name):
+        attr = getattr(self.wrapped_client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        flights = self._flights
+
+        def call(*args, **kw):
+            if scheduler.api_class(name, args) != scheduler.DESCRIBE:
+                return attr(*args, **kw)
+            try:
+                key = (name, _freeze(args), _freeze(kw))
+            except TypeError:
+                return attr(*args, **kw)
+            leader = []
+
+            def lead():
+                leader.append(True)
+                return attr(*args, **kw)
+            try:
+                return flights.do(key, lead)
+            finally:
+                if not leader:
+                    metrics.increment('ec2.api.coalesced', 1, {'call': name})
+        call.__name__ = name
+        return call
+
 
 # Clients acquirers
 
+# (region, access key id) -> ec2_config overrides clients were acquired with
+_client_configs = {}
+
+
 class EC2Client(AwsClient):
 
     config = EC2Config
 
+    def get(self, config=None, *args, **kw):
+        ret = super(EC2Client, self).get(config, *args, **kw)
+        _client_configs[(ret.region.name, ret.aws_access_key_id)] = config
+        return ret
+
+    def pool_key(self, cfg):
+        aws_cfg = cfg['Amazon Credentials']
+        return (self.__class__.__name__,
+                aws_cfg['region'],
+                aws_cfg['aws_access_key_id'],
+                aws_cfg['aws_secret_access_key'])
+
     def connect(self, cfg):
+        import boto.ec2
         aws_cfg = cfg['Amazon Credentials']
-        return aws_client.connect_to_region(
+        return boto.ec2.connect_to_region(
             aws_access_key_id=aws_cfg['aws_access_key_id'],
             aws_secret_access_key=aws_cfg['aws_secret_access_key'],
             region_name=aws_cfg['region'])
 
 
+def client_config(region, access_key_id):
+    """
+    Returns (known, config): the ec2_config overrides a client of region
+    and access_key_id was last acquired with, for background threads
+    acquiring their own.
+    """
+    key = (region, access_key_id)
+    return key in _client_configs, _client_configs.get(key)
+
+
+def error_code(e):
+    """Returns the EC2 error code of e, None for other exceptions."""
+    return getattr(e, 'error_code', None)
+
+
+def is_resource_error(e):
+    """
+    Returns True if e names resources of the call that failed, the call
+    may succeed for its other resources.
+    """
+    code = error_code(e) or ''
+    return code.startswith('InvalidInstanceID.') or \
+        code in RESOURCE_ERROR_CODES
+
+
+def unwrap_client(client):
+    """Returns the boto client behind client proxies."""
+    while hasattr(client, 'wrapped_client'):
+        client = client.wrapped_client
+    return client
+
+
+_schedulers = PerClient(
+    lambda region, access_key_id: scheduler.RequestScheduler(
+        '{0}-{1}'.format(region, access_key_id)),
+    pass_key=True)
+
+
+_flights = PerClient(SingleFlight)
+
+
+def coalesced(ec2_client, client=None):
+    """
+    Returns client, ec2_client by default, sharing concurrent identical
+    describe calls with other threads using ec2_client's region and
+    account.
+    """
+    return CoalescingClient(client or ec2_client, _flights.get(ec2_client))
+
+
+def scheduled(ec2_client, client=None):
+    """
+    Returns client, ec2_client by default, calling EC2 through the
+    request scheduler of ec2_client's region and account.
+    """
+    return scheduler.ScheduledClient(client or ec2_client,
+                                     _schedulers.get(ec2_client))
+
+
+# Tags kept by instance records, tag key -> record field
+RECORD_TAGS = {'Name': 'name', 'meta_data': 'node_id', 'warm_pool': 'pool'}
+
+
+class InstanceRecord(object):
+    """
+    The attributes of an EC2 instance used by the plugin.
+
+    Only the Name, meta_data (node id) and warm_pool tags are kept.
+    """
+
+    __slots__ = ('id', 'state', 'name', 'node_id', 'pool', 'image_id',
+                 'placement', 'key_name', 'ip_address', 'private_ip_address')
+
+    def __init__(self, id, state, name=None, node_id=None, pool=None,
+                 image_id=None, placement=None, key_name=None,
+                 ip_address=None, private_ip_address=None):
+        self.id = id
+        self.state = state
+        self.name = name
+        self.node_id = node_id
+        self.pool = pool
+        self.image_id = image_id
+        self.placement = placement
+        self.key_name = key_name
+        self.ip_address = ip_address
+        self.private_ip_address = private_ip_address
+
+    @classmethod
+    def from_boto(cls, i):
+        tags = i.tags or {}
+        return cls(i.id, i.state, tags.get('Name'), tags.get('meta_data'),
+                   tags.get('warm_pool'), i.image_id, i.placement,
+                   i.key_name, i.ip_address, i.private_ip_address)
+
+    def tag(self, key):
+        """Returns the value of a kept tag, None when it is not set."""
+        return getattr(self, RECORD_TAGS[key])
+
+    def __repr__(self):
+        return 'InstanceRecord:{0}'.format(self.id)
+
+
+def iter_instances(ec2_client, instance_ids=None, filters=None,
+                   page_size=DESCRIBE_PAGE_SIZE):
+    """
+    Yields an InstanceRecord for every instance matching instance_ids and
+    filters.
+
+    Filters are applied by EC2 and results are fetched one page at a time
+    as the generator is consumed, so stopping early after a match saves
+    fetching the remaining pages.
+    """
+    next_token = None
+    while True:
+        if instance_ids:
+            # EC2 does not paginate describes by instance id
+            page = ec2_client.get_all_reservations(instance_ids=instance_ids,
+                                                   filters=filters)
+        else:
+            page = ec2_client.get_all_reservations(filters=filters,
+                                                   max_results=page_size,
+                                                   next_token=next_token)
+        for r in page:
+            for i in r.instances:
+                yield InstanceRecord.from_boto(i)
+        next_token = getattr(page, 'next_token', None)
+        if instance_ids or not next_token:
+            return
+
+
+def chunks(values, size=MAX_FILTER_VALUES):
+    """Yields lists of at most size of values, in order."""
+    values = list(values)
+    for n in range(0, len(values), size):
+        yield values[n:n + size]
+
+
+def iter_instances_by(ec2_client, name, values, filters=None):
+    """
+    Yields an InstanceRecord for every instance whose filter name matches
+    one of values and filters, describing MAX_FILTER_VALUES values at a
+    time.
+    """
+    for chunk in chunks(values):
+        for record in iter_instances(ec2_client,
+                                     filters=dict(filters or {},
+                                                  **{name: chunk})):
+            yield record
+
+
 # Decorators
 
 def _find_instance_of_in_kw(cls, kw):
@@ -95,71 +575,37 @@ def _find_instance_of_in_kw(cls, kw):
 
 
 def _find_context_in_kw(kw):
-    return _find_instance_of_in_kw(cloudify.context.CloudifyContext, kw)
+    from cloudify.context import CloudifyContext
+    return _find_instance_of_in_kw(CloudifyContext, kw)
 
 
 def with_ec2_client(f):
     @wraps(f)
     def wrapper(*args, **kw):
         ctx = _find_context_in_kw(kw)
-        if ctx:
+        if ctx is not None:
             config = ctx.properties.get('ec2_config')
+            node_id, logger = ctx.node_id, ctx.logger
         else:
             config = None
-        ec2_client = EC2Client().get(config=config)
-        kw['ec2_client'] = ec2_client
-        return f(*args, **kw)
+            node_id, logger = None, None
+        acquirer = EC2Client()
+        ec2_client = acquirer.get(config=config)
+        recorder = metrics.start(f.__name__, node_id)
+        client = ec2_client
+        if recorder:
+            client = metrics.InstrumentedClient(client, recorder)
+        kw['ec2_client'] = coalesced(ec2_client,
+                                     scheduled(ec2_client, client))
+        discard = False
+        try:
+            return f(*args, **kw)
+        except Exception as e:
+            # Don't hand a connection in unknown state to the next task
+            discard = _is_connection_error(e)
+            raise
+        finally:
+            acquirer.release(ec2_client, discard=discard)
+            if recorder:
+                metrics.finish(recorder, logger)
     return wrapper
-
-
-#TestCases
-class TestCase(unittest.TestCase):
-
-    def get_ec2_client(self):
-        r = EC2Client().get()
-        self.get_ec2_client = lambda: r
-        return self.get_ec2_client()
-
-    def _mock_send_event(self, *args, **kw):
-        self.logger.debug("_mock_send_event(args={0}, kw={1})".format(
-            args, kw))
-
-    def _mock_get_node_state(self, __cloudify_id, *args, **kw):
-        self.logger.debug(
-            "_mock_get_node_state(__cloudify_id={0} args={1}, kw={2})".format(
-                __cloudify_id, args, kw))
-        return self.nodes_data[__cloudify_id]
-
-    def setUp(self):
-        # Careful!
-        logger = logging.getLogger(__name__)
-        logging.basicConfig(
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.logger = logger
-        self.logger.level = logging.DEBUG
-        self.logger.debug("Cosmo test setUp() called")
-        chars = string.ascii_uppercase + string.digits
-        self.name_prefix = 'cosmo_test_{0}_'\
-            .format(''.join(
-                random.choice(chars) for x in range(PREFIX_RANDOM_CHARS)))
-        self.timeout = 120
-
-        self.logger.debug("Cosmo test setUp() done")
-
-    @with_ec2_client
-    def assertThereIsOneServerAndGet(self, ec2_client, **kw):
-        instances = ec2_client.get_all_instances()
-        instances = [i for r in instances for i in r.instances]
-        self.assertEquals(1, len(instances[0].tags['Name']))
-        return instances[0].tags['Name']
-
-    assertThereIsOneServer = assertThereIsOneServerAndGet
-
-    @with_ec2_client
-    def assertThereIsNoServer(self, ec2_client, **kw):
-        tags = ec2_client.get_all_tags()
-        for tag in tags:
-            if tag.name == 'Name':
-                if tag.value == kw['name']:
-                    self.assertEquals(0, len(tag.value))
-
@@ -0,0 +1,202 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Concurrent execution of node operations.
+
+    results = Executor().run([(server.start, ctx) for ctx in ctxs],
+                             timeout=900)
+
+runs the operations on a bounded thread pool, at most max_per_region of
+them at a time in each region, and returns a NodeResult per operation.
+Cancelling a run, or reaching its timeout, skips the operations not
+started yet and makes the running ones raise Cancelled the next time
+they check for it, such as while waiting for instance states.
+"""
+
+import time
+import threading
+
+from aws_plugin_common import regions
+
+# Max operations run at the same time by an executor
+EXECUTOR_MAX_WORKERS = 16
+# Max operations run at the same time in one region by an executor
+EXECUTOR_MAX_PER_REGION = 8
+# Seconds between checks for cancellation while waiting
+CANCEL_CHECK_INTERVAL = 1
+
+_current = threading.local()
+
+
+class Cancelled(RuntimeError):
+    """The operation was cancelled or ran out of time."""
+
+
+def check_cancelled():
+    """Raises Cancelled if the operation of this thread was cancelled."""
+    cancelled = getattr(_current, 'cancelled', None)
+    if cancelled is not None and cancelled.is_set():
+        raise Cancelled("Operation cancelled")
+
+
+class NodeResult(object):
+    """The value returned by an operation, or the error it raised."""
+
+    __slots__ = ('node_id', 'operation', 'value', 'error', 'elapsed')
+
+    def __init__(self, node_id, operation):
+        self.node_id = node_id
+        self.operation = operation
+        self.value = None
+        self.error = None
+        self.elapsed = None
+
+    def __repr__(self):
+        return 'NodeResult({0!r}, {1!r}, {2!r}, {3!r})'.format(
+            self.node_id, self.operation, self.value, self.error)
+
+
+class _Slots(object):
+    # Counting semaphore whose waiters give up once cancelled
+
+    def __init__(self, size):
+        self._cond = threading.Condition()
+        self._free = size
+
+    def acquire(self, cancelled):
+        with self._cond:
+            while not self._free:
+                if cancelled.is_set():
+                    raise Cancelled("Operation cancelled before it started")
+                self._cond.wait(CANCEL_CHECK_INTERVAL)
+            self._free -= 1
+
+    def release(self):
+        with self._cond:
+            self._free += 1
+            self._cond.notify()
+
+
+class Executor(object):
+    """Runs many (operation, ctx) pairs concurrently."""
+
+    def __init__(self, max_workers=None, max_per_region=None):
+        self.max_workers = max_workers or EXECUTOR_MAX_WORKERS
+        self.max_per_region = max_per_region or EXECUTOR_MAX_PER_REGION
+        self._lock = threading.Lock()
+        # Cancellation events of the runs in progress
+        self._runs = set()
+
+    def cancel(self):
+        """Cancels all runs in progress."""
+        with self._lock:
+            for cancelled in self._runs:
+                cancelled.set()
+
+    def run(self, calls, timeout=None, cancel_on_error=False):
+        """
+        Runs calls, (operation, ctx) or (operation, ctx, kwargs) tuples,
+        and returns a NodeResult for each of them, in the same order.
+
+        Operations still running after timeout seconds are cancelled and
+        their result has a Cancelled error, the run returns without
+        waiting for them. With cancel_on_error, the first failure
+        cancels the operations not done yet.
+        """
+        # Loading multiprocessing is left to the first run
+        from multiprocessing.pool import ThreadPool
+        calls = [tuple(c) + ({}, ) if len(c) == 2 else tuple(c)
+                 for c in calls]
+        results = [NodeResult(ctx.node_id, operation.__name__)
+                   for operation, ctx, _ in calls]
+        if not calls:
+            return results
+        deadline = time.time() + timeout if timeout else None
+        cancelled = threading.Event()
+        done = threading.Condition()
+        finished = set()
+        slots = {}
+        call_slots = []
+        for operation, ctx, _ in calls:
+            region = regions.get_region(ctx.properties.get('ec2_config'))
+            call_slots.append(
+                slots.setdefault(region, _Slots(self.max_per_region)))
+
+        def on_done(n, outcome):
+            # Outcomes of operations finishing after the run timed out
+            # are dropped, the caller already has their results
+            with done:
+                if n in finished:
+                    return
+                finished.add(n)
+                result = results[n]
+                result.value = outcome.value
+                result.error = outcome.error
+                result.elapsed = outcome.elapsed
+                if cancel_on_error and result.error is not None:
+                    cancelled.set()
+                done.notify()
+
+        with self._lock:
+            self._runs.add(cancelled)
+        pool = ThreadPool(min(self.max_workers, len(calls)))
+        try:
+            for n, (operation, ctx, kw) in enumerate(calls):
+                pool.apply_async(_run_one, (
+                    operation, ctx, kw, call_slots[n], cancelled,
+                    lambda outcome, n=n: on_done(n, outcome)))
+            with done:
+                while len(finished) < len(calls):
+                    wait = CANCEL_CHECK_INTERVAL
+                    if deadline is not None:
+                        wait = min(wait, deadline - time.time())
+                        if wait <= 0:
+                            break
+                    done.wait(wait)
+                for n, result in enumerate(results):
+                    if n not in finished:
+                        finished.add(n)
+                        result.error = Cancelled(
+                            "Operation timed out after {0} seconds"
+                            .format(timeout))
+        finally:
+            cancelled.set()
+            with self._lock:
+                self._runs.discard(cancelled)
+            # Running operations finish in the background
+            pool.close()
+        return results
+
+
+def _run_one(operation, ctx, kw, slots, cancelled, on_done):
+    # Runs operation into an outcome of its own, passed to on_done
+    result = NodeResult(ctx.node_id, operation.__name__)
+    started = time.time()
+    try:
+        if cancelled.is_set():
+            raise Cancelled("Operation cancelled before it started")
+        slots.acquire(cancelled)
+        _current.cancelled = cancelled
+        try:
+            result.value = operation(ctx=ctx, **kw)
+        finally:
+            _current.cancelled = None
+            slots.release()
+    except Exception as e:
+        result.error = e
+    finally:
+        result.elapsed = time.time() - started
+        on_done(result)
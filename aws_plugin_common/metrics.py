@@ -0,0 +1,304 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+API call instrumentation.
+
+Disabled by default, enable() makes with_ec2_client hand operations an
+InstrumentedClient that records the count, latency, returned items and
+errors of each API call, tagged by operation and node id. Recorded data
+is logged per task through ctx.logger and sent to the configured sink.
+
+Unless enable() or disable() was called, the EC2_METRICS environment
+variable is read by the first instrumented operation:
+
+    EC2_METRICS=log                       logs the calls of every task
+    EC2_METRICS=statsd[:host[:port]]      also sends them to statsd
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+THROTTLING_ERROR_CODES = ('RequestLimitExceeded', 'Throttling')
+
+METRICS_ENV = 'EC2_METRICS'
+STATSD_PORT = 8125
+
+logger = logging.getLogger(__name__)
+
+_sink = None
+_enabled = False
+# Whether the settings were read from the environment or set in code
+_configured = False
+_lock = threading.Lock()
+_current = threading.local()
+
+
+def enable(sink=None):
+    global _sink, _enabled, _configured
+    _sink = sink
+    _enabled = True
+    _configured = True
+
+
+def disable():
+    global _sink, _enabled, _configured
+    _sink = None
+    _enabled = False
+    _configured = True
+
+
+def configure_from_env():
+    """Enables instrumentation as set by the EC2_METRICS variable."""
+    global _configured
+    with _lock:
+        if _configured:
+            return
+        _configured = True
+        value = os.getenv(METRICS_ENV, '').strip()
+        if not value or value.lower() in ('0', 'off', 'false'):
+            return
+        if value == 'log':
+            enable()
+            return
+        parts = value.split(':')
+        if parts[0] != 'statsd' or len(parts) > 3:
+            logger.warning("Ignoring {0}={1}, expected 'log' or "
+                           "'statsd[:host[:port]]'".format(METRICS_ENV,
+                                                           value))
+            return
+        try:
+            port = int(parts[2]) if len(parts) == 3 else STATSD_PORT
+        except ValueError:
+            logger.warning("Ignoring {0}={1}, bad statsd port"
+                           .format(METRICS_ENV, value))
+            return
+        enable(StatsdSink(parts[1] if len(parts) > 1 and parts[1]
+                          else 'localhost', port))
+
+
+def is_throttling_error(e):
+    # Checked by error code, importing boto's exceptions loads boto
+    return getattr(e, 'error_code', None) in THROTTLING_ERROR_CODES
+
+
+class CallStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.throttles = 0
+        self.total_time = 0.0
+        self.items = 0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, elapsed, items, error):
+        self.count += 1
+        self.total_time += elapsed
+        self.items += items
+        if error is not None:
+            self.errors += 1
+            if is_throttling_error(error):
+                self.throttles += 1
+        for n, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                self.histogram[n] += 1
+                break
+
+
+class Recorder(object):
+    """API call statistics of one operation on one node."""
+
+    def __init__(self, operation, node_id=None, sink=None):
+        self.operation = operation
+        self.node_id = node_id
+        self.sink = sink
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # API call name -> CallStats
+        self.calls = {}
+        # name -> seconds spent outside API calls, such as waiting
+        self.waits = {}
+
+    @property
+    def tags(self):
+        return {'operation': self.operation, 'node_id': self.node_id}
+
+    def record(self, name, elapsed, items=0, error=None):
+        with self._lock:
+            self.calls.setdefault(name, CallStats()).add(elapsed, items,
+                                                         error)
+        if self.sink is not None:
+            tags = dict(self.tags, call=name)
+            self.sink.timing('ec2.api.time', elapsed, tags)
+            self.sink.increment('ec2.api.calls', 1, tags)
+            if items:
+                self.sink.increment('ec2.api.items', items, tags)
+            if error is not None:
+                self.sink.increment('ec2.api.errors', 1, tags)
+                if is_throttling_error(error):
+                    self.sink.increment('ec2.api.throttles', 1, tags)
+
+    def record_wait(self, name, elapsed):
+        with self._lock:
+            self.waits[name] = self.waits.get(name, 0) + elapsed
+        if self.sink is not None:
+            self.sink.timing('ec2.wait.time', elapsed,
+                             dict(self.tags, wait=name))
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        total = sum(s.count for s in self.calls.values())
+        parts = ["{0}: {1} calls, {2:.3f}s".format(
+            name, s.count, s.total_time) +
+            (", {0} items".format(s.items) if s.items else "") +
+            (", {0} errors".format(s.errors) if s.errors else "") +
+            (", {0} throttled".format(s.throttles) if s.throttles else "")
+            for name, s in sorted(self.calls.items())]
+        parts.extend("{0}: {1:.3f}s".format(name, seconds)
+                     for name, seconds in sorted(self.waits.items()))
+        return "{0} on node {1} took {2:.3f}s with {3} EC2 API calls{4}"\
+            .format(self.operation, self.node_id, elapsed, total,
+                    ": " + "; ".join(parts) if parts else "")
+
+
+def start(operation, node_id=None):
+    """Returns a recorder for the operation or None when disabled."""
+    if not _configured:
+        configure_from_env()
+    if not _enabled:
+        return None
+    recorder = Recorder(operation, node_id, _sink)
+    stack = getattr(_current, 'stack', None)
+    if stack is None:
+        stack = _current.stack = []
+    stack.append(recorder)
+    return recorder
+
+
+def finish(recorder, logger=None):
+    _current.stack.remove(recorder)
+    if logger is not None:
+        logger.info(recorder.summary())
+    if recorder.sink is not None:
+        recorder.sink.timing('ec2.operation.time',
+                             time.time() - recorder.started, recorder.tags)
+
+
+def current():
+    """Returns the recorder of the operation running in this thread."""
+    stack = getattr(_current, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def record(name, elapsed):
+    """Records time spent outside API calls, such as waiting."""
+    recorder = current()
+    if recorder is not None:
+        recorder.record_wait(name, elapsed)
+
+
+def timing(name, seconds, tags=None):
+    """Sends a timing to the sink, when one is configured."""
+    if _sink is not None:
+        _sink.timing(name, seconds, tags or {})
+
+
+def increment(name, value=1, tags=None):
+    """Sends a counter increment to the sink, when one is configured."""
+    if _sink is not None:
+        _sink.increment(name, value, tags or {})
+
+
+class InstrumentedClient(object):
+    """Client proxy recording every public method call."""
+
+    def __init__(self, client, recorder):
+        self.wrapped_client = client
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attr = getattr(self.wrapped_client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        recorder = self._recorder
+
+        def call(*args, **kw):
+            started = time.time()
+            try:
+                ret = attr(*args, **kw)
+            except Exception as e:
+                recorder.record(name, time.time() - started, error=e)
+                raise
+            items = len(ret) if isinstance(ret, list) else 0
+            recorder.record(name, time.time() - started, items)
+            return ret
+        call.__name__ = name
+        return call
+
+
+class MemorySink(object):
+    """Keeps all metrics in memory, for tests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = []
+        self.counters = {}
+
+    def timing(self, name, seconds, tags):
+        with self._lock:
+            self.timings.append((name, seconds, tags))
+
+    def increment(self, name, value, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def count(self, name, **tags):
+        return sum(v for (n, t), v in self.counters.items()
+                   if n == name and set(tags.items()) <= set(t))
+
+
+class StatsdSink(object):
+    """Sends metrics to a statsd daemon, tags in the DogStatsD format."""
+
+    def __init__(self, host='localhost', port=8125, prefix='cloudify.aws'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, seconds, tags):
+        self._send(name, int(seconds * 1000), 'ms', tags)
+
+    def increment(self, name, value, tags):
+        self._send(name, value, 'c', tags)
+
+    def _send(self, name, value, kind, tags):
+        tags = ','.join('{0}:{1}'.format(k, v)
+                        for k, v in sorted(tags.items()) if v is not None)
+        line = '{0}.{1}:{2}|{3}'.format(self.prefix, name, value, kind)
+        if tags:
+            line += '|#' + tags
+        try:
+            self._socket.sendto(line.encode('utf-8'), self.address)
+        except socket.error:
+            # Metrics must never fail an operation
+            pass
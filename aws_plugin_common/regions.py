@@ -0,0 +1,136 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Calls fanned out over several regions.
+
+The regions are the 'regions' list of the 'Amazon Credentials' section
+of the EC2 configuration, the single 'region' when there is none. Each
+region is called on a bounded thread pool with a pooled client, so a
+search over all regions takes about as long as the slowest region.
+"""
+
+import time
+import threading
+
+import aws_plugin_common
+
+from aws_plugin_common import metrics
+
+# Max regions called at the same time, by all fan-outs of the process
+FANOUT_MAX_WORKERS = 16
+# Seconds a region has to answer
+FANOUT_TIMEOUT = 30
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class RegionResult(object):
+    """The value returned in a region, or the error raised there."""
+
+    __slots__ = ('region', 'value', 'error')
+
+    def __init__(self, region, value=None, error=None):
+        self.region = region
+        self.value = value
+        self.error = error
+
+    def __repr__(self):
+        return 'RegionResult({0!r}, {1!r}, {2!r})'.format(
+            self.region, self.value, self.error)
+
+
+def get_regions(config=None):
+    """Returns the configured regions, config overriding the file."""
+    aws_cfg = _aws_config(config)
+    return list(aws_cfg.get('regions') or [aws_cfg['region']])
+
+
+def get_region(config=None):
+    """Returns the region operations use, config overriding the file."""
+    return _aws_config(config)['region']
+
+
+def fan_out(f, config=None, regions=None, timeout=None):
+    """
+    Calls f(ec2_client) in every region concurrently.
+
+    Returns a RegionResult per region, in the order of regions. Regions
+    failing or not answering within timeout seconds, FANOUT_TIMEOUT by
+    default, have an error set, they don't fail the others.
+    """
+    from multiprocessing import TimeoutError
+    if regions is None:
+        regions = get_regions(config)
+    timeout = timeout or FANOUT_TIMEOUT
+    recorder = metrics.current()
+    pending = [(region, _get_pool().apply_async(
+        _call_in_region, (f, _region_config(config, region), recorder)))
+        for region in regions]
+    deadline = time.time() + timeout
+    ret = []
+    for region, async_result in pending:
+        try:
+            value = async_result.get(max(0, deadline - time.time()))
+        except TimeoutError:
+            ret.append(RegionResult(region, error=RuntimeError(
+                "Region {0} did not answer within {1} seconds"
+                .format(region, timeout))))
+        except Exception as e:
+            ret.append(RegionResult(region, error=e))
+        else:
+            ret.append(RegionResult(region, value))
+    return ret
+
+
+def _call_in_region(f, config, recorder):
+    acquirer = aws_plugin_common.EC2Client()
+    ec2_client = acquirer.get(config=config)
+    client = ec2_client
+    if recorder:
+        client = metrics.InstrumentedClient(client, recorder)
+    discard = False
+    try:
+        return f(aws_plugin_common.coalesced(
+            ec2_client, aws_plugin_common.scheduled(ec2_client, client)))
+    except Exception as e:
+        discard = aws_plugin_common._is_connection_error(e)
+        raise
+    finally:
+        acquirer.release(ec2_client, discard=discard)
+
+
+def _aws_config(config):
+    static_config = aws_plugin_common.EC2Config().get()
+    return aws_plugin_common._merge_config(
+        static_config, config)['Amazon Credentials']
+
+
+def _region_config(config, region):
+    aws_cfg = dict(_aws_config(config), region=region)
+    aws_cfg.pop('regions', None)
+    return dict(config or {}, **{'Amazon Credentials': aws_cfg})
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # Loading multiprocessing is left to the first fan-out
+        from multiprocessing.pool import ThreadPool
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPool(FANOUT_MAX_WORKERS)
+    return _pool
@@ -0,0 +1,224 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Rate limiting and retrying of EC2 API calls.
+
+Calls go through token buckets per region and account and per API class
+(describe or mutate), shared by all threads of the process. When the
+EC2_RATE_LIMIT_DIR environment variable names a directory, buckets are
+kept in files there and shared by all worker processes on the host.
+
+Throttled calls are retried with decorrelated jitter backoff and slow the
+bucket down. Transient errors are retried only for idempotent calls.
+"""
+
+import os
+import time
+import random
+import socket
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from aws_plugin_common import metrics
+
+DESCRIBE = 'describe'
+MUTATE = 'mutate'
+
+# API class -> (calls per second, burst)
+RATE_LIMITS = {
+    DESCRIBE: (20, 100),
+    MUTATE: (5, 50),
+}
+# Slowest rate a bucket is throttled down to, as a fraction of its limit
+MIN_RATE_FRACTION = 0.1
+
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 20
+RETRY_MAX_ATTEMPTS = 8
+
+SHARED_DIR_ENV = 'EC2_RATE_LIMIT_DIR'
+
+# Mutations that can safely be sent again when the outcome is unknown
+IDEMPOTENT_MUTATIONS = (
+    'start_instances',
+    'stop_instances',
+    'terminate_instances',
+    'create_tags',
+    'delete_tags',
+)
+
+TRANSIENT_ERROR_CODES = ('InternalError', 'Unavailable',
+                         'ServiceUnavailable')
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket.
+
+    The refill rate starts at rate, is halved on every throttled call and
+    grows back additively on successful calls.
+    """
+
+    def __init__(self, rate, burst):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.time()
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def throttled(self):
+        self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+    def _take(self):
+        # Returns 0 when a token was taken, otherwise seconds to wait
+        with self._lock:
+            now = time.time()
+            self._tokens, wait = self._refill_and_take(self._tokens,
+                                                      self._updated, now)
+            self._updated = now
+            return wait
+
+    def _refill_and_take(self, tokens, updated, now):
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, 0
+        return tokens, (1 - tokens) / self.rate
+
+
+class FileTokenBucket(TokenBucket):
+    """Token bucket kept in a file, shared by processes on the host."""
+
+    def __init__(self, path, rate, burst):
+        super(FileTokenBucket, self).__init__(rate, burst)
+        self.path = path
+
+    def _take(self):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                now = time.time()
+                try:
+                    tokens, updated = [
+                        float(x) for x in os.read(fd, 64).split()]
+                except ValueError:
+                    tokens, updated = float(self.burst), now
+                tokens, wait = self._refill_and_take(tokens, updated, now)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, '{0!r} {1!r}'.format(tokens, now).encode())
+                return wait
+            finally:
+                os.close(fd)
+
+
+def api_class(name, args):
+    if name.startswith('get_all_') or name.startswith('describe'):
+        return DESCRIBE
+    if name in ('get_list', 'get_object', 'get_status') and args:
+        # Raw requests, the first argument is the EC2 action
+        return DESCRIBE if args[0].startswith('Describe') else MUTATE
+    return MUTATE
+
+
+def is_idempotent(name, args, kw):
+    if api_class(name, args) == DESCRIBE or name in IDEMPOTENT_MUTATIONS:
+        return True
+    # Launches carrying a client token are deduplicated by EC2
+    return name == 'run_instances' and bool(kw.get('client_token'))
+
+
+def is_transient_error(e):
+    # boto server errors, without importing boto
+    if hasattr(e, 'error_code') and hasattr(e, 'status'):
+        return e.status >= 500 or e.error_code in TRANSIENT_ERROR_CODES
+    return isinstance(e, socket.error)
+
+
+class RequestScheduler(object):
+    """Rate limits and retries the calls to one region and account."""
+
+    def __init__(self, name, shared_dir=None):
+        shared_dir = shared_dir or os.getenv(SHARED_DIR_ENV)
+        self.buckets = {}
+        for cls, (rate, burst) in RATE_LIMITS.items():
+            if shared_dir and fcntl:
+                path = os.path.join(shared_dir, '{0}-{1}.bucket'.format(
+                    name, cls))
+                self.buckets[cls] = FileTokenBucket(path, rate, burst)
+            else:
+                self.buckets[cls] = TokenBucket(rate, burst)
+
+    def call(self, name, f, args, kw):
+        bucket = self.buckets[api_class(name, args)]
+        idempotent = is_idempotent(name, args, kw)
+        delay = RETRY_BASE_DELAY
+        attempt = 1
+        while True:
+            bucket.acquire()
+            try:
+                ret = f(*args, **kw)
+            except Exception as e:
+                throttled = metrics.is_throttling_error(e)
+                if throttled:
+                    bucket.throttled()
+                retry = throttled or (idempotent and is_transient_error(e))
+                if not retry or attempt >= RETRY_MAX_ATTEMPTS:
+                    raise
+                # Decorrelated jitter
+                delay = min(RETRY_MAX_DELAY,
+                            random.uniform(RETRY_BASE_DELAY, delay * 3))
+                metrics.record('retry_backoff', delay)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            bucket.succeeded()
+            return ret
+
+
+class ScheduledClient(object):
+    """Client proxy sending every public method call through a scheduler."""
+
+    def __init__(self, client, scheduler):
+        self.wrapped_client = client
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        attr = getattr(self.wrapped_client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        scheduler = self._scheduler
+
+        def call(*args, **kw):
+            return scheduler.call(name, attr, args, kw)
+        call.__name__ = name
+        return call
@@ -0,0 +1,85 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Test scaffolding, kept out of the modules workers import."""
+
+import string
+import random
+import logging
+import unittest
+import itertools
+
+from aws_plugin_common import EC2Client
+from aws_plugin_common import iter_instances
+from aws_plugin_common import with_ec2_client
+
+PREFIX_RANDOM_CHARS = 3
+
+
+class TestCase(unittest.TestCase):
+
+    def get_ec2_client(self):
+        r = EC2Client().get()
+        self.addCleanup(EC2Client().release, r)
+        self.get_ec2_client = lambda: r
+        return self.get_ec2_client()
+
+    def _mock_send_event(self, *args, **kw):
+        self.logger.debug("_mock_send_event(args={0}, kw={1})".format(
+            args, kw))
+
+    def _mock_get_node_state(self, __cloudify_id, *args, **kw):
+        self.logger.debug(
+            "_mock_get_node_state(__cloudify_id={0} args={1}, kw={2})".format(
+                __cloudify_id, args, kw))
+        return self.nodes_data[__cloudify_id]
+
+    def setUp(self):
+        # Careful!
+        logger = logging.getLogger(__name__)
+        logging.basicConfig(
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self.logger = logger
+        self.logger.level = logging.DEBUG
+        self.logger.debug("Cosmo test setUp() called")
+        chars = string.ascii_uppercase + string.digits
+        self.name_prefix = 'cosmo_test_{0}_'\
+            .format(''.join(
+                random.choice(chars) for x in range(PREFIX_RANDOM_CHARS)))
+        self.timeout = 120
+
+        self.logger.debug("Cosmo test setUp() done")
+
+    @with_ec2_client
+    def assertThereIsOneServerAndGet(self, ec2_client, **kw):
+        filters = {'instance-state-name': ['pending', 'running']}
+        if 'name' in kw:
+            filters['tag:Name'] = kw['name']
+        # Two are enough to tell there is more than one
+        instances = list(itertools.islice(
+            iter_instances(ec2_client, filters=filters), 2))
+        self.assertEquals(1, len(instances))
+        return instances[0].name
+
+    assertThereIsOneServer = assertThereIsOneServerAndGet
+
+    @with_ec2_client
+    def assertThereIsNoServer(self, ec2_client, **kw):
+        tags = ec2_client.get_all_tags()
+        for tag in tags:
+            if tag.name == 'Name':
+                if tag.value == kw['name']:
+                    self.assertEquals(0, len(tag.value))
+
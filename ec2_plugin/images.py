@@ -0,0 +1,94 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import time
+import threading
+
+import aws_plugin_common
+
+# Seconds a resolved image is trusted
+IMAGES_TTL = 3600
+# Seconds a missing image is remembered as missing
+IMAGES_NEGATIVE_TTL = 60
+
+
+class ImageCache(object):
+    """
+    Resolved AMIs, by image id or by name filter.
+
+    Concurrent resolutions of the same image share a single describe
+    call. Images not found are remembered for negative_ttl seconds.
+    """
+
+    def __init__(self, ttl=IMAGES_TTL, negative_ttl=IMAGES_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        # ('id', image id) or ('name', name) -> (image id or None, expires)
+        self._images = {}
+        self._flights = aws_plugin_common.SingleFlight()
+
+    def resolve(self, ec2_client, image_id=None, name=None):
+        """Returns the id of the image with image_id or with name."""
+        key = ('id', image_id) if image_id else ('name', name)
+        entry = self._images.get(key)
+        if entry is None or entry[1] <= time.time():
+            resolved = self._flights.do(
+                key, lambda: self._describe(ec2_client, key))
+        else:
+            resolved = entry[0]
+        if resolved is None:
+            raise ValueError("Image with {0} '{1}' was not found"
+                             .format(*key))
+        return resolved
+
+    def invalidate(self, image_id=None, name=None):
+        key = ('id', image_id) if image_id else ('name', name)
+        with self._lock:
+            self._images.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+
+    def _describe(self, ec2_client, key):
+        by, value = key
+        try:
+            if by == 'id':
+                images = ec2_client.get_all_images(image_ids=[value])
+            else:
+                images = ec2_client.get_all_images(filters={'name': value})
+        except Exception as e:
+            if not (aws_plugin_common.error_code(e) or '').startswith(
+                    'InvalidAMIID'):
+                raise
+            images = []
+        if images:
+            # The most recent image wins for name filters
+            image = max(images, key=lambda i: i.creationDate)
+            resolved, ttl = image.id, self.ttl
+        else:
+            resolved, ttl = None, self.negative_ttl
+        with self._lock:
+            self._images[key] = (resolved, time.time() + ttl)
+        return resolved
+
+
+_caches = aws_plugin_common.PerClient(ImageCache)
+
+
+def for_client(ec2_client):
+    """Returns the cache for the region and account of ec2_client."""
+    return _caches.get(ec2_client)
@@ -0,0 +1,197 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import time
+import threading
+
+import aws_plugin_common
+
+from ec2_plugin import shared_inventory
+
+# Seconds an indexed instance is trusted without asking EC2 again
+INVENTORY_TTL = 10
+
+META_DATA_TAG = 'meta_data'
+NAME_TAG = 'Name'
+
+# Instances in these states can still be acted upon by the plugin
+LIVE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+
+class InstanceIndex(object):
+    """
+    Short lived in-memory index of EC2 instance records.
+
+    Instances are indexed by instance id, by the cloudify node id kept in
+    the meta_data tag and by the Name tag. Lookups are answered from the
+    index while the entry is younger than ttl, then from the host's shared
+    inventory when one is configured, otherwise only the requested
+    instances are described again using server side filters.
+    """
+
+    def __init__(self, ttl=INVENTORY_TTL, store=None):
+        self.ttl = ttl
+        self.store = store
+        self._lock = threading.Lock()
+        # instance id -> (instance, fetched_at)
+        self._by_id = {}
+        # cloudify node id -> instance id
+        self._by_node_id = {}
+        # Name tag -> instance id
+        self._by_name = {}
+
+    def get(self, ec2_client, instance_id):
+        instance = self._fresh(instance_id) or \
+            self._from_store(ec2_client, 'get_instance', instance_id)
+        if instance is not None:
+            return instance
+        instances = self._describe(ec2_client, instance_ids=[instance_id])
+        return instances[0] if instances else None
+
+    def find_by_node_id(self, ec2_client, node_id):
+        return self._find(ec2_client, self._by_node_id, META_DATA_TAG,
+                          node_id)
+
+    def find_by_name(self, ec2_client, name):
+        return self._find(ec2_client, self._by_name, NAME_TAG, name)
+
+    def find_by_node_ids(self, ec2_client, node_ids):
+        """Returns node id -> instance for the nodes that have one."""
+        found = {}
+        stale = []
+        for node_id in node_ids:
+            instance = self._fresh(self._by_node_id.get(node_id)) or \
+                self._from_store(ec2_client, 'find_instance', META_DATA_TAG,
+                                 node_id)
+            if instance is not None and instance.node_id == node_id:
+                found[node_id] = instance
+            else:
+                stale.append(node_id)
+        if stale:
+            for i in self._describe(
+                    ec2_client, by=('tag:' + META_DATA_TAG, stale),
+                    filters={'instance-state-name': LIVE_STATES}):
+                found[i.node_id] = i
+        return found
+
+    def refresh(self, ec2_client, instance_ids):
+        """Describes the given instances, skipping ones that are fresh."""
+        stale = [i for i in instance_ids if self._fresh(i) is None and
+                 self._from_store(ec2_client, 'get_instance', i) is None]
+        if stale:
+            # Unknown ids make an instance_ids describe fail as a whole,
+            # a filter just leaves them out.
+            self.invalidate(stale)
+            self._describe(ec2_client, by=('instance-id', stale))
+        return [self._by_id[i][0] for i in instance_ids if i in self._by_id]
+
+    def add(self, instances):
+        self._add(instances)
+        if self.store is not None:
+            self.store.put_instances(instances)
+
+    def _add(self, instances):
+        now = time.time()
+        with self._lock:
+            for i in instances:
+                self._by_id[i.id] = (i, now)
+                if i.node_id is not None:
+                    self._by_node_id[i.node_id] = i.id
+                if i.name is not None:
+                    self._by_name[i.name] = i.id
+
+    def invalidate(self, instance_ids):
+        with self._lock:
+            for instance_id in instance_ids:
+                self._by_id.pop(instance_id, None)
+        if self.store is not None:
+            self.store.invalidate_instances(instance_ids)
+
+    def clear(self):
+        with self._lock:
+            self._by_id.clear()
+            self._by_node_id.clear()
+            self._by_name.clear()
+
+    def _from_store(self, ec2_client, method, *args):
+        if self.store is None:
+            return None
+        self.store.start_refresh()
+        instance = getattr(self.store, method)(*args)
+        if instance is not None:
+            self._add([instance])
+        return instance
+
+    def _fresh(self, instance_id):
+        entry = self._by_id.get(instance_id)
+        if entry is None or time.time() - entry[1] >= self.ttl:
+            return None
+        return entry[0]
+
+    def _find(self, ec2_client, index, tag, value):
+        instance_id = index.get(value)
+        if instance_id is not None:
+            instance = self._fresh(instance_id)
+            # Tags may have been changed since the entry was indexed
+            if instance is not None and instance.tag(tag) == value:
+                return instance
+        instance = self._from_store(ec2_client, 'find_instance', tag, value)
+        if instance is not None:
+            return instance
+        instances = aws_plugin_common.iter_instances(ec2_client, filters={
+            'tag:' + tag: value,
+            'instance-state-name': LIVE_STATES})
+        instance = next(instances, None)
+        if instance is not None:
+            self.add([instance])
+        return instance
+
+    def _describe(self, ec2_client, instance_ids=None, filters=None,
+                  by=None):
+        # by is a (filter name, values) pair, values are chunked
+        try:
+            if by is not None:
+                instances = list(aws_plugin_common.iter_instances_by(
+                    ec2_client, by[0], by[1], filters=filters))
+            else:
+                instances = list(aws_plugin_common.iter_instances(
+                    ec2_client, instance_ids=instance_ids, filters=filters))
+        except Exception as e:
+            if aws_plugin_common.error_code(e) != \
+                    'InvalidInstanceID.NotFound':
+                raise
+            self.invalidate(instance_ids or [])
+            return []
+        self.add(instances)
+        return instances
+
+
+_indexes = aws_plugin_common.PerClient(
+    lambda region, access_key_id: InstanceIndex(
+        store=shared_inventory.open_for(region, access_key_id)),
+    pass_key=True)
+
+
+def for_client(ec2_client):
+    """Returns the index for the region and account of ec2_client."""
+    return _indexes.get(ec2_client)
+
+
+def clear():
+    """Drops all indexes, stopping their shared inventory refresh."""
+    for index in _indexes.values():
+        if index.store is not None:
+            index.store.stop_refresh()
+    _indexes.clear()
@@ -0,0 +1,126 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Compiled launch specifications.
+
+A node's server properties are validated, and their image and security
+group resolved, once per node type: nodes with the same properties in
+the same region share a LaunchSpec, so launching hundreds of them
+parses and looks them up a single time.
+"""
+
+import sys
+import copy
+import time
+import hashlib
+import inspect
+import itertools
+import threading
+
+import aws_plugin_common
+
+from ec2_plugin import warm_pool
+
+# Seconds a compiled spec is trusted
+LAUNCH_SPECS_TTL = 600
+
+# (boto version, client class) -> run_instances parameters and defaults
+_signatures = {}
+
+
+def run_instances_defaults(ec2_client):
+    """
+    Returns the parameters of run_instances after image_id with their
+    default values, introspected once per boto version.
+    """
+    client = aws_plugin_common.unwrap_client(ec2_client)
+    key = (getattr(sys.modules.get('boto'), '__version__', None),
+           type(client))
+    ret = _signatures.get(key)
+    if ret is None:
+        # First parameters are 'self' and 'image_id', skipping
+        spec = inspect.getargspec(client.run_instances)
+        ret = tuple(itertools.izip(spec.args[2:], spec.defaults))
+        _signatures[key] = ret
+    return ret
+
+
+def spec_key(properties, region):
+    """Returns the key of the spec compiled from properties in region."""
+    frozen = aws_plugin_common._freeze(properties)
+    return hashlib.sha1(repr((region, frozen)).encode('utf-8')).hexdigest()
+
+
+class LaunchSpec(object):
+    """Validated run_instances parameters shared by nodes of one type."""
+
+    __slots__ = ('key', 'profile', '_params')
+
+    def __init__(self, key, params):
+        self.key = key
+        self.profile = warm_pool.profile_of(params)
+        self._params = tuple(sorted(params.items()))
+
+    @property
+    def params(self):
+        """Returns a copy of the run_instances parameters."""
+        return copy.deepcopy(dict(self._params))
+
+    def __repr__(self):
+        return 'LaunchSpec({0!r})'.format(self.key)
+
+
+class LaunchSpecCache(object):
+    """
+    Compiled specs by key. Concurrent compilations of the same spec
+    share a single one.
+    """
+
+    def __init__(self, ttl=LAUNCH_SPECS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (LaunchSpec, expires)
+        self._specs = {}
+        self._flights = aws_plugin_common.SingleFlight()
+
+    def get(self, key, compile_spec):
+        """Returns the spec with key, compile_spec() builds it if needed."""
+        entry = self._specs.get(key)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+        return self._flights.do(key, lambda: self._compile(key, compile_spec))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._specs.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._specs.clear()
+
+    def _compile(self, key, compile_spec):
+        spec = compile_spec()
+        with self._lock:
+            self._specs[key] = (spec, time.time() + self.ttl)
+        return spec
+
+
+_caches = aws_plugin_common.PerClient(LaunchSpecCache)
+
+
+def for_client(ec2_client):
+    """Returns the cache for the region and account of ec2_client."""
+    return _caches.get(ec2_client)
@@ -0,0 +1,289 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Reconciliation of a deployment's EC2 nodes and security groups.
+
+Given the desired state of all nodes and groups, plan() reads the
+current inventory once, at most one describe of instances by id, one by
+node id and one of security groups, and returns the minimal list of
+actions bringing them to that state. execute() runs a plan with batched
+calls, so the number of API calls grows with the changes made rather
+than with the number of nodes.
+
+    plan = reconcile.plan(ec2_client,
+                          nodes=[(ctx, reconcile.RUNNING) for ctx in ctxs],
+                          groups=[{'name': 'web', 'description': 'web',
+                                   'rules': [...]}])
+    print(plan.describe())
+    errors = reconcile.execute(ec2_client, plan)
+"""
+
+import logging
+
+from ec2_plugin import security_groups
+from ec2_plugin import server
+from ec2_plugin import tagging
+from ec2_plugin import waiter
+
+# Desired node states
+RUNNING = 'running'
+STOPPED = 'stopped'
+ABSENT = 'absent'
+# Desired security group state, besides ABSENT
+PRESENT = 'present'
+
+# Actions, in execution order
+CREATE_GROUP = 'create_group'
+AUTHORIZE = 'authorize'
+LAUNCH = 'launch'
+# Waiting for a stopping instance to stop, before starting it
+WAIT = 'wait'
+START = 'start'
+STOP = 'stop'
+TAG = 'tag'
+TERMINATE = 'terminate'
+DELETE_GROUP = 'delete_group'
+ACTIONS = (CREATE_GROUP, AUTHORIZE, LAUNCH, WAIT, START, STOP, TAG,
+           TERMINATE, DELETE_GROUP)
+
+logger = logging.getLogger(__name__)
+
+
+class Action(object):
+    """
+    One change to make. target is the node id or group name, ctx the
+    node context, instance_id the instance acted on and data the tags,
+    rules or group description involved.
+    """
+
+    __slots__ = ('kind', 'target', 'ctx', 'instance_id', 'data')
+
+    def __init__(self, kind, target, ctx=None, instance_id=None, data=None):
+        self.kind = kind
+        self.target = target
+        self.ctx = ctx
+        self.instance_id = instance_id
+        self.data = data
+
+    def __str__(self):
+        ret = '{0} {1}'.format(self.kind, self.target)
+        if self.instance_id:
+            ret += ' ({0})'.format(self.instance_id)
+        if self.data:
+            ret += ': {0}'.format(self.data)
+        return ret
+
+
+class Plan(object):
+    """Actions bringing nodes and groups to their desired state."""
+
+    def __init__(self):
+        self.actions = []
+
+    def add(self, kind, target, **kw):
+        self.actions.append(Action(kind, target, **kw))
+
+    def of_kind(self, kind):
+        return [a for a in self.actions if a.kind == kind]
+
+    def describe(self):
+        if not self.actions:
+            return 'Nothing to do'
+        return '\n'.join(str(a) for kind in ACTIONS
+                         for a in self.of_kind(kind))
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __iter__(self):
+        return iter(self.actions)
+
+
+def plan(ec2_client, nodes=(), groups=()):
+    """
+    Returns the Plan for nodes, (ctx, RUNNING, STOPPED or ABSENT) pairs,
+    and groups, dicts with a name and optionally a description, a list of
+    rules as taken by configure_security_group and a state, PRESENT by
+    default or ABSENT.
+    """
+    ret = Plan()
+    if groups:
+        _plan_groups(ec2_client, ret, groups)
+    if nodes:
+        _plan_nodes(ec2_client, ret, nodes)
+    return ret
+
+
+def _plan_groups(ec2_client, ret, groups):
+    current = security_groups.for_client(ec2_client).get_by_names(
+        ec2_client, [g['name'] for g in groups])
+    for g in groups:
+        name = g['name']
+        group = current.get(name)
+        if g.get('state', PRESENT) == ABSENT:
+            if group is not None:
+                ret.add(DELETE_GROUP, name, data=group.id)
+            continue
+        rules = g.get('rules') or []
+        if group is None:
+            ret.add(CREATE_GROUP, name, data=g.get('description', name))
+        else:
+            rules = security_groups.missing_rules(group, rules)
+        if rules:
+            ret.add(AUTHORIZE, name, data=rules)
+
+
+def _plan_nodes(ec2_client, ret, nodes):
+    current = server.get_servers(ec2_client, [ctx for ctx, _ in nodes])
+    for ctx, state in nodes:
+        if state == RUNNING and server._is_launching(ctx):
+            # Launching resumes from the last checkpoint
+            ret.add(LAUNCH, ctx.node_id, ctx=ctx)
+            continue
+        i = current.get(ctx.node_id)
+        if i is not None and i.state in ('shutting-down', 'terminated'):
+            i = None
+        if state == ABSENT:
+            if i is not None:
+                ret.add(TERMINATE, ctx.node_id, ctx=ctx, instance_id=i.id)
+            continue
+        if i is None:
+            if state == RUNNING:
+                ret.add(LAUNCH, ctx.node_id, ctx=ctx)
+            continue
+        if state == RUNNING and i.state in ('stopping', 'stopped'):
+            if i.state == 'stopping':
+                # EC2 only starts stopped instances
+                ret.add(WAIT, ctx.node_id, ctx=ctx, instance_id=i.id,
+                        data=waiter.STOPPED)
+            ret.add(START, ctx.node_id, ctx=ctx, instance_id=i.id)
+        elif state == STOPPED and i.state in ('pending', 'running'):
+            ret.add(STOP, ctx.node_id, ctx=ctx, instance_id=i.id)
+        tags = {'Name': server._get_tag_name(ctx), 'meta_data': ctx.node_id}
+        if (i.name, i.node_id) != (tags['Name'], tags['meta_data']):
+            ret.add(TAG, ctx.node_id, ctx=ctx, instance_id=i.id, data=tags)
+
+
+def execute(ec2_client, plan):
+    """
+    Runs the actions of plan, returns (kind, target) -> error for the
+    actions that failed.
+    """
+    errors = {}
+    cache = security_groups.for_client(ec2_client)
+
+    for a in plan.of_kind(CREATE_GROUP):
+        try:
+            cache.add(ec2_client.create_security_group(a.target, a.data))
+        except Exception as e:
+            errors[(a.kind, a.target)] = "Boto bad request error: " + str(e)
+
+    for a in plan.of_kind(AUTHORIZE):
+        if (CREATE_GROUP, a.target) in errors:
+            continue
+        try:
+            group = cache.get_by_name(ec2_client, a.target)
+            security_groups.authorize_rules(ec2_client, group, a.data)
+        except Exception as e:
+            errors[(a.kind, a.target)] = "Boto bad request error: " + str(e)
+        finally:
+            cache.invalidate(a.target)
+
+    launches = plan.of_kind(LAUNCH)
+    if launches:
+        before = [_launch_state(a.ctx) for a in launches]
+        try:
+            server.start_new_servers([a.ctx for a in launches], ec2_client)
+        except Exception as e:
+            # Launch groups done before the failure have their instances
+            errors.update(((a.kind, a.target), str(e))
+                          for a, state in zip(launches, before)
+                          if not _launched(a.ctx, state))
+
+    waits = plan.of_kind(WAIT)
+    if waits:
+        try:
+            waiter.wait_for_state(ec2_client,
+                                  [a.instance_id for a in waits],
+                                  waiter.STOPPED)
+        except Exception as e:
+            errors.update(((a.kind, a.target), str(e)) for a in waits)
+
+    for kind, call in ((START, ec2_client.start_instances),
+                       (STOP, ec2_client.stop_instances),
+                       (TERMINATE, ec2_client.terminate_instances)):
+        actions = [a for a in plan.of_kind(kind)
+                   if (WAIT, a.target) not in errors]
+        if not actions:
+            continue
+        instance_ids = [a.instance_id for a in actions]
+        failures = server._call_in_chunks(call, instance_ids)
+        server._invalidate(ec2_client, instance_ids)
+        for a in actions:
+            if a.instance_id in failures:
+                errors[(a.kind, a.target)] = failures[a.instance_id]
+            elif kind == TERMINATE:
+                server._bump_launch_generation(a.ctx)
+                a.ctx.update()
+
+    tags = plan.of_kind(TAG)
+    if tags:
+        failures = tagging.for_client(ec2_client).create_tags(
+            ec2_client, dict((a.instance_id, a.data) for a in tags))
+        server._invalidate(ec2_client, [a.instance_id for a in tags])
+        errors.update(((a.kind, a.target), str(failures[a.instance_id]))
+                      for a in tags if a.instance_id in failures)
+
+    for a in plan.of_kind(DELETE_GROUP):
+        try:
+            ec2_client.delete_security_group(name=a.target, group_id=a.data)
+        except Exception as e:
+            errors[(a.kind, a.target)] = "Boto bad request error: " + str(e)
+        finally:
+            cache.invalidate(a.target)
+    return errors
+
+
+def _launch_state(ctx):
+    return (ctx[server.AWS_SERVER_ID_PROPERTY]
+            if server.AWS_SERVER_ID_PROPERTY in ctx else None,
+            ctx[server.LAUNCH_PHASE_PROPERTY]
+            if server.LAUNCH_PHASE_PROPERTY in ctx else None)
+
+
+def _launched(ctx, before):
+    # The node's launch completed since its launch state was before
+    instance_id, phase = _launch_state(ctx)
+    return phase == server.RECORDED and (before[1] != server.RECORDED or
+                                         instance_id != before[0])
+
+
+def reconcile(ec2_client, nodes=(), groups=(), dry_run=False, log=None):
+    """
+    Plans and, unless dry_run, executes the changes bringing nodes and
+    groups to their desired state. The plan is logged to log, this
+    module's logger by default. Returns the plan and the errors.
+    """
+    log = log or logger
+    ret = plan(ec2_client, nodes, groups)
+    log.info("{0}EC2 plan with {1} actions:\n{2}".format(
+        'Dry run of ' if dry_run else '', len(ret), ret.describe()))
+    if dry_run:
+        return ret, {}
+    errors = execute(ec2_client, ret)
+    for (kind, target), error in sorted(errors.items()):
+        log.error("Failed to {0} {1}: {2}".format(kind, target, error))
+    return ret, errors
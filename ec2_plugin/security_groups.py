@@ -0,0 +1,200 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import time
+import threading
+
+import aws_plugin_common
+
+from ec2_plugin import shared_inventory
+
+# Seconds a cached security group (or its absence) is trusted
+SECURITY_GROUPS_TTL = 60
+
+
+class SecurityGroupCache(object):
+    """
+    Security groups indexed by name and id.
+
+    Groups, and names known not to exist, are kept for ttl seconds.
+    Groups created, deleted or modified through the plugin must be
+    added or invalidated explicitly. Group ids are also shared with other
+    processes through the host's shared inventory when one is configured.
+    """
+
+    def __init__(self, ttl=SECURITY_GROUPS_TTL, store=None):
+        self.ttl = ttl
+        self.store = store
+        self._lock = threading.Lock()
+        # name -> (group or None, fetched_at)
+        self._by_name = {}
+        # id -> name
+        self._names = {}
+
+    def get_by_name(self, ec2_client, name):
+        entry = self._by_name.get(name)
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            return entry[0]
+        groups = ec2_client.get_all_security_groups(
+            filters={'group-name': name})
+        group = groups[0] if groups else None
+        with self._lock:
+            self._by_name[name] = (group, time.time())
+            if group is not None:
+                self._names[group.id] = name
+        if self.store is not None:
+            self.store.put_security_group(name, group and group.id)
+        return group
+
+    def get_by_names(self, ec2_client, names):
+        """
+        Returns name -> group, None for missing groups, describing the
+        names not cached with a single call.
+        """
+        now = time.time()
+        ret = {}
+        stale = []
+        for name in names:
+            entry = self._by_name.get(name)
+            if entry is not None and now - entry[1] < self.ttl:
+                ret[name] = entry[0]
+            else:
+                stale.append(name)
+        if not stale:
+            return ret
+        found = dict(
+            (g.name, g) for chunk in aws_plugin_common.chunks(stale)
+            for g in ec2_client.get_all_security_groups(
+                filters={'group-name': chunk}))
+        with self._lock:
+            for name in stale:
+                group = found.get(name)
+                self._by_name[name] = (group, time.time())
+                if group is not None:
+                    self._names[group.id] = name
+                ret[name] = group
+        if self.store is not None:
+            for name in stale:
+                self.store.put_security_group(name, found[name].id
+                                              if name in found else None)
+        return ret
+
+    def get_id_by_name(self, ec2_client, name):
+        """
+        Returns the id of the group named name, None if there is none.
+        Unlike get_by_name() it can be answered by the shared inventory.
+        """
+        entry = self._by_name.get(name)
+        if (entry is None or time.time() - entry[1] >= self.ttl) and \
+                self.store is not None:
+            known, group_id = self.store.get_security_group(name)
+            if known:
+                return group_id
+        group = self.get_by_name(ec2_client, name)
+        return group.id if group is not None else None
+
+    def get_by_id(self, ec2_client, group_id):
+        name = self._names.get(group_id)
+        if name is not None:
+            group = self.get_by_name(ec2_client, name)
+            if group is not None and group.id == group_id:
+                return group
+        groups = ec2_client.get_all_security_groups(
+            filters={'group-id': group_id})
+        if not groups:
+            return None
+        self.add(groups[0])
+        return groups[0]
+
+    def add(self, group):
+        with self._lock:
+            self._by_name[group.name] = (group, time.time())
+            self._names[group.id] = group.name
+        if self.store is not None:
+            self.store.put_security_group(group.name, group.id)
+
+    def invalidate(self, name):
+        with self._lock:
+            entry = self._by_name.pop(name, None)
+            if entry is not None and entry[0] is not None:
+                self._names.pop(entry[0].id, None)
+        if self.store is not None:
+            self.store.invalidate_security_group(name)
+
+    def clear(self):
+        with self._lock:
+            self._by_name.clear()
+            self._names.clear()
+
+
+_caches = aws_plugin_common.PerClient(
+    lambda region, access_key_id: SecurityGroupCache(
+        store=shared_inventory.open_for(region, access_key_id)),
+    pass_key=True)
+
+
+def for_client(ec2_client):
+    """Returns the cache for the region and account of ec2_client."""
+    return _caches.get(ec2_client)
+
+
+def _rule_key(ip_protocol, from_port, to_port):
+    return (str(ip_protocol).lower(), str(from_port), str(to_port))
+
+
+def missing_rules(group, rules):
+    """
+    Returns the rules, dicts with ip_protocol, from_port, to_port and
+    cidr_ip, that group does not have yet, without duplicates.
+    """
+    existing = set()
+    for rule in group.rules:
+        key = _rule_key(rule.ip_protocol, rule.from_port, rule.to_port)
+        for grant in rule.grants:
+            existing.add(key + (grant.cidr_ip, ))
+    ret = []
+    for rule in rules:
+        key = _rule_key(rule['ip_protocol'], rule['from_port'],
+                        rule['to_port']) + (rule['cidr_ip'], )
+        if key not in existing:
+            existing.add(key)
+            ret.append(rule)
+    return ret
+
+
+def authorize_rules(ec2_client, group, rules):
+    """
+    Authorizes ingress rules on group with a single API call.
+
+    boto's authorize_security_group() takes one CIDR per call, the
+    underlying AuthorizeSecurityGroupIngress action takes any number of
+    permissions, each with any number of ranges.
+    """
+    permissions = {}
+    for rule in rules:
+        key = _rule_key(rule['ip_protocol'], rule['from_port'],
+                        rule['to_port'])
+        permissions.setdefault(key, []).append(rule['cidr_ip'])
+
+    params = {'GroupId': group.id}
+    for n, (key, cidrs) in enumerate(sorted(permissions.items()), 1):
+        prefix = 'IpPermissions.{0}.'.format(n)
+        params[prefix + 'IpProtocol'] = key[0]
+        params[prefix + 'FromPort'] = key[1]
+        params[prefix + 'ToPort'] = key[2]
+        for m, cidr_ip in enumerate(cidrs, 1):
+            params[prefix + 'IpRanges.{0}.CidrIp'.format(m)] = cidr_ip
+    return ec2_client.get_status('AuthorizeSecurityGroupIngress', params,
+                                 verb='POST')
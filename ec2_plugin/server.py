@@ -13,12 +13,20 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
-import time
 import copy
-import inspect
-import itertools
+import hashlib
 import aws_plugin_common
 
+from aws_plugin_common import regions
+
+from ec2_plugin import images
+from ec2_plugin import inventory
+from ec2_plugin import launch_specs
+from ec2_plugin import security_groups
+from ec2_plugin import tagging
+from ec2_plugin import tracker
+from ec2_plugin import waiter
+from ec2_plugin import warm_pool
 from base64 import standard_b64decode
 from cloudify.decorators import operation
 
@@ -27,8 +35,19 @@ with_ec2_client = aws_plugin_common.with_ec2_client
 NODE_ID_PROPERTY = 'cloudify_id'
 AWS_SERVER_ID_PROPERTY = 'aws_instance_id'
 AWS_SERVER_DETAILS = 'runtime_info'
+LAUNCH_PHASE_PROPERTY = 'launch_phase'
+LAUNCH_GENERATION_PROPERTY = 'launch_generation'
 sec_group = {}
 
+# Max instance ids passed to a single start/stop/terminate call
+INSTANCES_PER_CALL = 100
+
+# Phases of a launch, checkpointed in the runtime properties
+LAUNCHED = 'launched'
+TAGGED = 'tagged'
+RUNNING = 'running'
+RECORDED = 'recorded'
+
 
 def start_new_server(ctx, ec2_client):
     """
@@ -36,7 +55,63 @@ def start_new_server(ctx, ec2_client):
     http://boto.readthedocs.org/en/latest/ref/ec2.html#module-boto.ec2
     run_instances class
     """
+    start_new_servers([ctx], ec2_client)
+
+
+def start_new_servers(ctxs, ec2_client):
+    """
+    Creates instances for many nodes.
 
+    Nodes with identical launch parameters (image, type, placement, key,
+    security groups, ...) are launched with a single run_instances call,
+    waited for together and described together. Each node's context gets
+    its own instance id and details.
+    """
+    # Nodes whose instance was launched by an interrupted attempt
+    resumed = [(ctx, _get_tag_name(ctx)) for ctx in ctxs
+               if _is_launching(ctx) and ctx[LAUNCH_PHASE_PROPERTY]]
+    if resumed:
+        resumed_ids = set(id(ctx) for ctx, _ in resumed)
+        ctxs = [ctx for ctx in ctxs if id(ctx) not in resumed_ids] + \
+            _resume_servers(ec2_client, resumed)
+
+    # Nodes whose recorded instance is gone, the token of their last
+    # launch would return it
+    recorded = [ctx for ctx in ctxs
+                if AWS_SERVER_ID_PROPERTY in ctx and not _is_launching(ctx)]
+    if recorded:
+        found = dict((i.id, i) for i in inventory.for_client(ec2_client)
+                     .refresh(ec2_client, [ctx[AWS_SERVER_ID_PROPERTY]
+                                           for ctx in recorded]))
+        for ctx in recorded:
+            i = found.get(ctx[AWS_SERVER_ID_PROPERTY])
+            if i is None or i.state in ('shutting-down', 'terminated'):
+                _new_launch(ctx)
+
+    groups = {}
+    for ctx in ctxs:
+        spec = _get_launch_spec(ctx, ec2_client)
+        groups.setdefault(spec.key, (spec, []))[1].append(
+            (ctx, _get_tag_name(ctx)))
+
+    for spec, nodes in groups.values():
+        _launch_servers(ec2_client, spec, nodes)
+
+
+def _get_tag_name(ctx):
+    return ctx.properties['server'].get('name') or ctx.node_id
+
+
+def _get_launch_spec(ctx, ec2_client):
+    # Nodes with the same properties share the spec compiled for the first
+    properties = {'server': ctx.properties['server'],
+                  'security_group': ctx.properties.get('security_group')}
+    key = launch_specs.spec_key(properties, ec2_client.region.name)
+    return launch_specs.for_client(ec2_client).get(
+        key, lambda: _compile_launch_spec(ctx, ec2_client, key))
+
+
+def _compile_launch_spec(ctx, ec2_client, key):
     server = {
         'name': ctx.node_id
     }
@@ -45,28 +120,22 @@ def start_new_server(ctx, ec2_client):
     ctx.logger.debug(
         "instance.run_instances() server before transformations: {0}".format(server))
 
-    # First parameter is 'self', skipping
-    params_names = inspect.getargspec(ec2_client.run_instances).args[2:]
+    _fail_on_missing_required_parameters(
+        server,
+        ('name', 'image_id', 'instance_type','security_groups',
+        'placement','key_name'),
+        'server')
 
-    params_default_values = inspect.getargspec(
-        ec2_client.run_instances).defaults
-    params = dict(itertools.izip(params_names, params_default_values))
+    params = dict(launch_specs.run_instances_defaults(ec2_client))
 
     # Sugar
     if 'image_id' in server:
-        server['image_id'] = ec2_client.get_all_images(image_ids=server['image_id'])
-        params['image_id'] = server['image_id'][0].id
+        params['image_id'] = images.for_client(ec2_client).resolve(
+            ec2_client, image_id=server['image_id'])
         del server['image_id']
 
-    tag_name = server['name']
     del server['name']
 
-    _fail_on_missing_required_parameters(
-        server,
-        ('name', 'image_id', 'instance_type','security_groups',
-        'placement','key_name'),
-        'server')
-
     # Fail on unsupported parameters
     for k in server:
         if k not in params:
@@ -83,7 +152,7 @@ def start_new_server(ctx, ec2_client):
                                                           server['security_groups'])
 
     securitygroup = []
-    if security_group_presence[0]['name'] == server['security_groups']:
+    if security_group_presence:
         securitygroup.append(server['security_groups'])
         params['security_groups'] = securitygroup
     else:
@@ -93,36 +162,189 @@ def start_new_server(ctx, ec2_client):
     ctx.logger.debug(
         "Asking EC2 to create Server. All possible parameters are: {0})"
         .format(','.join(params.keys())))
+    return launch_specs.LaunchSpec(key, params)
+
+
+def _launch_servers(ec2_client, spec, nodes):
+    # nodes is a list of (ctx, Name tag) sharing the same LaunchSpec
+    params = spec.params
+    timeouts = [ctx.properties.get('start_timeout') for ctx, _ in nodes]
+    timeout = max([t for t in timeouts if t] or [None])
+    pool_size = max(ctx.properties.get('warm_pool_size') or 0
+                    for ctx, _ in nodes)
+    config = nodes[0][0].properties.get('ec2_config')
     try:
-        s = ec2_client.run_instances(**params)
+        instance_ids = []
+        if pool_size:
+            pool = warm_pool.for_client(ec2_client)
+            instance_ids = pool.claim(ec2_client, spec.profile, len(nodes))
+            if instance_ids:
+                try:
+                    ec2_client.start_instances(instance_ids)
+                except Exception:
+                    pool.release(ec2_client, spec.profile, instance_ids)
+                    raise
+            nodes[0][0].logger.info(
+                "Claimed {0} of {1} instances from the warm pool, hit rate "
+                "{hit_rate:.0%}, mean claim latency {claim_latency:.3f}s"
+                .format(len(instance_ids), len(nodes), **pool.stats()))
+        cold = len(nodes) - len(instance_ids)
+        if cold:
+            s = ec2_client.run_instances(**dict(
+                params, min_count=cold, max_count=cold,
+                client_token=params.get('client_token') or
+                _client_token(nodes[len(instance_ids):])))
+            instance_ids += [i.id for i in s.instances]
+        _checkpoint(nodes, instance_ids, LAUNCHED)
+
+        servers_details = _complete_launch(ec2_client, nodes, instance_ids,
+                                           LAUNCHED, timeout, config)
+        for (ctx, _), instance_id in zip(nodes, instance_ids):
+            server_details = servers_details.get(instance_id)
+            ctx.logger.info("Created VM with Parameters {0} Security_Group {1}."
+                            .format(str(server_details),
+                                    params['security_groups']))
+
+    except Exception as e:
+        # The image or security group of the spec may be gone
+        launch_specs.for_client(ec2_client).invalidate(spec.key)
+        raise RuntimeError("Boto bad request error: " + str(e))
+    if pool_size:
+        pool.top_up(params, pool_size, config=config)
 
-        active_server = _wait_for_server_to_become_active(ec2_client, s)
-        ##Assign name to server
-        ec2_client.create_tags([active_server.id], {"Name": tag_name})
 
-        meta_data = dict({})
-        meta_data[NODE_ID_PROPERTY] = ctx.node_id
-        meta_data = meta_data['cloudify_id']
-        ec2_client.create_tags([active_server.id], {"meta_data": meta_data})
+def _resume_servers(ec2_client, nodes):
+    """
+    Continues interrupted launches from their last checkpoint.
 
-        server_details = _get_server_status(ec2_client, active_server.id)
-        ctx.logger.info("Created VM with Parameters {0} Security_Group {1}."
-                        .format(str(server_details),
-                                params['security_groups']))
+    nodes is a list of (ctx, Name tag) whose instances are looked up with
+    a single describe. Returns the contexts of nodes whose instance is
+    gone, those must be launched again.
+    """
+    instance_ids = [ctx[AWS_SERVER_ID_PROPERTY] for ctx, _ in nodes]
+    found = dict((i.id, i) for i in inventory.for_client(ec2_client)
+                 .refresh(ec2_client, instance_ids))
+    relaunch = []
+    by_phase = {}
+    for node, instance_id in zip(nodes, instance_ids):
+        ctx = node[0]
+        i = found.get(instance_id)
+        if i is None or i.state in ('shutting-down', 'terminated'):
+            _new_launch(ctx)
+            relaunch.append(ctx)
+            continue
+        by_phase.setdefault(ctx[LAUNCH_PHASE_PROPERTY], []).append(
+            (node, instance_id))
 
+    try:
+        for phase, members in by_phase.items():
+            phase_nodes = [node for node, _ in members]
+            phase_ids = [instance_id for _, instance_id in members]
+            timeouts = [ctx.properties.get('start_timeout')
+                        for ctx, _ in phase_nodes]
+            servers_details = _complete_launch(
+                ec2_client, phase_nodes, phase_ids, phase,
+                max([t for t in timeouts if t] or [None]),
+                phase_nodes[0][0].properties.get('ec2_config'),
+                [found[i] for i in phase_ids])
+            for (ctx, _), instance_id in members:
+                ctx.logger.info(
+                    "Resumed launch of VM {0} after the {1} phase: {2}"
+                    .format(instance_id, phase,
+                            servers_details.get(instance_id)))
     except Exception as e:
         raise RuntimeError("Boto bad request error: " + str(e))
-    ctx[AWS_SERVER_ID_PROPERTY] = active_server.id
-    ctx[AWS_SERVER_DETAILS] = server_details
+    return relaunch
+
+
+def _complete_launch(ec2_client, nodes, instance_ids, phase, timeout=None,
+                     config=None, records=None):
+    # Runs the launch phases following phase, checkpointing each of them.
+    # records are the described instances, when still current.
+    if phase == LAUNCHED:
+        ##Assign name and node id to servers, EC2 may not know them yet
+        failures = tagging.tag_new_instances(
+            ec2_client,
+            dict((instance_id, {"Name": tag_name, "meta_data": ctx.node_id})
+                 for (ctx, tag_name), instance_id in zip(nodes,
+                                                         instance_ids)))
+        if failures:
+            raise RuntimeError("Failed tagging instances: {0}"
+                               .format(failures))
+        _checkpoint(nodes, instance_ids, TAGGED)
+        phase, records = TAGGED, None
+
+    if phase == TAGGED:
+        waiter.wait_for_state(ec2_client, instance_ids, waiter.RUNNING,
+                              timeout=timeout)
+        _checkpoint(nodes, instance_ids, RUNNING)
+        phase, records = RUNNING, None
+
+    index = inventory.for_client(ec2_client)
+    if records is None:
+        index.invalidate(instance_ids)
+        records = index.refresh(ec2_client, instance_ids)
+    tracker.for_client(ec2_client).track(records, config=config)
+    servers_details = dict(
+        (i.id, [_get_server_details(i)]) for i in records)
+    for (ctx, _), instance_id in zip(nodes, instance_ids):
+        ctx[AWS_SERVER_DETAILS] = servers_details.get(instance_id)
+    _checkpoint(nodes, instance_ids, RECORDED)
+    return servers_details
+
+
+def _checkpoint(nodes, instance_ids, phase):
+    for (ctx, _), instance_id in zip(nodes, instance_ids):
+        ctx[AWS_SERVER_ID_PROPERTY] = instance_id
+        ctx[LAUNCH_PHASE_PROPERTY] = phase
+        ctx.update()
+
+
+def _is_launching(ctx):
+    # A launch was interrupted before its instance was recorded
+    return LAUNCH_PHASE_PROPERTY in ctx and \
+        ctx[LAUNCH_PHASE_PROPERTY] != RECORDED
+
+
+def _launch_generation(ctx):
+    return ctx[LAUNCH_GENERATION_PROPERTY] \
+        if LAUNCH_GENERATION_PROPERTY in ctx else 0
+
+
+def _new_launch(ctx):
+    # A new launch needs a new client token. The node counts as launching
+    # until its new instance is recorded, so retries keep the token.
+    _bump_launch_generation(ctx)
+    ctx[LAUNCH_PHASE_PROPERTY] = None
     ctx.update()
 
 
+def _bump_launch_generation(ctx):
+    # The next launch of the node must not reuse the client token
+    ctx[LAUNCH_GENERATION_PROPERTY] = _launch_generation(ctx) + 1
+
+
+def _client_token(nodes):
+    # Retries launching the same nodes send the same token, EC2 then
+    # returns the instances of the first attempt instead of launching.
+    key = ','.join('{0}/{1}/{2}'.format(ctx.deployment_id, ctx.node_id,
+                                        _launch_generation(ctx))
+                   for ctx, _ in nodes)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
 @operation
 @with_ec2_client
 def start(ctx, ec2_client, **kwargs):
+    if _is_launching(ctx):
+        start_new_server(ctx, ec2_client)
+        return
+
     server = get_server_by_context(ec2_client, ctx)
-    if server is not None:
+    i = _get_server(ec2_client, server)
+    if i is not None and i.state not in ('shutting-down', 'terminated'):
         ec2_client.start_instances(server)
+        _invalidate(ec2_client, [server])
         return
 
     start_new_server(ctx, ec2_client)
@@ -138,9 +360,10 @@ def stop(ctx, ec2_client, **kwargs):
     for Instance stored backed AMI  server.stop not supported"
     """
     server = get_server_by_context(ec2_client, ctx)
-    server_state = _get_server_status(ec2_client, server)
-    if server_state[0]['Status'] is "running":
+    i = _get_server(ec2_client, server)
+    if i is not None and i.state == "running":
         ec2_client.stop_instances(server)
+        _invalidate(ec2_client, [server])
     else:
         raise RuntimeError(
             "Cannot stop server - server doesn't exist for node: {0}"
@@ -151,49 +374,188 @@ def stop(ctx, ec2_client, **kwargs):
 @with_ec2_client
 def delete(ctx, ec2_client, **kwargs):
     server = get_server_by_context(ec2_client, ctx)
-    server_state = _get_server_status(ec2_client, server)
-    if server_state[0]['Status'] is "running" or \
-            server_state[0]['Status'] is "stopped":
+    i = _get_server(ec2_client, server)
+    if i is not None and i.state in ("running", "stopped"):
         ec2_client.terminate_instances(server)
+        _invalidate(ec2_client, [server])
+        _bump_launch_generation(ctx)
+        ctx.update()
     else:
         raise RuntimeError(
             "Cannot delete server - server doesn't exist for node: {0}"
             .format(ctx.node_id))
 
 
+def start_servers(ec2_client, servers):
+    """
+    Starts many servers, given as node contexts or instance ids.
+
+    Returns a dict keyed by node id (or instance id) with the instance id
+    and the error, if any, for every requested server.
+    """
+    return _change_servers_state(ec2_client, servers,
+                                 ec2_client.start_instances,
+                                 ("stopped", ), 'start')
+
+
+def stop_servers(ec2_client, servers):
+    """Stops many servers, see start_servers()."""
+    return _change_servers_state(ec2_client, servers,
+                                 ec2_client.stop_instances,
+                                 ("running", ), 'stop')
+
+
+def delete_servers(ec2_client, servers):
+    """Terminates many servers, see start_servers()."""
+    results = _change_servers_state(ec2_client, servers,
+                                    ec2_client.terminate_instances,
+                                    ("running", "stopped"), 'delete')
+    for server in servers:
+        if not isinstance(server, basestring) and \
+                results[server.node_id]['error'] is None:
+            _bump_launch_generation(server)
+            server.update()
+    return results
+
+
+def _change_servers_state(ec2_client, servers, call, allowed_states, action):
+    results = {}
+    instance_ids = []
+    for key, i in get_servers(ec2_client, servers).items():
+        if i is None:
+            error = "server doesn't exist for node: {0}".format(key)
+        elif i.state not in allowed_states:
+            error = "server is {0} for node: {1}".format(i.state, key)
+        else:
+            error = None
+            instance_ids.append(i.id)
+        results[key] = {'instance_id': i.id if i else None,
+                        'error': error and "Cannot {0} server - {1}"
+                        .format(action, error)}
+
+    failures = _call_in_chunks(call, instance_ids)
+    _invalidate(ec2_client, instance_ids)
+
+    for result in results.values():
+        if result['instance_id'] in failures:
+            result['error'] = failures[result['instance_id']]
+    return results
+
+
+def _call_in_chunks(call, instance_ids):
+    # Calls call with up to INSTANCES_PER_CALL ids at a time, returns
+    # instance id -> error for the instances it failed for.
+    failures = {}
+    for n in range(0, len(instance_ids), INSTANCES_PER_CALL):
+        chunk = instance_ids[n:n + INSTANCES_PER_CALL]
+        try:
+            call(chunk)
+        except Exception as e:
+            if not aws_plugin_common.is_resource_error(e):
+                # Throttled or failing, calling per instance makes it worse
+                failures.update((instance_id,
+                                 "Boto bad request error: " + str(e))
+                                for instance_id in chunk)
+                continue
+            # One bad instance fails the whole call, isolate it
+            for instance_id in chunk:
+                try:
+                    call([instance_id])
+                except Exception as e:
+                    failures[instance_id] = \
+                        "Boto bad request error: " + str(e)
+    return failures
+
+
+def _invalidate(ec2_client, instance_ids):
+    # Instances changing state through the plugin
+    inventory.for_client(ec2_client).invalidate(instance_ids)
+    tracker.for_client(ec2_client).invalidate(instance_ids)
+
+
+def get_servers(ec2_client, servers):
+    """
+    Returns the instance records of many servers, given as node contexts
+    or instance ids, keyed by node id (or instance id), None for servers
+    without an instance. Makes at most one describe by instance id and
+    one by node id.
+    """
+    index = inventory.for_client(ec2_client)
+    by_instance_id = {}
+    node_ids = []
+    for server in servers:
+        if isinstance(server, basestring):
+            by_instance_id[server] = server
+        elif AWS_SERVER_ID_PROPERTY in server:
+            by_instance_id[server.node_id] = server[AWS_SERVER_ID_PROPERTY]
+        else:
+            node_ids.append(server.node_id)
+
+    found = dict((i.id, i) for i in
+                 index.refresh(ec2_client, by_instance_id.values()))
+    ret = dict((key, found.get(instance_id))
+               for key, instance_id in by_instance_id.items())
+    by_node_id = index.find_by_node_ids(ec2_client, node_ids) \
+        if node_ids else {}
+    ret.update((node_id, by_node_id.get(node_id)) for node_id in node_ids)
+    return ret
+
+
 def get_server_by_context(ec2_client, ctx):
     """
     Gets a instance for the provided context.
 
     If aws instance id is present it would be used for getting the server.
-    Otherwise, an iteration on all servers userdata will be made.
+    Otherwise, instances are looked up by the meta_data tag holding the
+    node id.
     """
     # Getting instance by its AWS instance id is faster tho it requires
     # a REST API call to Cloudify's storage for getting runtime properties.
+    index = inventory.for_client(ec2_client)
     if AWS_SERVER_ID_PROPERTY in ctx:
-        reservations = ec2_client.get_all_instances(instance_ids=ctx[AWS_SERVER_ID_PROPERTY])
-        servers = [i for r in reservations for i in r.instances]
-        return servers[0].id
+        server = index.get(ec2_client, ctx[AWS_SERVER_ID_PROPERTY])
+        return server.id if server else None
     # Fallback
-    reservations = ec2_client.get_all_instances()
-    servers = [{'tags':i.tags['meta_data'], 'instance_id':i.id} for r in reservations
-           for i in r.instances if i.tags if i.tags.get('meta_data') == NODE_ID_PROPERTY]
+    server = index.find_by_node_id(ec2_client, ctx.node_id)
+    return server.id if server else None
 
-    for server in servers:
-        return server['instance_id']
 
-    return None
+def get_server_by_context_in_regions(ctx, region_names=None, timeout=None):
+    """
+    Looks the instance of ctx up in all configured regions, or in
+    region_names, at once.
+
+    Returns a RegionResult per region, its value is the instance id or
+    None.
+    """
+    return regions.fan_out(
+        lambda ec2_client: get_server_by_context(ec2_client, ctx),
+        config=ctx.properties.get('ec2_config'), regions=region_names,
+        timeout=timeout)
 
 
 @operation
 @with_ec2_client
 def get_state(ctx, ec2_client, **kwargs):
-    server = get_server_by_context(ec2_client, ctx)
-    server_state = _get_server_status(ec2_client, server)
-    if server_state[0]['Status'] is "running":
-        ctx['ip'] = server_state[0]['Public IP']
+    # Instances launched by this worker are polled in the background,
+    # answer from memory while their status is fresh.
+    statuses = tracker.for_client(ec2_client)
+    status = statuses.get(ctx[AWS_SERVER_ID_PROPERTY]) \
+        if AWS_SERVER_ID_PROPERTY in ctx else None
+    if status is not None:
+        server, state, ip = status.id, status.state, status.ip_address
+    else:
+        i = _get_server(ec2_client, get_server_by_context(ec2_client, ctx))
+        if i is None:
+            return False
+        server, state, ip = i.id, i.state, i.ip_address
+        if state != "terminated":
+            statuses.track([i], config=ctx.properties.get('ec2_config'))
+    if state == "running":
+        ctx['ip'] = ip
         # The ip of this instance in the management network
-        ctx.logger.info("Instance id").format(str(server_state[0]['Public IP']))
+        ctx.logger.info("Instance {0} is running with public IP {1}"
+                        .format(server, ip))
         return True
     return False
 
@@ -213,6 +575,7 @@ def create_security_group(ctx, ec2_client, **kwargs):
         sg_create = ec2_client.create_security_group(
             sec_group['crt_sg_name'],
             sec_group['description'])
+        security_groups.for_client(ec2_client).add(sg_create)
         ctx.logger.info("Creating Security Group with Parameters: {0}".format(str(sg_create)))
         return str(sg_create.name)
 
@@ -234,6 +597,9 @@ def delete_security_group(ctx, ec2_client, **kwargs):
             ctx.logger.info("Security group Deleted")
         except Exception as e:
             raise RuntimeError("Boto bad request error: " + str(e))
+        finally:
+            security_groups.for_client(ec2_client).invalidate(
+                sec_group['del_sg_name'])
     else:
         raise RuntimeError(
             "Cannot delete Security Group - Security Group doesn't exist for node: {0}"
@@ -243,29 +609,48 @@ def delete_security_group(ctx, ec2_client, **kwargs):
 @operation
 @with_ec2_client
 def configure_security_group(ctx, ec2_client, **kwargs):
+    """
+    Add rules to existing Security Group.
 
-    #Add rules to existing Security Group
+    Rules are either given as a list under 'rules', each with ip_protocol,
+    cidr_ip, from_port and to_port, or as a single rule directly in the
+    security_group properties. Only rules the group does not have yet are
+    authorized, all of them in one call.
+    """
     sec_group.update(copy.deepcopy(ctx.properties['security_group']))
-    _fail_on_missing_required_parameters(sec_group, ('conf_sg_name',
-                                                     'ip_protocol',
-                                                     'cidr_ip',
-                                                     'from_port',
-                                                     'to_port', ),
-                                         'security_groups.configure')
-    security_group_presence = _get_security_group_by_name(ec2_client,
-                                                          sec_group['conf_sg_name'])
-    if security_group_presence:
+    rules = ctx.properties['security_group'].get('rules')
+    if rules:
+        _fail_on_missing_required_parameters(sec_group, ('conf_sg_name', ),
+                                             'security_groups.configure')
+    else:
+        _fail_on_missing_required_parameters(sec_group, ('conf_sg_name',
+                                                         'ip_protocol',
+                                                         'cidr_ip',
+                                                         'from_port',
+                                                         'to_port', ),
+                                             'security_groups.configure')
+        rules = [sec_group]
+    for rule in rules:
+        _fail_on_missing_required_parameters(rule, ('ip_protocol',
+                                                    'cidr_ip',
+                                                    'from_port',
+                                                    'to_port', ),
+                                             'security_groups.rules')
+    cache = security_groups.for_client(ec2_client)
+    group = cache.get_by_name(ec2_client, sec_group['conf_sg_name'])
+    if group is not None:
+        missing = security_groups.missing_rules(group, rules)
+        if not missing:
+            ctx.logger.info("Security group already has all the rules")
+            return
         try:
-            security_group = ec2_client.authorize_security_group(
-                group_name=security_group_presence[0]['name'],
-                src_security_group_group_id=security_group_presence[0]['id'],
-                ip_protocol=sec_group['ip_protocol'],
-                cidr_ip=sec_group['cidr_ip'],
-                from_port=sec_group['from_port'],
-                to_port=sec_group['to_port'])
-            ctx.logger.info("Rules added to the Security group ")
+            security_groups.authorize_rules(ec2_client, group, missing)
+            ctx.logger.info("{0} rules added to the Security group"
+                            .format(len(missing)))
         except Exception as e:
             raise RuntimeError("Boto bad request error: " + str(e))
+        finally:
+            cache.invalidate(group.name)
     else:
         raise RuntimeError(
             "Unable to Add rules to the Group - Security Group doesn't exist for node: {0}"
@@ -274,34 +659,47 @@ def configure_security_group(ctx, ec2_client, **kwargs):
 
 def _get_security_group_by_name(ec2_client, name):
     #Return Security Group Name is present or not in AWS EC2
-    security_groups = ec2_client.get_all_security_groups(groupnames=None,
-                                                         group_ids=None,
-                                                         filters=None)
-    return [{'id': sg.id, "name": sg.name} for sg in security_groups if sg.name == name]
-
-
-def _get_server_status(ec2_client, server_id):
-    #Instance Status in AWS
-    aws_reservations = ec2_client.get_all_instances()
-    servers = [i for r in aws_reservations for i in r.instances]
-    for i in servers:
-        if i.id == server_id:
-            return [{"Status": i.update(), "Host_name": i.tags["Name"],
-                    "Image Id": i.image_id, "Placement": i.placement,
-                    "Key_Name": i.key_name, "Public IP": i.ip_address,
-                    "Hardware id": server_id, "Private IP": i.private_ip_address}]
-
-
-def _wait_for_server_to_become_active(ec2_client, server):
-    timeout = 100
-    while server.instances[0].state != "running":
-        timeout -= 5
-        if timeout <= 0:
-            raise RuntimeError('Server failed to start in time')
-        time.sleep(5)
-        server = ec2_client.get_all_instances(instance_ids=str(server.instances[0].id))[0]
-
-    return server.instances[0]
+    sg_id = security_groups.for_client(ec2_client).get_id_by_name(ec2_client,
+                                                                  name)
+    return [{'id': sg_id, "name": name}] if sg_id else []
+
+
+def get_security_groups_by_name_in_regions(name, config=None,
+                                           region_names=None, timeout=None):
+    """
+    Looks the security group called name up in all configured regions, or
+    in region_names, at once.
+
+    Returns (groups, errors): a {'region', 'id', 'name'} dict per group
+    found, in the order of regions, and region -> error for the regions
+    that failed or did not answer in time.
+    """
+    groups = []
+    errors = {}
+    for result in regions.fan_out(
+            lambda ec2_client: _get_security_group_by_name(ec2_client, name),
+            config=config, regions=region_names, timeout=timeout):
+        if result.error is not None:
+            errors[result.region] = result.error
+            continue
+        for group in result.value:
+            groups.append(dict(group, region=result.region))
+    return groups, errors
+
+
+def _get_server(ec2_client, server_id):
+    #Instance record in AWS, None if there is no such instance
+    if server_id is None:
+        return None
+    return inventory.for_client(ec2_client).get(ec2_client, server_id)
+
+
+def _get_server_details(i):
+    # The runtime_info shape of an instance record
+    return {"Status": i.state, "Host_name": i.name,
+            "Image Id": i.image_id, "Placement": i.placement,
+            "Key_Name": i.key_name, "Public IP": i.ip_address,
+            "Hardware id": i.id, "Private IP": i.private_ip_address}
 
 
 def _fail_on_missing_required_parameters(obj, required_parameters, hint_where):
@@ -0,0 +1,346 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Host-local inventory shared by worker processes.
+
+When the EC2_INVENTORY_PATH environment variable names a file, instance
+and security group records are kept there in an SQLite database in WAL
+mode, so that all worker processes on the host share what any of them
+learned. The plugin's own lookups and mutations write through to it.
+
+A background thread of every process using the inventory competes for
+a leader lease. The leader refreshes the records older than ttl with
+filtered describes, and every full_sync_interval describes all instances
+managed by the plugin, so lookups made by operations only read.
+"""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+import aws_plugin_common
+
+INVENTORY_PATH_ENV = 'EC2_INVENTORY_PATH'
+
+# Seconds a shared record is trusted
+SHARED_INVENTORY_TTL = 30
+# Seconds between describes of all instances managed by the plugin
+FULL_SYNC_INTERVAL = 300
+# Seconds a leader holds the refresh lease
+LEADER_LEASE = 60
+# Instance ids per refresh describe
+REFRESH_BATCH = aws_plugin_common.MAX_FILTER_VALUES
+
+META_DATA_TAG = 'meta_data'
+NAME_TAG = 'Name'
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    scope TEXT NOT NULL,
+    id TEXT NOT NULL,
+    state TEXT,
+    node_id TEXT,
+    name TEXT,
+    record TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (scope, id));
+CREATE INDEX IF NOT EXISTS instances_node_id ON instances (scope, node_id);
+CREATE INDEX IF NOT EXISTS instances_name ON instances (scope, name);
+CREATE TABLE IF NOT EXISTS security_groups (
+    scope TEXT NOT NULL,
+    name TEXT NOT NULL,
+    id TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (scope, name));
+CREATE TABLE IF NOT EXISTS meta (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (scope, key));
+"""
+
+_RECORD_FIELDS = aws_plugin_common.InstanceRecord.__slots__
+
+
+def _dump_record(record):
+    return json.dumps(dict((f, getattr(record, f)) for f in _RECORD_FIELDS))
+
+
+def _load_record(data):
+    # Fields unknown to this version of the plugin are dropped
+    return aws_plugin_common.InstanceRecord(**dict(
+        (str(k), v) for k, v in json.loads(data).items()
+        if k in _RECORD_FIELDS))
+
+
+class SharedInventory(object):
+    """Instance and security group records of one region and account."""
+
+    def __init__(self, path, region, access_key_id,
+                 ttl=SHARED_INVENTORY_TTL):
+        self.path = path
+        self.region = region
+        self.access_key_id = access_key_id
+        self.scope = '{0}/{1}'.format(region, access_key_id)
+        self.ttl = ttl
+        self._local = threading.local()
+        # Holder of the leases taken by this process
+        self._holder_id = '{0}:{1}'.format(os.getpid(), id(self))
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+            self._local.db = db
+        return db
+
+    @property
+    def version(self):
+        """Incremented on every change, by any process."""
+        return int(self._get_meta(self._db(), 'version') or 0)
+
+    # Instances
+
+    def get_instance(self, instance_id):
+        return self._select_instance('id', instance_id)
+
+    def find_instance(self, tag, value):
+        column = {META_DATA_TAG: 'node_id', NAME_TAG: 'name'}.get(tag)
+        if column is None:
+            return None
+        return self._select_instance(column, value)
+
+    def _select_instance(self, column, value):
+        row = self._db().execute(
+            "SELECT record FROM instances WHERE scope = ? AND {0} = ? AND "
+            "updated >= ? ORDER BY updated DESC LIMIT 1".format(column),
+            (self.scope, value, time.time() - self.ttl)).fetchone()
+        return _load_record(row[0]) if row else None
+
+    def put_instances(self, records):
+        if not records:
+            return
+        now = time.time()
+        with self._write() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO instances "
+                "(scope, id, state, node_id, name, record, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(self.scope, r.id, r.state, r.node_id, r.name,
+                  _dump_record(r), now)
+                 for r in records])
+
+    def invalidate_instances(self, instance_ids):
+        if not instance_ids:
+            return
+        with self._write() as db:
+            db.executemany(
+                "UPDATE instances SET updated = 0 WHERE scope = ? AND id = ?",
+                [(self.scope, i) for i in instance_ids])
+
+    # Security groups
+
+    def get_security_group(self, name):
+        """
+        Returns (known, group id), group id is None for groups known not
+        to exist.
+        """
+        row = self._db().execute(
+            "SELECT id FROM security_groups WHERE scope = ? AND name = ? "
+            "AND updated >= ?",
+            (self.scope, name, time.time() - self.ttl)).fetchone()
+        return (True, row[0]) if row else (False, None)
+
+    def put_security_group(self, name, group_id):
+        with self._write() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO security_groups "
+                "(scope, name, id, updated) VALUES (?, ?, ?, ?)",
+                (self.scope, name, group_id, time.time()))
+
+    def invalidate_security_group(self, name):
+        with self._write() as db:
+            db.execute(
+                "DELETE FROM security_groups WHERE scope = ? AND name = ?",
+                (self.scope, name))
+
+    # Leases and values shared by the processes of the host
+
+    def acquire_lease(self, name, duration):
+        """
+        Takes the lease name for duration seconds unless another process
+        holds it. Returns True if this process holds it.
+        """
+        now = time.time()
+        with self._write() as db:
+            lease = self._get_meta(db, 'lease:' + name)
+            if lease:
+                holder, expires = lease.rsplit(' ', 1)
+                if holder != self._holder_id and float(expires) > now:
+                    return False
+            self._set_meta(db, 'lease:' + name, '{0} {1!r}'.format(
+                self._holder_id, now + duration))
+            return True
+
+    def release_lease(self, name):
+        """Releases the lease name if this process holds it."""
+        with self._write() as db:
+            lease = self._get_meta(db, 'lease:' + name)
+            if lease and lease.rsplit(' ', 1)[0] == self._holder_id:
+                db.execute("DELETE FROM meta WHERE scope = ? AND key = ?",
+                           (self.scope, 'lease:' + name))
+
+    def get_value(self, name):
+        return self._get_meta(self._db(), 'value:' + name)
+
+    def set_value(self, name, value):
+        """Sets the value name, None deletes it."""
+        with self._write() as db:
+            if value is None:
+                db.execute("DELETE FROM meta WHERE scope = ? AND key = ?",
+                           (self.scope, 'value:' + name))
+            else:
+                self._set_meta(db, 'value:' + name, value)
+
+    # Refresh
+
+    def start_refresh(self):
+        """Starts the background refresh thread unless it is running."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name='ec2-inventory-refresh')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop_refresh(self):
+        """Stops the background refresh thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stop.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.ttl / 2.0):
+            known, config = aws_plugin_common.client_config(
+                self.region, self.access_key_id)
+            if not known:
+                continue
+            acquirer = aws_plugin_common.EC2Client()
+            try:
+                client = acquirer.get(config=config)
+            except Exception:
+                logger.exception("Failed connecting to EC2")
+                continue
+            try:
+                self.maybe_refresh(aws_plugin_common.scheduled(client))
+            except Exception:
+                logger.exception("Failed refreshing the shared inventory")
+            finally:
+                acquirer.release(client)
+
+    def maybe_refresh(self, ec2_client):
+        """Refreshes stale records if this process holds the lease."""
+        now = time.time()
+        refreshed = float(self._get_meta(self._db(), 'refreshed') or 0)
+        if now - refreshed < self.ttl / 2.0 or \
+                not self.acquire_lease('leader', LEADER_LEASE):
+            return False
+        full_sync = float(self._get_meta(self._db(), 'full_sync') or 0)
+        if now - full_sync >= FULL_SYNC_INTERVAL:
+            records = list(aws_plugin_common.iter_instances(
+                ec2_client, filters={'tag-key': META_DATA_TAG}))
+            self.put_instances(records)
+            with self._write() as db:
+                self._set_meta(db, 'full_sync', now)
+        else:
+            self._refresh_stale(ec2_client, now)
+        with self._write() as db:
+            self._set_meta(db, 'refreshed', now)
+        return True
+
+    def _refresh_stale(self, ec2_client, now):
+        stale = [row[0] for row in self._db().execute(
+            "SELECT id FROM instances WHERE scope = ? AND updated < ? AND "
+            "state != 'terminated'", (self.scope, now - self.ttl / 2.0))]
+        for n in range(0, len(stale), REFRESH_BATCH):
+            ids = stale[n:n + REFRESH_BATCH]
+            records = list(aws_plugin_common.iter_instances(
+                ec2_client, filters={'instance-id': ids}))
+            self.put_instances(records)
+            gone = set(ids) - set(r.id for r in records)
+            if gone:
+                with self._write() as db:
+                    db.executemany(
+                        "DELETE FROM instances WHERE scope = ? AND id = ?",
+                        [(self.scope, i) for i in gone])
+
+    # Helpers
+
+    def _write(self):
+        return _Transaction(self)
+
+    def _get_meta(self, db, key):
+        row = db.execute("SELECT value FROM meta WHERE scope = ? AND key = ?",
+                         (self.scope, key)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, db, key, value):
+        db.execute("INSERT OR REPLACE INTO meta (scope, key, value) "
+                   "VALUES (?, ?, ?)", (self.scope, key, str(value)))
+
+
+class _Transaction(object):
+    # Write transaction bumping the inventory version
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+
+    def __enter__(self):
+        self.db = self.inventory._db()
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.db.execute('ROLLBACK')
+            return
+        version = int(self.inventory._get_meta(self.db, 'version') or 0)
+        self.inventory._set_meta(self.db, 'version', version + 1)
+        self.db.execute('COMMIT')
+
+
+def open_for(region, access_key_id):
+    """Returns the shared inventory, None when it is not configured."""
+    path = os.getenv(INVENTORY_PATH_ENV)
+    if not path:
+        return None
+    return SharedInventory(path, region, access_key_id)
@@ -0,0 +1,165 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import time
+import threading
+
+import aws_plugin_common
+
+# Buffered resources that trigger an immediate flush
+TAGS_MAX_BATCH = 50
+# Seconds a tag write may wait for writes from other operations
+TAGS_MAX_DELAY = 0.05
+# Max resource ids passed to a single create_tags call
+TAGS_RESOURCES_PER_CALL = 200
+# Attempts, and seconds before the second one, at tagging instances just
+# launched, EC2 may not know them yet
+NEW_INSTANCE_TAG_ATTEMPTS = 6
+NEW_INSTANCE_TAG_DELAY = 0.5
+
+NOT_FOUND_CODE = 'InvalidInstanceID.NotFound'
+
+
+class _TagRequest(object):
+
+    def __init__(self, resource_id):
+        self.resource_id = resource_id
+        self.tags = {}
+        self.error = None
+        self.error_code = None
+        self.done = threading.Event()
+
+
+class TagWriter(object):
+    """
+    Coalesces tag writes.
+
+    All tags for a resource are merged into one request. Requests from
+    concurrent operations are buffered until max_batch resources are
+    pending or max_delay passed, then resources with identical tags are
+    tagged together, since create_tags applies the same tags to all the
+    resources it is given.
+    """
+
+    def __init__(self, max_batch=TAGS_MAX_BATCH, max_delay=TAGS_MAX_DELAY):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        # resource id -> _TagRequest not sent yet
+        self._pending = {}
+
+    def create_tags(self, ec2_client, tags_by_resource):
+        """
+        Tags resources, tags_by_resource maps a resource id to its tags.
+
+        Returns resource id -> error message for resources that could not
+        be tagged.
+        """
+        return dict((r.resource_id, r.error)
+                    for r in self._write(ec2_client, tags_by_resource)
+                    if r.error)
+
+    def _write(self, ec2_client, tags_by_resource):
+        # Returns the _TagRequests of tags_by_resource once sent
+        requests = []
+        with self._lock:
+            for resource_id, tags in tags_by_resource.items():
+                request = self._pending.get(resource_id)
+                if request is None:
+                    request = self._pending[resource_id] = \
+                        _TagRequest(resource_id)
+                request.tags.update(tags)
+                requests.append(request)
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self.flush(ec2_client)
+        deadline = time.time() + self.max_delay
+        for request in requests:
+            if not request.done.wait(max(0, deadline - time.time())):
+                self.flush(ec2_client)
+                request.done.wait()
+        return requests
+
+    def flush(self, ec2_client):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        groups = {}
+        for request in pending.values():
+            key = tuple(sorted(request.tags.items()))
+            groups.setdefault(key, []).append(request)
+        try:
+            for key, requests in groups.items():
+                for n in range(0, len(requests), TAGS_RESOURCES_PER_CALL):
+                    self._send(ec2_client, dict(key),
+                               requests[n:n + TAGS_RESOURCES_PER_CALL])
+        finally:
+            for request in pending.values():
+                request.done.set()
+
+    def _send(self, ec2_client, tags, requests):
+        try:
+            ec2_client.create_tags([r.resource_id for r in requests], tags)
+            return
+        except Exception as e:
+            if len(requests) == 1 or \
+                    not aws_plugin_common.is_resource_error(e):
+                for request in requests:
+                    _fail(request, e)
+                return
+        # One bad resource fails the whole call, isolate it
+        for request in requests:
+            try:
+                ec2_client.create_tags([request.resource_id], tags)
+            except Exception as e:
+                _fail(request, e)
+
+
+def _fail(request, e):
+    request.error = str(e)
+    request.error_code = aws_plugin_common.error_code(e)
+
+
+_writers = aws_plugin_common.PerClient(TagWriter)
+
+
+def for_client(ec2_client):
+    """Returns the tag writer for the region and account of ec2_client."""
+    return _writers.get(ec2_client)
+
+
+def tag_new_instances(ec2_client, tags_by_instance):
+    """
+    Tags instances just launched, like TagWriter.create_tags, retrying
+    with backoff the instances EC2 does not know yet.
+    """
+    writer = for_client(ec2_client)
+    delay = NEW_INSTANCE_TAG_DELAY
+    failures = {}
+    for attempt in range(NEW_INSTANCE_TAG_ATTEMPTS):
+        if attempt:
+            time.sleep(delay)
+            delay *= 2
+        retry = {}
+        for r in writer._write(ec2_client, tags_by_instance):
+            if r.error_code == NOT_FOUND_CODE:
+                retry[r.resource_id] = tags_by_instance[r.resource_id]
+            if r.error:
+                failures[r.resource_id] = r.error
+            else:
+                failures.pop(r.resource_id, None)
+        if not retry:
+            break
+        tags_by_instance = retry
+    return failures
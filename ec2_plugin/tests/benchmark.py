@@ -0,0 +1,392 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Offline benchmarks of the ec2_plugin.server operations.
+
+Operations run unmodified against the in-process fake EC2 backend for
+growing account sizes, reporting wall time, API calls, instances
+returned by describe calls and peak memory per operation:
+
+    python -m ec2_plugin.tests.benchmark --sizes 10 100 1000 10000
+
+--imports reports the time and memory taken by importing the plugin in
+a fresh interpreter instead.
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import signal
+import select
+import argparse
+import tempfile
+import unittest
+import subprocess
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, memory is measured by the peak RSS of forked children
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from cloudify.mocks import MockCloudifyContext
+
+import aws_plugin_common as common
+import ec2_plugin.server as cfy_srv
+
+from ec2_plugin import images
+from ec2_plugin import inventory
+from ec2_plugin import launch_specs
+from ec2_plugin import security_groups
+from ec2_plugin import shared_inventory
+from ec2_plugin import tagging
+from ec2_plugin import tracker
+from ec2_plugin import waiter
+from ec2_plugin import warm_pool
+from ec2_plugin.tests.fake_ec2 import FakeEC2Backend
+
+SIZES = (10, 100, 1000, 10000)
+
+# Seconds a forked child has to measure the memory of an operation
+MEMORY_PROBE_TIMEOUT = 60
+
+# Modules importing the plugin must not load, they are loaded with the
+# first EC2 client or only by tests
+LAZY_MODULES = ('boto', 'boto.ec2', 'unittest', 'aws_plugin_common.testing')
+# Loaded before measuring an import, every plugin's worker loads them
+IMPORT_PRELOAD = ('cloudify.decorators', )
+# Bounds of importing the plugin, loading boto alone takes about 140ms
+# and 7.5MiB on Python 2.7. Import times are inflated by tracemalloc.
+IMPORT_TIME_LIMIT = 0.5
+IMPORT_MEMORY_LIMIT = 5 * 1024 * 1024
+
+IMPORT_PROBE = """
+import sys, json, time
+try:
+    import tracemalloc
+    tracemalloc.start()
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def max_rss():
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+{1}
+rss = max_rss()
+started = time.time()
+import {0}
+elapsed = time.time() - started
+if tracemalloc:
+    peak = tracemalloc.get_traced_memory()[1]
+else:
+    # Python 2, the growth of the peak RSS of the fresh interpreter
+    peak = max_rss() - rss
+print(json.dumps({{'time': elapsed, 'peak_memory': peak,
+                  'modules': sorted(sys.modules)}}))
+"""
+
+SERVER = {
+    'image_id': 'ami-00000001',
+    'instance_type': 't1.micro',
+    'security_groups': 'default',
+    'placement': 'us-east-1c',
+    'key_name': 'test',
+}
+
+
+def reset_caches():
+    common.client_pool.clear()
+    inventory.clear()
+    launch_specs._caches.clear()
+    images._caches.clear()
+    security_groups._caches.clear()
+    tagging._writers.clear()
+    tracker.clear()
+    waiter._waiters.clear()
+    warm_pool._pools.clear()
+
+
+class FakeEC2Environment(object):
+    """
+    Points EC2Client at a fake backend for the duration of a with. With
+    shared_inventory, worker processes share a fresh inventory file.
+    """
+
+    def __init__(self, backend, shared_inventory=False):
+        self.backend = backend
+        self.shared_inventory = shared_inventory
+        self.inventory_path = None
+
+    def __enter__(self):
+        fd, self.config_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'Amazon Credentials': {
+                'aws_access_key_id': 'fake-access-key',
+                'aws_secret_access_key': 'fake-secret-key',
+                'region': self.backend.region.name}}, f)
+        self.saved = (os.environ.get('EC2_CONFIG_PATH'),
+                      os.environ.pop(shared_inventory.INVENTORY_PATH_ENV,
+                                     None),
+                      common.EC2Client.connect, waiter.WAIT_INITIAL_DELAY,
+                      warm_pool.CLAIM_SETTLE_DELAY)
+        os.environ['EC2_CONFIG_PATH'] = self.config_path
+        if self.shared_inventory:
+            fd, self.inventory_path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            os.environ[shared_inventory.INVENTORY_PATH_ENV] = \
+                self.inventory_path
+        backend = self.backend
+        common.EC2Client.connect = lambda self, cfg: backend.connect()
+        waiter.WAIT_INITIAL_DELAY = 0.01
+        warm_pool.CLAIM_SETTLE_DELAY = 0
+        self.claims_path = warm_pool.claims_path(backend.region.name,
+                                                 'fake-access-key')
+        self._remove_claims()
+        reset_caches()
+        return self.backend
+
+    def __exit__(self, *exc_info):
+        config_path, inventory_path, connect, initial_delay, settle_delay = \
+            self.saved
+        if config_path is None:
+            del os.environ['EC2_CONFIG_PATH']
+        else:
+            os.environ['EC2_CONFIG_PATH'] = config_path
+        common.EC2Client.connect = connect
+        waiter.WAIT_INITIAL_DELAY = initial_delay
+        warm_pool.CLAIM_SETTLE_DELAY = settle_delay
+        self._remove_claims()
+        reset_caches()
+        os.environ.pop(shared_inventory.INVENTORY_PATH_ENV, None)
+        if inventory_path is not None:
+            os.environ[shared_inventory.INVENTORY_PATH_ENV] = inventory_path
+        os.remove(self.config_path)
+        if self.inventory_path:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.inventory_path + suffix):
+                    os.remove(self.inventory_path + suffix)
+
+    def _remove_claims(self):
+        if os.path.exists(self.claims_path):
+            os.remove(self.claims_path)
+
+
+def _node_ctx(node_id, instance_id=None, **properties):
+    runtime_properties = {}
+    if instance_id:
+        runtime_properties[cfy_srv.AWS_SERVER_ID_PROPERTY] = instance_id
+    return MockCloudifyContext(node_id=node_id, properties=properties,
+                               runtime_properties=runtime_properties)
+
+
+def _scenarios(backend):
+    """Yields (name, callable) pairs, each running one operation."""
+    def existing(state, node_id):
+        i = backend.add_instance(state=state, tags={'Name': node_id,
+                                                    'meta_data': node_id})
+        return i.id
+
+    yield 'start (launch)', lambda: cfy_srv.start(
+        ctx=_node_ctx('bench_new', server=dict(SERVER)))
+    yield 'start (existing)', lambda: cfy_srv.start(
+        ctx=_node_ctx('bench_start', existing('stopped', 'bench_start')))
+    yield 'stop', lambda: cfy_srv.stop(
+        ctx=_node_ctx('bench_stop', existing('running', 'bench_stop')))
+    yield 'delete', lambda: cfy_srv.delete(
+        ctx=_node_ctx('bench_delete', existing('running', 'bench_delete')))
+    yield 'get_state', lambda: cfy_srv.get_state(
+        ctx=_node_ctx('bench_state', existing('running', 'bench_state')))
+    existing('running', 'bench_state_by_tag')
+    yield 'get_state (by tag)', lambda: cfy_srv.get_state(
+        ctx=_node_ctx('bench_state_by_tag'))
+
+    sg = {'crt_sg_name': 'bench-sg', 'description': 'benchmark',
+          'conf_sg_name': 'bench-sg', 'del_sg_name': 'bench-sg',
+          'rules': [{'ip_protocol': 'tcp', 'cidr_ip': '0.0.0.0/0',
+                     'from_port': p, 'to_port': p} for p in (22, 80, 443)]}
+    yield 'create_security_group', lambda: cfy_srv.create_security_group(
+        ctx=_node_ctx('bench_sg', security_group=dict(sg)))
+    yield 'configure_security_group', \
+        lambda: cfy_srv.configure_security_group(
+            ctx=_node_ctx('bench_sg', security_group=dict(sg)))
+    yield 'delete_security_group', lambda: cfy_srv.delete_security_group(
+        ctx=_node_ctx('bench_sg', security_group=dict(sg)))
+
+
+def max_rss():
+    """Returns the peak resident set size of the process in bytes."""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, OS X bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def measure_memory(f):
+    """
+    Returns the peak memory taken by f in bytes, for interpreters without
+    tracemalloc. f runs in a forked child, whose peak RSS starts from its
+    RSS at the fork, so the parent's state is left untouched.
+    """
+    if resource is None or not hasattr(os, 'fork'):
+        return 0
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            # What the child learns must not reach the parent's inventory
+            os.environ.pop(shared_inventory.INVENTORY_PATH_ENV, None)
+            before = max_rss()
+            f()
+            os.write(w, str(max_rss() - before).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(w)
+    try:
+        if select.select([r], [], [], MEMORY_PROBE_TIMEOUT)[0]:
+            return int(os.read(r, 64) or 0)
+        os.kill(pid, signal.SIGKILL)
+        return 0
+    finally:
+        os.close(r)
+        os.waitpid(pid, 0)
+
+
+def measure(backend, f):
+    """Runs f with cold caches, returns its measurements as a dict."""
+    peak = 0
+    if not tracemalloc:
+        reset_caches()
+        gc.collect()
+        peak = measure_memory(f)
+    reset_caches()
+    backend.reset_counters()
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    started = time.time()
+    f()
+    elapsed = time.time() - started
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'time': elapsed, 'calls': backend.total_calls,
+            'described': backend.described, 'peak_memory': peak}
+
+
+def run(sizes=SIZES, latency=0, throttle_rate=0, shared_inventory=False):
+    """Returns {(fleet size, operation name): measurements}."""
+    results = {}
+    for size in sizes:
+        backend = FakeEC2Backend(fleet_size=size, latency=latency,
+                                 throttle_rate=throttle_rate)
+        with FakeEC2Environment(backend, shared_inventory):
+            for name, f in _scenarios(backend):
+                results[(size, name)] = measure(backend, f)
+    return results
+
+
+def measure_import(module='ec2_plugin.server', preload=IMPORT_PRELOAD):
+    """
+    Imports module in a fresh interpreter, returns its measurements. The
+    preload modules are imported first and not measured.
+    """
+    out = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_PROBE.format(
+            module, '\n'.join('import ' + m for m in preload))])
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def report(results):
+    lines = ["{0:>8} {1:<26} {2:>10} {3:>6} {4:>10} {5:>10}".format(
+        'fleet', 'operation', 'time(ms)', 'calls', 'described', 'peak(KiB)')]
+    for (size, name), r in sorted(results.items()):
+        lines.append("{0:>8} {1:<26} {2:>10.2f} {3:>6} {4:>10} {5:>10}"
+                     .format(size, name, r['time'] * 1000, r['calls'],
+                             r['described'], r['peak_memory'] // 1024))
+    return '\n'.join(lines)
+
+
+class ScalingTest(unittest.TestCase):
+    """Fails when an operation's cost grows with the account size."""
+
+    def test_operations_do_not_scan_the_account(self):
+        self.assertSameCost(run(sizes=(10, 1000)))
+
+    def test_shared_inventory_does_not_scan_the_account(self):
+        self.assertSameCost(run(sizes=(10, 1000), shared_inventory=True))
+
+    def assertSameCost(self, results):
+        for (size, name), r in results.items():
+            if size != 1000:
+                continue
+            small = results[(10, name)]
+            self.assertEqual(small['calls'], r['calls'], name)
+            self.assertEqual(small['described'], r['described'], name)
+
+
+class ImportTest(unittest.TestCase):
+    """Fails when importing the plugin loads what only clients need."""
+
+    def test_import_is_lazy(self):
+        loaded = set(measure_import()['modules'])
+        self.assertEqual([], [m for m in LAZY_MODULES if m in loaded])
+
+    def test_import_is_cheap(self):
+        r = measure_import()
+        self.assertLess(r['time'], IMPORT_TIME_LIMIT)
+        if r['peak_memory']:
+            self.assertLess(r['peak_memory'], IMPORT_MEMORY_LIMIT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every API call')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='fraction of API calls to throttle')
+    parser.add_argument('--shared-inventory', action='store_true',
+                        help='share an inventory file between operations')
+    parser.add_argument('--imports', action='store_true',
+                        help='measure importing the plugin instead')
+    args = parser.parse_args()
+    if args.imports:
+        r = measure_import()
+        print("import ec2_plugin.server: {0:.2f}ms, peak {1}KiB, {2} modules"
+              .format(r['time'] * 1000, r['peak_memory'] // 1024,
+                      len(r['modules'])))
+        return
+    print(report(run(args.sizes, args.latency, args.throttle_rate,
+                     args.shared_inventory)))
+
+
+if __name__ == '__main__':
+    main()
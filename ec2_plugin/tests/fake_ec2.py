@@ -0,0 +1,457 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+In-process fake of the boto EC2 connection.
+
+Implements the subset of boto.ec2.connection.EC2Connection used by the
+plugin on top of an in-memory account, with configurable fleet size,
+per-call latency and throttling. Used by the offline benchmarks.
+"""
+
+import time
+import random
+import itertools
+import threading
+
+from boto.exception import EC2ResponseError
+
+THROTTLE_BODY = (
+    '<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+    '<Message>Request limit exceeded.</Message></Error></Errors>'
+    '<RequestID>fake</RequestID></Response>')
+
+# Max values of a single filter, as enforced by EC2
+MAX_FILTER_VALUES = 200
+
+NOT_FOUND_BODY = (
+    '<Response><Errors><Error><Code>{0}</Code>'
+    '<Message>{1}</Message></Error></Errors>'
+    '<RequestID>fake</RequestID></Response>')
+
+
+class FakeRegion(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeInstance(object):
+
+    def __init__(self, id, image_id, instance_type, placement, key_name,
+                 groups, state='running'):
+        self.id = id
+        self.image_id = image_id
+        self.instance_type = instance_type
+        self.placement = placement
+        self.key_name = key_name
+        self.groups = groups
+        self.state = state
+        self.tags = {}
+        self.ip_address = None
+        self.private_ip_address = '10.0.{0}.{1}'.format(
+            random.randint(0, 255), random.randint(1, 254))
+
+    def update(self):
+        return self.state
+
+
+class FakeReservation(object):
+
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class FakeImage(object):
+
+    def __init__(self, id, name, creation_date='2014-01-01T00:00:00.000Z'):
+        self.id = id
+        self.name = name
+        self.creationDate = creation_date
+
+
+class FakeGrant(object):
+
+    def __init__(self, cidr_ip):
+        self.cidr_ip = cidr_ip
+        self.group_id = None
+
+
+class FakeRule(object):
+
+    def __init__(self, ip_protocol, from_port, to_port):
+        self.ip_protocol = ip_protocol
+        self.from_port = from_port
+        self.to_port = to_port
+        self.grants = []
+
+
+class FakeSecurityGroup(object):
+
+    def __init__(self, id, name, description):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.rules = []
+
+
+class ResultList(list):
+    next_token = None
+
+
+class FakeEC2Backend(object):
+    """
+    One fake EC2 account and region.
+
+    latency seconds, plus up to jitter seconds, are slept on every call
+    and a throttle_rate fraction of calls fail with RequestLimitExceeded.
+    Instances launched become running after boot_time seconds, stopped
+    stop_time seconds after being stopped, and can be tagged after
+    tag_lag seconds, like EC2 they are unknown to create_tags until then.
+    """
+
+    def __init__(self, fleet_size=0, latency=0, throttle_rate=0,
+                 boot_time=0, stop_time=0, tag_lag=0,
+                 region='us-east-1'):
+        self.latency = latency
+        self.jitter = 0
+        self.throttle_rate = throttle_rate
+        self.boot_time = boot_time
+        self.stop_time = stop_time
+        self.tag_lag = tag_lag
+        self.region = FakeRegion(region)
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self.instances = {}
+        self.security_groups = {}
+        self.images = {}
+        # API call name -> count
+        self.calls = {}
+        # Instances returned by describe calls
+        self.described = 0
+        self.add_image('ami-00000001', 'cosmo-test-image')
+        self.add_security_group('default', 'default group')
+        for n in range(fleet_size):
+            # Fleet instances look like nodes of another deployment
+            i = self.add_instance(tags={'Name': 'fleet-{0}'.format(n),
+                                        'meta_data': 'fleet-{0}'.format(n)})
+            i.ip_address = '54.0.{0}.{1}'.format(n // 250, n % 250 + 1)
+
+    def connect(self, **kw):
+        return FakeEC2Connection(self)
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = {}
+            self.described = 0
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def new_id(self, prefix):
+        return '{0}-{1:08x}'.format(prefix, next(self._ids))
+
+    def add_image(self, id, name):
+        self.images[id] = FakeImage(id, name)
+        return self.images[id]
+
+    def add_security_group(self, name, description):
+        sg = FakeSecurityGroup(self.new_id('sg'), name, description)
+        self.security_groups[sg.id] = sg
+        return sg
+
+    def add_instance(self, image_id='ami-00000001', instance_type='t1.micro',
+                     placement='us-east-1c', key_name='test',
+                     groups=('default', ), state='running', tags=None):
+        i = FakeInstance(self.new_id('i'), image_id, instance_type,
+                         placement, key_name, list(groups), state)
+        i.tags.update(tags or {})
+        i.created_at = i.launched_at = time.time()
+        self.instances[i.id] = i
+        return i
+
+    def call(self, name):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            throttled = self.throttle_rate and \
+                random.random() < self.throttle_rate
+        if throttled:
+            raise EC2ResponseError(503, 'Service Unavailable', THROTTLE_BODY)
+
+    def tick(self):
+        now = time.time()
+        for i in self.instances.values():
+            if i.state == 'pending' and now - i.launched_at >= self.boot_time:
+                i.state = 'running'
+                i.ip_address = '54.1.{0}.{1}'.format(random.randint(0, 255),
+                                                     random.randint(1, 254))
+            elif i.state == 'stopping' and \
+                    now - i.launched_at >= self.stop_time:
+                i.state = 'stopped'
+            elif i.state == 'shutting-down':
+                i.state = 'terminated'
+
+
+def _as_list(value):
+    return value if isinstance(value, (list, tuple, set)) else [value]
+
+
+def _not_found(code, ids):
+    return EC2ResponseError(400, 'Bad Request', NOT_FOUND_BODY.format(
+        code, "The ids '{0}' do not exist".format(', '.join(ids))))
+
+
+def _check_filters(filters):
+    for name, values in (filters or {}).items():
+        if len(_as_list(values)) > MAX_FILTER_VALUES:
+            raise EC2ResponseError(400, 'Bad Request', NOT_FOUND_BODY.format(
+                'FilterLimitExceeded',
+                "The filter '{0}' has too many values".format(name)))
+
+
+def _instance_matches(i, filters):
+    for name, values in (filters or {}).items():
+        values = _as_list(values)
+        if name == 'instance-id':
+            value = i.id
+        elif name == 'instance-state-name':
+            value = i.state
+        elif name.startswith('tag:'):
+            value = i.tags.get(name[4:])
+        elif name == 'tag-key':
+            if not set(values) & set(i.tags):
+                return False
+            continue
+        else:
+            raise NotImplementedError("Filter {0}".format(name))
+        if value not in values:
+            return False
+    return True
+
+
+class FakeEC2Connection(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.region = backend.region
+        self.aws_access_key_id = 'fake-access-key'
+
+    def close(self):
+        pass
+
+    def get_all_regions(self, *args, **kw):
+        self.backend.call('get_all_regions')
+        return ResultList([self.region])
+
+    def get_all_reservations(self, instance_ids=None, filters=None,
+                             dry_run=False, max_results=None,
+                             next_token=None):
+        self.backend.call('get_all_reservations')
+        return self._describe(instance_ids, filters, max_results, next_token)
+
+    def get_all_instances(self, instance_ids=None, filters=None,
+                          dry_run=False, max_results=None):
+        self.backend.call('get_all_instances')
+        return self._describe(instance_ids, filters, max_results, None)
+
+    def _describe(self, instance_ids, filters, max_results, next_token):
+        b = self.backend
+        _check_filters(filters)
+        with b._lock:
+            b.tick()
+            if instance_ids:
+                instance_ids = _as_list(instance_ids)
+                missing = [i for i in instance_ids if i not in b.instances]
+                if missing:
+                    raise _not_found('InvalidInstanceID.NotFound', missing)
+                candidates = [b.instances[i] for i in instance_ids]
+            else:
+                candidates = sorted(b.instances.values(), key=lambda i: i.id)
+            matches = [i for i in candidates if _instance_matches(i, filters)]
+            start = int(next_token or 0)
+            end = start + max_results if max_results else len(matches)
+            ret = ResultList(FakeReservation([i]) for i in matches[start:end])
+            if end < len(matches):
+                ret.next_token = str(end)
+            b.described += len(ret)
+        return ret
+
+    def get_all_instance_status(self, instance_ids=None, max_results=None,
+                                next_token=None, filters=None,
+                                dry_run=False, include_all_instances=False):
+        self.backend.call('get_all_instance_status')
+        reservations = self._describe(instance_ids, filters, max_results,
+                                      next_token)
+        ret = ResultList()
+        for r in reservations:
+            for i in r.instances:
+                status = FakeInstanceStatus(i)
+                if include_all_instances or i.state == 'running':
+                    ret.append(status)
+        ret.next_token = reservations.next_token
+        return ret
+
+    def run_instances(self, image_id, min_count=1, max_count=1,
+                      key_name=None, security_groups=None,
+                      user_data=None, addressing_type=None,
+                      instance_type='m1.small', placement=None,
+                      kernel_id=None, ramdisk_id=None,
+                      monitoring_enabled=False, subnet_id=None,
+                      block_device_map=None,
+                      disable_api_termination=False,
+                      instance_initiated_shutdown_behavior=None,
+                      private_ip_address=None,
+                      placement_group=None, client_token=None,
+                      security_group_ids=None,
+                      additional_info=None, instance_profile_name=None,
+                      instance_profile_arn=None, tenancy=None,
+                      ebs_optimized=False, network_interfaces=None,
+                      dry_run=False):
+        b = self.backend
+        b.call('run_instances')
+        with b._lock:
+            if client_token:
+                launched = [i for i in b.instances.values()
+                            if getattr(i, 'client_token', None) ==
+                            client_token]
+                if launched:
+                    return FakeReservation(launched)
+            if image_id not in b.images:
+                raise _not_found('InvalidAMIID.NotFound', [image_id])
+            instances = []
+            for _ in range(max_count):
+                i = b.add_instance(image_id, instance_type, placement,
+                                   key_name, security_groups or ['default'],
+                                   state='pending')
+                i.client_token = client_token
+                instances.append(i)
+        return FakeReservation(instances)
+
+    def _change_state(self, name, instance_ids, state):
+        b = self.backend
+        b.call(name)
+        instance_ids = _as_list(instance_ids)
+        with b._lock:
+            missing = [i for i in instance_ids if i not in b.instances]
+            if missing:
+                raise _not_found('InvalidInstanceID.NotFound', missing)
+            for instance_id in instance_ids:
+                i = b.instances[instance_id]
+                i.state = state
+                i.launched_at = time.time()
+        return [b.instances[i] for i in instance_ids]
+
+    def start_instances(self, instance_ids=None, dry_run=False):
+        return self._change_state('start_instances', instance_ids, 'pending')
+
+    def stop_instances(self, instance_ids=None, force=False, dry_run=False):
+        return self._change_state('stop_instances', instance_ids, 'stopping')
+
+    def terminate_instances(self, instance_ids=None, dry_run=False):
+        return self._change_state('terminate_instances', instance_ids,
+                                  'shutting-down')
+
+    def create_tags(self, resource_ids, tags, dry_run=False):
+        b = self.backend
+        b.call('create_tags')
+        with b._lock:
+            missing = [r for r in resource_ids if r not in b.instances]
+            if missing:
+                raise _not_found('InvalidID', missing)
+            now = time.time()
+            unknown = [r for r in resource_ids
+                       if now - b.instances[r].created_at < b.tag_lag]
+            if unknown:
+                raise _not_found('InvalidInstanceID.NotFound', unknown)
+            for resource_id in resource_ids:
+                b.instances[resource_id].tags.update(tags)
+        return True
+
+    def get_all_images(self, image_ids=None, owners=None,
+                       executable_by=None, filters=None, dry_run=False):
+        b = self.backend
+        b.call('get_all_images')
+        if image_ids:
+            missing = [i for i in image_ids if i not in b.images]
+            if missing:
+                raise _not_found('InvalidAMIID.NotFound', missing)
+            return ResultList(b.images[i] for i in image_ids)
+        name = (filters or {}).get('name')
+        return ResultList(i for i in b.images.values()
+                          if name is None or i.name in _as_list(name))
+
+    def get_all_security_groups(self, groupnames=None, group_ids=None,
+                                filters=None, dry_run=False):
+        b = self.backend
+        b.call('get_all_security_groups')
+        _check_filters(filters)
+        filters = filters or {}
+        ret = ResultList()
+        for sg in b.security_groups.values():
+            if 'group-name' in filters and \
+                    sg.name not in _as_list(filters['group-name']):
+                continue
+            if 'group-id' in filters and \
+                    sg.id not in _as_list(filters['group-id']):
+                continue
+            ret.append(sg)
+        return ret
+
+    def create_security_group(self, name, description, vpc_id=None,
+                              dry_run=False):
+        b = self.backend
+        b.call('create_security_group')
+        with b._lock:
+            return b.add_security_group(name, description)
+
+    def delete_security_group(self, name=None, group_id=None,
+                              dry_run=False):
+        b = self.backend
+        b.call('delete_security_group')
+        with b._lock:
+            b.security_groups.pop(group_id, None)
+        return True
+
+    def get_status(self, action, params, path='/', parent=None, verb='GET'):
+        b = self.backend
+        b.call(action)
+        if action != 'AuthorizeSecurityGroupIngress':
+            raise NotImplementedError(action)
+        with b._lock:
+            sg = b.security_groups[params['GroupId']]
+            n = 1
+            while 'IpPermissions.{0}.IpProtocol'.format(n) in params:
+                prefix = 'IpPermissions.{0}.'.format(n)
+                rule = FakeRule(params[prefix + 'IpProtocol'],
+                                params[prefix + 'FromPort'],
+                                params[prefix + 'ToPort'])
+                m = 1
+                while prefix + 'IpRanges.{0}.CidrIp'.format(m) in params:
+                    rule.grants.append(FakeGrant(
+                        params[prefix + 'IpRanges.{0}.CidrIp'.format(m)]))
+                    m += 1
+                sg.rules.append(rule)
+                n += 1
+        return True
+
+
+class FakeInstanceStatus(object):
+
+    def __init__(self, instance):
+        self.id = instance.id
+        self.state_name = instance.state
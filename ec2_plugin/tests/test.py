@@ -21,6 +21,8 @@ from cloudify.mocks import MockCloudifyContext
 
 import aws_plugin_common as common
 
+from aws_plugin_common.testing import TestCase
+
 import ec2_plugin.server as cfy_srv
 
 tests_config = common.TestsConfig().get()
@@ -40,7 +42,7 @@ class MockReporter(object):
 # WIP - end
 
 
-class AWSEC2Test(common.TestCase):
+class AWSEC2Test(TestCase):
 
     def test_instance_create_and_delete(self):
 
@@ -51,8 +53,8 @@ class AWSEC2Test(common.TestCase):
         ctx = MockCloudifyContext(
             node_id='__cloudify_id_' + name,
             properties={
-                'instance': {
-                    'Name': name,
+                'server': {
+                    'name': name,
                     'image_id': tst_inst_cfg['image_id'],
                     'placement': tst_inst_cfg['placement'],
                     'instance_type': tst_inst_cfg['instance_type'],
@@ -74,7 +76,7 @@ class AWSEC2Test(common.TestCase):
 
         # Test: create
         #self.assertThereIsNoServer(name=name)
-        cfy_srv.launch_new_instance(ctx,ec2_client)
+        cfy_srv.start_new_server(ctx, ec2_client)
         #cfy_srv.get_server_by_context(ec2_client,ctx)
         #cfy_srv.create_security_group(ctx)
         #cfy_srv.delete_security_group(ctx)
@@ -0,0 +1,1188 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Tests of the plugin against the in-process fake EC2 backend."""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import aws_plugin_common as common
+import ec2_plugin.server as cfy_srv
+
+from aws_plugin_common import executor
+from aws_plugin_common import metrics
+from aws_plugin_common import scheduler
+
+from ec2_plugin import images
+from ec2_plugin import inventory
+from ec2_plugin import launch_specs
+from ec2_plugin import reconcile
+from ec2_plugin import shared_inventory
+from ec2_plugin import tagging
+from ec2_plugin import tracker
+from ec2_plugin import waiter
+from ec2_plugin import warm_pool
+from ec2_plugin.tests.benchmark import FakeEC2Environment
+from ec2_plugin.tests.benchmark import SERVER
+from ec2_plugin.tests.benchmark import _node_ctx
+from ec2_plugin.tests.fake_ec2 import EC2ResponseError
+from ec2_plugin.tests.fake_ec2 import FakeEC2Backend
+from ec2_plugin.tests.fake_ec2 import NOT_FOUND_BODY
+from ec2_plugin.tests.fake_ec2 import THROTTLE_BODY
+
+
+class FakeEC2TestCase(unittest.TestCase):
+
+    fleet_size = 0
+    shared_inventory = False
+
+    def setUp(self):
+        self.backend = FakeEC2Backend(fleet_size=self.fleet_size)
+        self.environment = FakeEC2Environment(self.backend,
+                                              self.shared_inventory)
+        self.environment.__enter__()
+        self.ec2_client = common.EC2Client().get()
+
+    def tearDown(self):
+        self.environment.__exit__(None, None, None)
+
+
+class ConfigCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, cfg):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            json.dump(cfg, f)
+        return path
+
+    def test_symlink_swap_is_picked_up(self):
+        cache = common._ConfigCache(check_interval=0)
+        link = os.path.join(self.directory, 'ec2_config.json')
+        old = self.write('old.json', {'key': 'old'})
+        os.symlink(old, link)
+        self.assertEqual({'key': 'old'}, cache.get(link))
+
+        # Rotation the way secret mounts do it
+        new = self.write('new.json', {'key': 'new'})
+        os.symlink(new, link + '.tmp')
+        os.rename(link + '.tmp', link)
+        os.remove(old)
+        self.assertEqual({'key': 'new'}, cache.get(link))
+
+
+class LaunchTest(FakeEC2TestCase):
+
+    def test_nodes_of_a_spec_share_calls(self):
+        self.backend.boot_time = 0.2
+        large = dict(SERVER, instance_type='m1.large')
+        ctxs = [_node_ctx('small{0}'.format(n), server=dict(SERVER))
+                for n in range(10)] + \
+            [_node_ctx('large{0}'.format(n), server=dict(large))
+             for n in range(10)]
+        writer = tagging.for_client(self.ec2_client)
+        flushes = []
+
+        def flush(ec2_client):
+            flushes.append(ec2_client)
+            tagging.TagWriter.flush(writer, ec2_client)
+        writer.flush = flush
+        self.backend.reset_counters()
+        cfy_srv.start_new_servers(ctxs, self.ec2_client)
+        self.assertEqual(2, self.backend.calls['run_instances'])
+        self.assertEqual(2, len(flushes))
+        # create_tags gives all its resources the same tags, one call per
+        # node since each node has its own Name
+        self.assertEqual(len(ctxs), self.backend.calls['create_tags'])
+        # One wait per spec, a few ticks each while instances boot
+        self.assertLess(self.backend.calls['get_all_reservations'], 20)
+
+        instance_ids = [ctx[cfy_srv.AWS_SERVER_ID_PROPERTY] for ctx in ctxs]
+        self.assertEqual(len(ctxs), len(set(instance_ids)))
+        for ctx, instance_id in zip(ctxs, instance_ids):
+            i = self.backend.instances[instance_id]
+            self.assertEqual(ctx.node_id, i.tags['meta_data'])
+            self.assertEqual(ctx.properties['server']['instance_type'],
+                             i.instance_type)
+            details, = ctx[cfy_srv.AWS_SERVER_DETAILS]
+            self.assertEqual(instance_id, details['Hardware id'])
+            self.assertEqual('running', details['Status'])
+
+    def test_relaunch_after_delete_servers(self):
+        ctx = _node_ctx('relaunched', server=dict(SERVER))
+        cfy_srv.start_new_servers([ctx], self.ec2_client)
+        first = ctx[cfy_srv.AWS_SERVER_ID_PROPERTY]
+        results = cfy_srv.delete_servers(self.ec2_client, [ctx])
+        self.assertIsNone(results['relaunched']['error'])
+
+        _, errors = reconcile.reconcile(self.ec2_client,
+                                        nodes=[(ctx, reconcile.RUNNING)])
+        self.assertEqual({}, errors)
+        second = ctx[cfy_srv.AWS_SERVER_ID_PROPERTY]
+        self.assertNotEqual(first, second)
+        self.assertEqual('running', self.backend.instances[second].state)
+
+    def test_launch_waits_until_instances_can_be_tagged(self):
+        self.backend.tag_lag = 0.3
+        delay = tagging.NEW_INSTANCE_TAG_DELAY
+        tagging.NEW_INSTANCE_TAG_DELAY = 0.05
+        ctx = _node_ctx('tagged_late', server=dict(SERVER))
+        try:
+            cfy_srv.start_new_servers([ctx], self.ec2_client)
+        finally:
+            tagging.NEW_INSTANCE_TAG_DELAY = delay
+        instance = self.backend.instances[ctx[cfy_srv.AWS_SERVER_ID_PROPERTY]]
+        self.assertEqual('tagged_late', instance.tags['meta_data'])
+        self.assertEqual(cfy_srv.RECORDED, ctx[cfy_srv.LAUNCH_PHASE_PROPERTY])
+        self.assertEqual(1, self.backend.calls['run_instances'])
+
+    def test_relaunch_after_external_termination(self):
+        ctx = _node_ctx('terminated_outside', server=dict(SERVER))
+        cfy_srv.start_new_servers([ctx], self.ec2_client)
+        first = ctx[cfy_srv.AWS_SERVER_ID_PROPERTY]
+        self.backend.instances[first].state = 'terminated'
+        cfy_srv._invalidate(self.ec2_client, [first])
+
+        cfy_srv.start(ctx=ctx)
+        second = ctx[cfy_srv.AWS_SERVER_ID_PROPERTY]
+        self.assertNotEqual(first, second)
+        self.assertEqual('running', self.backend.instances[second].state)
+
+
+class SharedInventoryTest(FakeEC2TestCase):
+
+    fleet_size = 50
+    shared_inventory = True
+
+    def test_refresh_runs_in_the_background(self):
+        store = shared_inventory.SharedInventory(
+            self.environment.inventory_path, self.backend.region.name,
+            self.ec2_client.aws_access_key_id, ttl=0.2)
+        self.backend.reset_counters()
+        store.start_refresh()
+        self.assertEqual(0, self.backend.total_calls)
+        try:
+            deadline = time.time() + 5
+            while True:
+                record = store.find_instance('meta_data', 'fleet-49')
+                if record is not None:
+                    break
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+        finally:
+            store.stop_refresh()
+        self.assertEqual('fleet-49',
+                         self.backend.instances[record.id].tags['Name'])
+
+
+class BatchTest(FakeEC2TestCase):
+
+    nodes = 250
+
+    def test_large_teardown(self):
+        ctxs = [_node_ctx('node{0}'.format(n),
+                          self.backend.add_instance().id)
+                for n in range(self.nodes)]
+        results = cfy_srv.delete_servers(self.ec2_client, ctxs)
+        self.assertEqual([], [r for r in results.values() if r['error']])
+        self.assertEqual(
+            set(['shutting-down']),
+            set(self.backend.instances[r['instance_id']].state
+                for r in results.values()))
+
+    def test_chunks_are_split_for_bad_instances_only(self):
+        calls = []
+
+        def call(error):
+            # Calls failing with error when given i-bad
+            def f(instance_ids):
+                calls.append(instance_ids)
+                if 'i-bad' in instance_ids:
+                    raise error
+            return f
+        instance_ids = ['i-{0}'.format(n) for n in range(150)] + ['i-bad']
+        failures = cfy_srv._call_in_chunks(
+            call(EC2ResponseError(503, 'Service Unavailable',
+                                  THROTTLE_BODY)), instance_ids)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(set(instance_ids[100:]), set(failures))
+
+        del calls[:]
+        failures = cfy_srv._call_in_chunks(
+            call(EC2ResponseError(400, 'Bad Request', NOT_FOUND_BODY.format(
+                'InvalidInstanceID.NotFound', 'i-bad'))), instance_ids)
+        self.assertEqual(['i-bad'], list(failures))
+        self.assertEqual(2 + len(instance_ids[100:]), len(calls))
+
+    def test_large_plan(self):
+        ctxs = []
+        for n in range(self.nodes):
+            node_id = 'node{0}'.format(n)
+            self.backend.add_instance(state='stopped', tags={
+                'Name': node_id, 'meta_data': node_id})
+            ctxs.append(_node_ctx(node_id, server={'name': node_id}))
+        plan = reconcile.plan(self.ec2_client,
+                              nodes=[(ctx, reconcile.RUNNING)
+                                     for ctx in ctxs])
+        self.assertEqual(self.nodes, len(plan.of_kind(reconcile.START)))
+
+    def test_waiting_for_many_instances(self):
+        instance_ids = [self.backend.add_instance(state='pending').id
+                        for _ in range(self.nodes)]
+        records = waiter.wait_for_state(self.ec2_client, instance_ids,
+                                        waiter.RUNNING, timeout=10)
+        self.assertEqual(self.nodes, len(records))
+
+
+class WarmPoolTest(FakeEC2TestCase):
+
+    shared_inventory = True
+    params = {'image_id': 'ami-00000001', 'instance_type': 't1.micro',
+              'placement': 'us-east-1c', 'key_name': 'test',
+              'security_groups': ['default']}
+
+    def pool(self):
+        # A pool as created by another worker process of the host
+        return warm_pool._new_pool(self.backend.region.name,
+                                   self.ec2_client.aws_access_key_id)
+
+    def add_members(self, count):
+        profile = warm_pool.profile_of(self.params)
+        return [self.backend.add_instance(
+            state='stopped', tags={warm_pool.WARM_POOL_TAG: profile}).id
+            for _ in range(count)]
+
+    def claim_concurrently(self, pools, count=1):
+        # Returns the ids claimed by each of pools
+        profile = warm_pool.profile_of(self.params)
+        claimed = [None] * len(pools)
+
+        def claim(n):
+            claimed[n] = pools[n].claim(self.ec2_client, profile, count)
+        threads = [threading.Thread(target=claim, args=(n, ))
+                   for n in range(len(pools))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return claimed
+
+    def assertClaimedOnce(self, claimed):
+        ids = sum(claimed, [])
+        self.assertEqual(len(set(ids)), len(ids), claimed)
+
+    def members(self):
+        profile = warm_pool.profile_of(self.params)
+        return [i for i in self.backend.instances.values()
+                if i.tags.get(warm_pool.WARM_POOL_TAG) == profile]
+
+    def test_one_top_up_per_host(self):
+        self.backend.boot_time = 0.3
+        first, second = self.pool(), self.pool()
+        thread = first.top_up(self.params, 2)
+        self.assertIsNone(second.top_up(self.params, 2))
+        thread.join()
+        self.assertEqual(2, len(self.backend.instances))
+        self.assertEqual(2, len(self.members()))
+        # The lease is released once the top-up is done
+        second.top_up(self.params, 2).join()
+        self.assertEqual(2, len(self.backend.instances))
+
+    def test_interrupted_top_up_is_completed(self):
+        pool = self.pool()
+        for_client = tagging.for_client
+
+        def worker_died(ec2_client):
+            raise RuntimeError("worker died")
+        tagging.for_client = worker_died
+        try:
+            self.assertRaises(RuntimeError, pool.fill, self.ec2_client,
+                              self.params, 2)
+        finally:
+            tagging.for_client = for_client
+        launched = sorted(self.backend.instances)
+        self.assertEqual([], self.members())
+
+        self.assertEqual(launched, sorted(
+            self.pool().fill(self.ec2_client, self.params, 2)))
+        self.assertEqual(launched, sorted(self.backend.instances))
+        self.assertEqual(2, len(self.members()))
+
+    def test_processes_of_a_host_claim_distinct_members(self):
+        self.backend.jitter = 0.06
+        for _ in range(10):
+            self.add_members(2)
+            claimed = self.claim_concurrently([self.pool()
+                                               for _ in range(4)])
+            self.assertClaimedOnce(claimed)
+            self.assertEqual(2, len(sum(claimed, [])))
+
+    def test_hosts_claim_distinct_members(self):
+        self.backend.jitter = 0.06
+        warm_pool.CLAIM_SETTLE_DELAY = 0.2
+        directory = tempfile.mkdtemp()
+        try:
+            for n in range(5):
+                self.add_members(1)
+                # One claim log per host
+                claimed = self.claim_concurrently([
+                    warm_pool.WarmPool(claims_path=os.path.join(
+                        directory, '{0}-{1}'.format(n, host)))
+                    for host in range(2)])
+                self.assertClaimedOnce(claimed)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_failed_claims_are_released(self):
+        profile = warm_pool.profile_of(self.params)
+        member, = self.add_members(1)
+        pool = self.pool()
+        create_tags = self.ec2_client.create_tags
+
+        def fail(*args, **kw):
+            raise RuntimeError("create_tags failed")
+        self.ec2_client.create_tags = fail
+        try:
+            self.assertRaises(RuntimeError, pool.claim, self.ec2_client,
+                              profile)
+        finally:
+            self.ec2_client.create_tags = create_tags
+        self.assertEqual([member], pool.claim(self.ec2_client, profile))
+
+        # As when the claimed member fails to start
+        pool.release(self.ec2_client, profile, [member])
+        self.assertEqual([member], self.pool().claim(self.ec2_client,
+                                                     profile))
+
+    def test_fill_waits_until_new_instances_can_be_tagged(self):
+        self.backend.tag_lag = 0.3
+        delay = tagging.NEW_INSTANCE_TAG_DELAY
+        tagging.NEW_INSTANCE_TAG_DELAY = 0.05
+        try:
+            launched = self.pool().fill(self.ec2_client, self.params, 2)
+        finally:
+            tagging.NEW_INSTANCE_TAG_DELAY = delay
+        self.assertEqual(sorted(launched),
+                         sorted(i.id for i in self.members()))
+        self.assertEqual(set(['stopping']),
+                         set(i.state for i in self.members()))
+
+    def test_fill_failing_to_tag_is_completed_later(self):
+        self.backend.tag_lag = 60
+        attempts = tagging.NEW_INSTANCE_TAG_ATTEMPTS
+        tagging.NEW_INSTANCE_TAG_ATTEMPTS = 1
+        try:
+            self.assertRaises(RuntimeError, self.pool().fill,
+                              self.ec2_client, self.params, 2)
+        finally:
+            tagging.NEW_INSTANCE_TAG_ATTEMPTS = attempts
+        launched = sorted(self.backend.instances)
+        self.assertEqual(set(['pending']), set(
+            i.state for i in self.backend.instances.values()))
+
+        self.backend.tag_lag = 0
+        self.assertEqual(launched, sorted(
+            self.pool().fill(self.ec2_client, self.params, 2)))
+        self.assertEqual(launched, sorted(self.backend.instances))
+        self.assertEqual(2, len(self.members()))
+
+
+class ExecutorTest(FakeEC2TestCase):
+
+    def test_results_in_order(self):
+        def double(ctx, n):
+            time.sleep(0.1)
+            if n == 2:
+                raise ValueError(n)
+            return n * 2
+        started = time.time()
+        results = executor.Executor().run(
+            [(double, _node_ctx('node{0}'.format(n)), {'n': n})
+             for n in range(4)])
+        self.assertLess(time.time() - started, 0.35)
+        self.assertEqual(['node0', 'node1', 'node2', 'node3'],
+                         [r.node_id for r in results])
+        self.assertEqual([0, 2, None, 6], [r.value for r in results])
+        self.assertIsInstance(results[2].error, ValueError)
+
+    def test_region_concurrency_is_capped(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def op(ctx):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+        executor.Executor(max_workers=8, max_per_region=2).run(
+            [(op, _node_ctx('node{0}'.format(n))) for n in range(8)])
+        self.assertEqual(2, running[1])
+
+    def test_timed_out_results_are_final(self):
+        release = threading.Event()
+
+        def slow(ctx):
+            release.wait(5)
+            return 'done'
+        results = executor.Executor().run([(slow, _node_ctx('slow'))],
+                                          timeout=0.1)
+        self.assertIsInstance(results[0].error, executor.Cancelled)
+        release.set()
+        time.sleep(0.2)
+        self.assertIsNone(results[0].value)
+        self.assertIsInstance(results[0].error, executor.Cancelled)
+
+    def test_cancellation_reaches_running_operations(self):
+        def wait(ctx):
+            while True:
+                executor.check_cancelled()
+                time.sleep(0.01)
+
+        def fail(ctx):
+            raise ValueError(ctx.node_id)
+        results = executor.Executor(max_workers=2).run(
+            [(wait, _node_ctx('waiting')), (fail, _node_ctx('failing')),
+             (wait, _node_ctx('queued'))], timeout=5, cancel_on_error=True)
+        self.assertIsInstance(results[0].error, executor.Cancelled)
+        self.assertIsInstance(results[1].error, ValueError)
+        self.assertIsInstance(results[2].error, executor.Cancelled)
+        self.assertLess(results[0].elapsed, 1)
+
+
+class TagWriterTest(FakeEC2TestCase):
+
+    def tag_concurrently(self, writer, writes):
+        # writes are (resource id, tags), each written by its own thread
+        errors = {}
+
+        def tag(resource_id, tags):
+            errors.update(writer.create_tags(self.ec2_client,
+                                             {resource_id: tags}))
+        threads = [threading.Thread(target=tag, args=write)
+                   for write in writes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_writes_are_coalesced(self):
+        instance_ids = [self.backend.add_instance().id for _ in range(10)]
+        self.backend.reset_counters()
+        errors = self.tag_concurrently(
+            tagging.TagWriter(max_delay=0.5),
+            [(i, {'Owner': 'test'}) for i in instance_ids])
+        self.assertEqual({}, errors)
+        self.assertEqual({'create_tags': 1}, self.backend.calls)
+        for instance_id in instance_ids:
+            self.assertEqual({'Owner': 'test'},
+                             self.backend.instances[instance_id].tags)
+
+    def test_writes_to_a_resource_are_merged(self):
+        instance_id = self.backend.add_instance().id
+        self.backend.reset_counters()
+        errors = self.tag_concurrently(
+            tagging.TagWriter(max_delay=0.5),
+            [(instance_id, {'Name': 'a'}), (instance_id, {'Env': 'x'})])
+        self.assertEqual({}, errors)
+        self.assertEqual({'create_tags': 1}, self.backend.calls)
+        self.assertEqual({'Name': 'a', 'Env': 'x'},
+                         self.backend.instances[instance_id].tags)
+
+    def test_full_batch_is_flushed_at_once(self):
+        instance_ids = [self.backend.add_instance().id for _ in range(2)]
+        writer = tagging.TagWriter(max_batch=2, max_delay=5)
+        started = time.time()
+        self.assertEqual({}, writer.create_tags(
+            self.ec2_client, dict((i, {'Owner': 'test'})
+                                  for i in instance_ids)))
+        self.assertLess(time.time() - started, 1)
+
+    def test_call_errors_fail_every_resource(self):
+        instance_ids = [self.backend.add_instance().id for _ in range(3)]
+        self.backend.throttle_rate = 1
+        self.backend.reset_counters()
+        errors = tagging.TagWriter(max_delay=0.5).create_tags(
+            self.ec2_client, dict((i, {'Owner': 'test'})
+                                  for i in instance_ids))
+        self.assertEqual(sorted(instance_ids), sorted(errors))
+        self.assertEqual({'create_tags': 1}, self.backend.calls)
+
+    def test_errors_are_per_resource(self):
+        instance_ids = [self.backend.add_instance().id for _ in range(3)]
+        errors = self.tag_concurrently(
+            tagging.TagWriter(max_delay=0.5),
+            [(i, {'Owner': 'test'}) for i in instance_ids + ['i-bad']])
+        self.assertEqual(['i-bad'], list(errors))
+        self.assertIn('InvalidID', errors['i-bad'])
+        for instance_id in instance_ids:
+            self.assertEqual({'Owner': 'test'},
+                             self.backend.instances[instance_id].tags)
+
+class WaiterTest(FakeEC2TestCase):
+
+    def test_concurrent_waiters_share_one_describe_per_tick(self):
+        self.backend.boot_time = 0.5
+        state_waiter = waiter.StateWaiter(initial_delay=0.1, multiplier=1,
+                                          jitter=0)
+        instance_ids = [self.backend.add_instance(state='pending').id
+                        for _ in range(8)]
+        self.backend.reset_counters()
+        results = {}
+
+        def wait(instance_id):
+            results[instance_id] = state_waiter.wait(
+                self.ec2_client, [instance_id], waiter.RUNNING, timeout=5)
+        threads = [threading.Thread(target=wait, args=(i, ))
+                   for i in instance_ids]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ticks = (time.time() - started) / state_waiter.initial_delay
+        self.assertEqual(sorted(instance_ids), sorted(results))
+        self.assertEqual(set(['running']), set(
+            r[0].state for r in results.values()))
+        self.assertLessEqual(self.backend.total_calls, ticks + 1)
+
+    def test_waiters_finishing_early_do_not_speed_polling_up(self):
+        self.backend.boot_time = 0.5
+        state_waiter = waiter.StateWaiter(initial_delay=0.1, multiplier=1,
+                                          jitter=0)
+        instance_ids = [self.backend.add_instance().id for _ in range(20)]
+        instance_ids.append(self.backend.add_instance(state='pending').id)
+        self.backend.reset_counters()
+        threads = [threading.Thread(target=state_waiter.wait, args=(
+            self.ec2_client, [i], waiter.RUNNING, 5)) for i in instance_ids]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ticks = (time.time() - started) / state_waiter.initial_delay
+        self.assertEqual('running',
+                         self.backend.instances[instance_ids[-1]].state)
+        self.assertLessEqual(self.backend.total_calls, ticks + 1)
+
+    def test_unreachable_state_fails_at_once(self):
+        instance_id = self.backend.add_instance(state='terminated').id
+        started = time.time()
+        self.assertRaises(RuntimeError, waiter.StateWaiter(
+            initial_delay=0.05).wait, self.ec2_client, [instance_id],
+            waiter.RUNNING, timeout=5)
+        self.assertLess(time.time() - started, 1)
+
+
+class SchedulerTest(FakeEC2TestCase):
+
+    def setUp(self):
+        super(SchedulerTest, self).setUp()
+        self.retry_base_delay = scheduler.RETRY_BASE_DELAY
+        scheduler.RETRY_BASE_DELAY = 0.001
+        self.scheduler = scheduler.RequestScheduler('test')
+
+    def tearDown(self):
+        scheduler.RETRY_BASE_DELAY = self.retry_base_delay
+        super(SchedulerTest, self).tearDown()
+
+    def failing(self, *errors):
+        # A call raising errors, one per attempt, then succeeding
+        errors = list(errors)
+        attempts = []
+
+        def f(*args, **kw):
+            attempts.append(args)
+            if errors:
+                raise errors.pop(0)
+            return 'ok'
+        return f, attempts
+
+    def throttled(self):
+        return EC2ResponseError(503, 'Service Unavailable', THROTTLE_BODY)
+
+    def internal_error(self):
+        return EC2ResponseError(500, 'Internal Server Error',
+                                NOT_FOUND_BODY.format('InternalError', ''))
+
+    def test_throttled_calls_are_retried(self):
+        f, attempts = self.failing(self.throttled(), self.throttled())
+        self.assertEqual('ok', self.scheduler.call('run_instances', f,
+                                                   ('ami-00000001', ), {}))
+        self.assertEqual(3, len(attempts))
+        bucket = self.scheduler.buckets[scheduler.MUTATE]
+        self.assertLess(bucket.rate, bucket.max_rate)
+
+    def test_transient_errors_are_retried_when_idempotent(self):
+        for name, args, kw in [
+                ('get_all_reservations', (), {}),
+                ('terminate_instances', (['i-1'], ), {}),
+                ('run_instances', ('ami-00000001', ),
+                 {'client_token': 'token'})]:
+            f, attempts = self.failing(self.internal_error())
+            self.assertEqual('ok', self.scheduler.call(name, f, args, kw))
+            self.assertEqual(2, len(attempts), name)
+
+    def test_transient_errors_are_raised_when_not_idempotent(self):
+        for name, args in [('run_instances', ('ami-00000001', )),
+                           ('create_security_group', ('sg', 'sg'))]:
+            f, attempts = self.failing(self.internal_error())
+            self.assertRaises(EC2ResponseError, self.scheduler.call,
+                              name, f, args, {})
+            self.assertEqual(1, len(attempts), name)
+
+    def test_client_errors_are_not_retried(self):
+        f, attempts = self.failing(
+            EC2ResponseError(400, 'Bad Request',
+                             NOT_FOUND_BODY.format('InvalidID', '')))
+        self.assertRaises(EC2ResponseError, self.scheduler.call,
+                          'get_all_reservations', f, (), {})
+        self.assertEqual(1, len(attempts))
+
+    def test_retries_are_bounded(self):
+        f, attempts = self.failing(
+            *[self.throttled()] * scheduler.RETRY_MAX_ATTEMPTS)
+        self.assertRaises(EC2ResponseError, self.scheduler.call,
+                          'get_all_reservations', f, (), {})
+        self.assertEqual(scheduler.RETRY_MAX_ATTEMPTS, len(attempts))
+
+    def test_throttled_backend(self):
+        self.backend.throttle_rate = 0.3
+        instance_id = self.backend.add_instance().id
+        ec2_client = common.scheduled(self.ec2_client)
+        for _ in range(20):
+            self.assertEqual(
+                [instance_id],
+                [i.id for i in common.iter_instances(ec2_client)])
+        self.assertGreater(self.backend.calls['get_all_reservations'], 20)
+
+
+class CoalescingTest(FakeEC2TestCase):
+
+    def concurrently(self, f, threads=10):
+        results = []
+        errors = []
+
+        def run():
+            try:
+                results.append(f())
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for _ in range(threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_single_flight_shares_results_and_errors(self):
+        flights = common.SingleFlight()
+        calls = []
+
+        def slow(value):
+            calls.append(value)
+            time.sleep(0.2)
+            if isinstance(value, Exception):
+                raise value
+            return value
+        results, errors = self.concurrently(
+            lambda: flights.do('key', lambda: slow('value')))
+        self.assertEqual((['value'] * 10, []), (results, errors))
+        error = ValueError('failed')
+        results, errors = self.concurrently(
+            lambda: flights.do('key', lambda: slow(error)))
+        self.assertEqual(([], [error] * 10), (results, errors))
+        self.assertEqual(2, len(calls))
+        # Nothing is cached once the flight landed
+        self.assertEqual('again', flights.do('key', lambda: 'again'))
+
+    def test_concurrent_describes_are_shared(self):
+        self.backend.latency = 0.2
+        ec2_client = common.coalesced(self.ec2_client)
+        results, errors = self.concurrently(
+            lambda: ec2_client.get_all_security_groups(groupnames=['default']))
+        self.assertEqual([], errors)
+        self.assertEqual(10, len(results))
+        self.assertEqual({'get_all_security_groups': 1}, self.backend.calls)
+
+        # Calls with other arguments are not shared
+        self.backend.reset_counters()
+        threads = [threading.Thread(
+            target=ec2_client.get_all_security_groups, kwargs=kw)
+            for kw in ({'groupnames': ['default']}, {})]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual({'get_all_security_groups': 2}, self.backend.calls)
+
+    def test_mutations_are_not_shared(self):
+        instance_id = self.backend.add_instance().id
+        self.backend.latency = 0.2
+        self.backend.reset_counters()
+        ec2_client = common.coalesced(self.ec2_client)
+        _, errors = self.concurrently(
+            lambda: ec2_client.create_tags([instance_id], {'Owner': 'test'}),
+            threads=3)
+        self.assertEqual([], errors)
+        self.assertEqual({'create_tags': 3}, self.backend.calls)
+
+
+class RegionsTest(FakeEC2TestCase):
+
+    def test_security_groups_in_regions(self):
+        group = self.backend.add_security_group('web', 'web servers')
+        connect = common.EC2Client.connect
+
+        def connect_or_fail(acquirer, cfg):
+            if cfg['Amazon Credentials']['region'] == 'eu-west-1':
+                raise RuntimeError("eu-west-1 is down")
+            return connect(acquirer, cfg)
+        common.EC2Client.connect = connect_or_fail
+        groups, errors = cfy_srv.get_security_groups_by_name_in_regions(
+            'web', region_names=['us-east-1', 'eu-west-1', 'us-west-2'])
+        self.assertEqual([
+            {'region': 'us-east-1', 'id': group.id, 'name': 'web'},
+            {'region': 'us-west-2', 'id': group.id, 'name': 'web'}], groups)
+        self.assertEqual(['eu-west-1'], list(errors))
+        self.assertIn('is down', str(errors['eu-west-1']))
+
+        groups, errors = cfy_srv.get_security_groups_by_name_in_regions(
+            'db', region_names=['us-east-1'])
+        self.assertEqual(([], {}), (groups, errors))
+
+
+class ReconcileTest(FakeEC2TestCase):
+
+    def test_failed_launch_group_only_fails_its_nodes(self):
+        large = dict(SERVER, instance_type='m1.large')
+        ctxs = [_node_ctx('small{0}'.format(n), server=dict(SERVER))
+                for n in range(3)] + \
+            [_node_ctx('large{0}'.format(n), server=dict(large))
+             for n in range(3)]
+        run_instances = self.ec2_client.run_instances
+
+        def no_large_instances(*args, **kw):
+            if kw.get('instance_type') == 'm1.large':
+                raise RuntimeError("InsufficientInstanceCapacity")
+            return run_instances(*args, **kw)
+        self.ec2_client.run_instances = no_large_instances
+        _, errors = reconcile.reconcile(
+            self.ec2_client, nodes=[(ctx, reconcile.RUNNING)
+                                    for ctx in ctxs])
+        not_launched = set(
+            (reconcile.LAUNCH, ctx.node_id) for ctx in ctxs
+            if ctx.get(cfy_srv.LAUNCH_PHASE_PROPERTY) != cfy_srv.RECORDED)
+        self.assertEqual(not_launched, set(errors))
+        self.assertTrue(set((reconcile.LAUNCH, 'large{0}'.format(n))
+                            for n in range(3)) <= not_launched)
+
+    def test_stopping_instances_are_started_once_stopped(self):
+        self.backend.stop_time = 0.2
+        i = self.backend.add_instance(state='stopping', tags={
+            'Name': 'stopping', 'meta_data': 'stopping'})
+        ctx = _node_ctx('stopping', server={'name': 'stopping'})
+        plan, errors = reconcile.reconcile(
+            self.ec2_client, nodes=[(ctx, reconcile.RUNNING)])
+        self.assertEqual([reconcile.WAIT, reconcile.START],
+                         [a.kind for a in plan])
+        self.assertEqual({}, errors)
+        self.assertEqual(1, self.backend.calls['start_instances'])
+        self.assertIn(i.state, ('pending', 'running'))
+
+    def test_errors_are_keyed_by_action(self):
+        ctx = _node_ctx('web', server={'name': 'web'})
+        self.backend.add_instance(tags={'Name': 'web', 'meta_data': 'web'})
+        _, errors = reconcile.reconcile(
+            self.ec2_client, nodes=[(ctx, reconcile.ABSENT)],
+            groups=[{'name': 'web', 'state': reconcile.ABSENT}])
+        self.assertEqual({}, errors)
+
+        def fail(*args, **kw):
+            raise RuntimeError("failed")
+        self.ec2_client.create_security_group = fail
+        self.ec2_client.terminate_instances = fail
+        self.backend.add_instance(tags={'Name': 'web', 'meta_data': 'web'})
+        _, errors = reconcile.reconcile(
+            self.ec2_client, nodes=[(ctx, reconcile.ABSENT)],
+            groups=[{'name': 'web'}])
+        self.assertEqual(set([(reconcile.CREATE_GROUP, 'web'),
+                              (reconcile.TERMINATE, 'web')]), set(errors))
+
+
+class _Logger(object):
+    # Keeps the messages logged through a node context
+
+    def __init__(self):
+        self.messages = []
+
+    def _log(self, message, *args, **kw):
+        self.messages.append(message)
+    debug = info = warning = error = _log
+
+
+class MetricsTest(FakeEC2TestCase):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.sink = metrics.MemorySink()
+        metrics.enable(self.sink)
+
+    def tearDown(self):
+        metrics.disable()
+        metrics._configured = False
+        super(MetricsTest, self).tearDown()
+
+    def node(self, node_id, instance_id):
+        ctx = _node_ctx(node_id, instance_id)
+        ctx.logger = _Logger()
+        return ctx
+
+    def test_calls_are_recorded_per_operation_and_node(self):
+        web = self.node('web', self.backend.add_instance().id)
+        self.assertTrue(cfy_srv.get_state(ctx=web))
+        self.assertEqual(1, self.sink.count(
+            'ec2.api.calls', operation='get_state', node_id='web',
+            call='get_all_reservations'))
+        self.assertEqual(0, self.sink.count('ec2.api.errors'))
+        summary = web.logger.messages[-1]
+        self.assertIn('get_state on node web', summary)
+        self.assertIn('get_all_reservations: 1 calls', summary)
+
+    def test_errors_are_recorded(self):
+        retry_base_delay = scheduler.RETRY_BASE_DELAY
+        scheduler.RETRY_BASE_DELAY = 0.001
+        self.backend.throttle_rate = 1
+        db = self.node('db', self.backend.add_instance().id)
+        try:
+            self.assertRaises(Exception, cfy_srv.get_state, ctx=db)
+        finally:
+            scheduler.RETRY_BASE_DELAY = retry_base_delay
+        attempts = scheduler.RETRY_MAX_ATTEMPTS
+        self.assertEqual(attempts, self.sink.count(
+            'ec2.api.errors', operation='get_state', node_id='db'))
+        self.assertEqual(attempts, self.sink.count(
+            'ec2.api.throttles', operation='get_state', node_id='db'))
+        self.assertIn('{0} throttled'.format(attempts),
+                      db.logger.messages[-1])
+
+    def test_settings_are_read_from_the_environment(self):
+        web = self.node('web', self.backend.add_instance().id)
+        saved = os.environ.pop(metrics.METRICS_ENV, None)
+        try:
+            for value, sink in [('', None), ('log', None),
+                                ('statsd:127.0.0.1:9125',
+                                 ('127.0.0.1', 9125)),
+                                ('statsd', ('localhost', 8125))]:
+                os.environ[metrics.METRICS_ENV] = value
+                metrics.disable()
+                metrics._configured = False
+                del web.logger.messages[:]
+                cfy_srv.get_state(ctx=web)
+                self.assertEqual(bool(value), metrics._enabled, value)
+                self.assertEqual(
+                    sink, metrics._sink and metrics._sink.address, value)
+                self.assertEqual(bool(value), any(
+                    'EC2 API calls' in m for m in web.logger.messages))
+        finally:
+            os.environ.pop(metrics.METRICS_ENV)
+            if saved is not None:
+                os.environ[metrics.METRICS_ENV] = saved
+
+
+class TrackerTest(FakeEC2TestCase):
+
+    def launch(self, node_id):
+        ctx = _node_ctx(node_id, server=dict(SERVER))
+        cfy_srv.start_new_servers([ctx], self.ec2_client)
+        return ctx
+
+    def test_get_state_is_answered_from_fresh_statuses(self):
+        ctx = self.launch('tracked')
+        self.backend.reset_counters()
+        self.assertTrue(cfy_srv.get_state(ctx=ctx))
+        self.assertEqual(0, self.backend.total_calls)
+
+        tracker.for_client(self.ec2_client).stale_after = 0.05
+        time.sleep(0.1)
+        inventory.for_client(self.ec2_client).invalidate(
+            [ctx[cfy_srv.AWS_SERVER_ID_PROPERTY]])
+        self.assertTrue(cfy_srv.get_state(ctx=ctx))
+        self.assertEqual({'get_all_reservations': 1}, self.backend.calls)
+
+    def add_instances(self, count):
+        instance_ids = []
+        for n in range(count):
+            i = self.backend.add_instance()
+            i.ip_address = '54.1.0.{0}'.format(n)
+            instance_ids.append(i.id)
+        return instance_ids
+
+    def test_poll_batches_and_refreshes_changes(self):
+        instance_ids = self.add_instances(250)
+        status_tracker = tracker.StatusTracker()
+        status_tracker._update(list(common.iter_instances(self.ec2_client)))
+        self.backend.reset_counters()
+        status_tracker.poll(self.ec2_client)
+        self.assertEqual({'get_all_instance_status': 3}, self.backend.calls)
+
+        self.backend.instances[instance_ids[0]].state = 'stopped'
+        self.backend.instances[instance_ids[1]].state = 'terminated'
+        self.backend.reset_counters()
+        status_tracker.poll(self.ec2_client)
+        self.assertEqual({'get_all_instance_status': 3,
+                          'get_all_reservations': 1}, self.backend.calls)
+        self.assertEqual('stopped',
+                         status_tracker.get(instance_ids[0]).state)
+        self.assertIsNone(status_tracker.get(instance_ids[1]))
+        self.assertEqual(249, len(status_tracker._tracked))
+
+    def test_statuses_not_read_are_evicted(self):
+        instance_ids = self.add_instances(3)
+        status_tracker = tracker.StatusTracker(evict_after=0.1)
+        status_tracker._update(list(common.iter_instances(self.ec2_client)))
+        time.sleep(0.15)
+        status_tracker.get(instance_ids[0])
+        status_tracker.poll(self.ec2_client)
+        self.assertEqual([instance_ids[0]], list(status_tracker._tracked))
+        self.assertEqual('running',
+                         status_tracker.get(instance_ids[0]).state)
+
+
+class LaunchSpecTest(FakeEC2TestCase):
+
+    def setUp(self):
+        super(LaunchSpecTest, self).setUp()
+        self.compiled = []
+        compile_launch_spec = cfy_srv._compile_launch_spec
+
+        def counting(ctx, ec2_client, key):
+            self.compiled.append(key)
+            return compile_launch_spec(ctx, ec2_client, key)
+        cfy_srv._compile_launch_spec = counting
+        self.addCleanup(setattr, cfy_srv, '_compile_launch_spec',
+                        compile_launch_spec)
+
+    def launch(self, node_id, **server):
+        cfy_srv.start_new_servers(
+            [_node_ctx(node_id, server=dict(SERVER, **server))],
+            self.ec2_client)
+
+    def test_identical_properties_share_a_spec(self):
+        self.launch('first')
+        self.backend.reset_counters()
+        self.launch('second')
+        self.assertEqual(1, len(self.compiled))
+        self.assertNotIn('get_all_images', self.backend.calls)
+        self.assertNotIn('get_all_security_groups', self.backend.calls)
+
+    def test_other_properties_or_region_compile_a_new_spec(self):
+        self.launch('small')
+        self.launch('large', instance_type='m1.large')
+        self.assertEqual(2, len(set(self.compiled)))
+        properties = {'server': dict(SERVER), 'security_group': None}
+        self.assertNotEqual(launch_specs.spec_key(properties, 'us-east-1'),
+                            launch_specs.spec_key(properties, 'eu-west-1'))
+
+    def test_failed_launch_invalidates_the_spec(self):
+        self.launch('first')
+        # The image of the compiled spec is gone
+        image = self.backend.images.pop(SERVER['image_id'])
+        self.assertRaises(RuntimeError, self.launch, 'failing')
+        self.backend.images[image.id] = image
+        self.launch('failing')
+        self.assertEqual(2, len(self.compiled))
+        self.assertEqual(1, len(set(self.compiled)))
+
+
+class SecurityGroupRulesTest(FakeEC2TestCase):
+
+    rules = [
+        {'ip_protocol': 'tcp', 'from_port': 22, 'to_port': 22,
+         'cidr_ip': '10.0.0.0/8'},
+        {'ip_protocol': 'tcp', 'from_port': 22, 'to_port': 22,
+         'cidr_ip': '192.168.0.0/16'},
+        {'ip_protocol': 'tcp', 'from_port': 80, 'to_port': 80,
+         'cidr_ip': '0.0.0.0/0'},
+    ]
+
+    def configure(self, rules):
+        ctx = _node_ctx('web_rules', security_group={
+            'conf_sg_name': 'web', 'rules': rules})
+        cfy_srv.configure_security_group(ctx=ctx)
+
+    def rules_of(self, group):
+        return sorted((r.ip_protocol, str(r.from_port), str(r.to_port),
+                       g.cidr_ip) for r in group.rules for g in r.grants)
+
+    def test_only_missing_rules_are_authorized(self):
+        group = self.backend.add_security_group('web', 'web servers')
+        self.backend.reset_counters()
+        self.configure(self.rules)
+        self.assertEqual(1, self.backend.calls[
+            'AuthorizeSecurityGroupIngress'])
+        self.assertEqual([('tcp', '22', '22', '10.0.0.0/8'),
+                          ('tcp', '22', '22', '192.168.0.0/16'),
+                          ('tcp', '80', '80', '0.0.0.0/0')],
+                         self.rules_of(group))
+        # Ranges of a port range are sent as one permission
+        self.assertEqual(2, len(group.rules))
+
+        authorized = list(group.rules)
+        extra = {'ip_protocol': 'tcp', 'from_port': 443, 'to_port': 443,
+                 'cidr_ip': '0.0.0.0/0'}
+        self.backend.reset_counters()
+        self.configure(self.rules + [extra])
+        self.assertEqual(1, self.backend.calls[
+            'AuthorizeSecurityGroupIngress'])
+        added = group.rules[len(authorized):]
+        self.assertEqual([('tcp', '443', '443', '0.0.0.0/0')],
+                         [(r.ip_protocol, r.from_port, r.to_port,
+                           g.cidr_ip) for r in added for g in r.grants])
+
+        self.backend.reset_counters()
+        self.configure(self.rules + [extra])
+        self.assertNotIn('AuthorizeSecurityGroupIngress', self.backend.calls)
+
+
+class ImageCacheTest(FakeEC2TestCase):
+
+    def test_concurrent_resolutions_share_a_describe(self):
+        self.backend.latency = 0.2
+        cache = images.ImageCache()
+        resolved = []
+
+        def resolve():
+            resolved.append(cache.resolve(self.ec2_client,
+                                          image_id=SERVER['image_id']))
+        threads = [threading.Thread(target=resolve) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([SERVER['image_id']] * 10, resolved)
+        self.assertEqual({'get_all_images': 1}, self.backend.calls)
+
+        self.backend.reset_counters()
+        self.backend.latency = 0
+        cache.resolve(self.ec2_client, image_id=SERVER['image_id'])
+        self.assertEqual({}, self.backend.calls)
+
+    def test_missing_images_are_remembered(self):
+        cache = images.ImageCache(negative_ttl=0.2)
+        for _ in range(3):
+            self.assertRaises(ValueError, cache.resolve, self.ec2_client,
+                              image_id='ami-missing')
+            self.assertRaises(ValueError, cache.resolve, self.ec2_client,
+                              name='missing')
+        self.assertEqual({'get_all_images': 2}, self.backend.calls)
+
+        # Once negative_ttl passed, the image is looked up again
+        time.sleep(0.25)
+        self.backend.add_image('ami-missing', 'missing')
+        self.assertEqual('ami-missing', cache.resolve(
+            self.ec2_client, image_id='ami-missing'))
+        self.assertEqual('ami-missing', cache.resolve(
+            self.ec2_client, name='missing'))
+        self.assertEqual({'get_all_images': 4}, self.backend.calls)
+
+
+class ClientPoolTest(FakeEC2TestCase):
+
+    def setUp(self):
+        super(ClientPoolTest, self).setUp()
+        common.EC2Client().release(self.ec2_client)
+        common.client_pool.clear()
+        self.connected = []
+        self.closed = []
+
+    def connect(self):
+        client = self.backend.connect()
+        client.close = lambda: self.closed.append(client)
+        self.connected.append(client)
+        return client
+
+    def test_clients_are_reused_across_operations(self):
+        connect = common.EC2Client.connect
+        common.EC2Client.connect = lambda acquirer, cfg: self.connect()
+        try:
+            ctx = _node_ctx('web', self.backend.add_instance().id)
+            for _ in range(3):
+                self.assertTrue(cfy_srv.get_state(ctx=ctx))
+        finally:
+            common.EC2Client.connect = connect
+        self.assertEqual(1, len(self.connected))
+
+    def test_ec2_config_overrides_get_their_own_clients(self):
+        credentials = {'aws_access_key_id': 'fake-access-key',
+                       'aws_secret_access_key': 'fake-secret-key'}
+        configs = [{'Amazon Credentials': dict(credentials, region=region)}
+                   for region in ('us-east-1', 'eu-west-1')]
+        acquirer = common.EC2Client()
+        clients = [acquirer.get(config=config) for config in configs]
+        self.assertIsNot(clients[0], clients[1])
+        for client in clients:
+            acquirer.release(client)
+        self.assertEqual(clients, [acquirer.get(config=config)
+                                   for config in configs])
+
+    def test_idle_clients_are_bounded_per_key(self):
+        pool = common.ClientPool(max_idle_per_key=2)
+        clients = [pool.acquire('key', self.connect) for _ in range(3)]
+        other = pool.acquire('other', self.connect)
+        for client in clients + [other]:
+            pool.release(client)
+        self.assertEqual([clients[2]], self.closed)
+        self.assertIs(other, pool.acquire('other', self.connect))
+        self.assertEqual(4, len(self.connected))
+
+    def test_idle_clients_expire(self):
+        pool = common.ClientPool(max_idle_time=0.05)
+        client = pool.acquire('key', self.connect)
+        pool.release(client)
+        time.sleep(0.1)
+        self.assertIsNot(client, pool.acquire('key', self.connect))
+        self.assertEqual([client], self.closed)
+
+    def test_unhealthy_clients_are_discarded(self):
+        pool = common.ClientPool(health_check_interval=0)
+        client = pool.acquire('key', self.connect)
+        pool.release(client)
+        self.backend.reset_counters()
+        self.assertIs(client, pool.acquire('key', self.connect))
+        self.assertEqual({'get_all_regions': 1}, self.backend.calls)
+        pool.release(client)
+
+        def broken(*args, **kw):
+            raise IOError("Connection reset by peer")
+        client.get_all_regions = broken
+        self.assertIsNot(client, pool.acquire('key', self.connect))
+        self.assertEqual([client], self.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
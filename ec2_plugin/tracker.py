@@ -0,0 +1,229 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import time
+import logging
+import threading
+
+import aws_plugin_common
+
+from ec2_plugin import inventory
+
+# Seconds between polls while a tracked instance changes state
+TRACKER_FAST_INTERVAL = 2
+# Seconds between polls while all tracked instances are stable
+TRACKER_SLOW_INTERVAL = 30
+# Seconds after which a tracked status is not trusted anymore
+TRACKER_STALE_AFTER = 60
+# Seconds after which an instance whose status was not read stops being
+# tracked
+TRACKER_EVICT_AFTER = 5 * TRACKER_STALE_AFTER
+# Max instance ids per describe_instance_status call
+TRACKER_BATCH = 100
+
+TRANSITIONAL_STATES = ('pending', 'stopping', 'shutting-down')
+
+logger = logging.getLogger(__name__)
+
+
+class TrackedStatus(object):
+
+    __slots__ = ('id', 'state', 'ip_address', 'private_ip_address',
+                 'updated', 'read')
+
+    def __init__(self, id, state=None, ip_address=None,
+                 private_ip_address=None, updated=0, read=0):
+        self.id = id
+        self.state = state
+        self.ip_address = ip_address
+        self.private_ip_address = private_ip_address
+        self.updated = updated
+        # Last time get() asked for the status
+        self.read = read
+
+
+class StatusTracker(object):
+    """
+    Keeps the state and addresses of instances created by the plugin.
+
+    A background thread polls describe_instance_status for all tracked
+    instances in batches, every fast_interval seconds while one of them
+    is changing state and every slow_interval seconds otherwise.
+    Addresses are described again only for instances whose state
+    changed. Terminated instances, and instances whose status was not
+    read for evict_after seconds, stop being tracked.
+    """
+
+    def __init__(self, fast_interval=None, slow_interval=None,
+                 stale_after=None, evict_after=None):
+        self.fast_interval = fast_interval or TRACKER_FAST_INTERVAL
+        self.slow_interval = slow_interval or TRACKER_SLOW_INTERVAL
+        self.stale_after = stale_after or TRACKER_STALE_AFTER
+        self.evict_after = evict_after or TRACKER_EVICT_AFTER
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        # ec2_config overrides the background thread connects with
+        self._config = None
+        # instance id -> TrackedStatus
+        self._tracked = {}
+
+    def track(self, records, config=None):
+        """Starts tracking instances, given as InstanceRecords."""
+        with self._lock:
+            if config:
+                self._config = config
+            self._update(records)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='ec2-status-tracker')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def get(self, instance_id):
+        """Returns the instance's TrackedStatus, None if it is stale."""
+        status = self._tracked.get(instance_id)
+        if status is None:
+            return None
+        now = time.time()
+        status.read = now
+        if now - status.updated >= self.stale_after:
+            return None
+        return status
+
+    def invalidate(self, instance_ids):
+        """Marks instances as changing state, polling them soon."""
+        with self._lock:
+            for instance_id in instance_ids:
+                status = self._tracked.get(instance_id)
+                if status is not None:
+                    status.updated = 0
+                    status.state = None
+        self._wakeup.set()
+
+    def update(self, records):
+        """Updates tracked instances from freshly described records."""
+        with self._lock:
+            self._update([r for r in records if r.id in self._tracked])
+
+    def clear(self):
+        """Stops tracking all instances, the thread exits."""
+        with self._lock:
+            self._tracked.clear()
+        self._wakeup.set()
+
+    def _update(self, records):
+        # Must be called with self._lock held
+        now = time.time()
+        for r in records:
+            if r.state == 'terminated':
+                self._tracked.pop(r.id, None)
+                continue
+            status = self._tracked.get(r.id)
+            self._tracked[r.id] = TrackedStatus(
+                r.id, r.state, r.ip_address, r.private_ip_address, now,
+                status.read if status is not None else now)
+
+    def _evict(self):
+        # Must be called with self._lock held
+        now = time.time()
+        for instance_id, status in list(self._tracked.items()):
+            if now - status.read >= self.evict_after:
+                del self._tracked[instance_id]
+
+    def _interval(self):
+        for status in self._tracked.values():
+            if status.state is None or status.state in TRANSITIONAL_STATES:
+                return self.fast_interval
+        return self.slow_interval
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._tracked:
+                    self._thread = None
+                    return
+                interval = self._interval()
+                config = self._config
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            if not self._tracked:
+                continue
+            acquirer = aws_plugin_common.EC2Client()
+            try:
+                client = acquirer.get(config=config)
+            except Exception:
+                logger.exception("Failed connecting to EC2")
+                continue
+            try:
+                self.poll(aws_plugin_common.scheduled(client))
+            except Exception:
+                logger.exception("Failed polling instance status")
+            finally:
+                acquirer.release(client)
+
+    def poll(self, ec2_client):
+        with self._lock:
+            self._evict()
+            ids = list(self._tracked)
+        changed = []
+        for n in range(0, len(ids), TRACKER_BATCH):
+            chunk = ids[n:n + TRACKER_BATCH]
+            try:
+                statuses = ec2_client.get_all_instance_status(
+                    instance_ids=chunk, include_all_instances=True)
+            except Exception as e:
+                if aws_plugin_common.error_code(e) != \
+                        'InvalidInstanceID.NotFound':
+                    raise
+                # Describing instances copes with unknown ids
+                changed.extend(chunk)
+                continue
+            now = time.time()
+            with self._lock:
+                for s in statuses:
+                    status = self._tracked.get(s.id)
+                    if status is None:
+                        continue
+                    if status.state == s.state_name and \
+                            (status.ip_address or s.state_name != 'running'):
+                        status.updated = now
+                    else:
+                        changed.append(s.id)
+        if changed:
+            records = list(aws_plugin_common.iter_instances_by(
+                ec2_client, 'instance-id', changed))
+            inventory.for_client(ec2_client).add(records)
+            with self._lock:
+                self._update(records)
+                found = set(r.id for r in records)
+                for instance_id in changed:
+                    if instance_id not in found:
+                        self._tracked.pop(instance_id, None)
+
+
+_trackers = aws_plugin_common.PerClient(StatusTracker)
+
+
+def for_client(ec2_client):
+    """Returns the tracker for the region and account of ec2_client."""
+    return _trackers.get(ec2_client)
+
+
+def clear():
+    """Stops all trackers."""
+    for status_tracker in _trackers.values():
+        status_tracker.clear()
+    _trackers.clear()
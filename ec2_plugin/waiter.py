@@ -0,0 +1,180 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import time
+import random
+import threading
+
+import aws_plugin_common
+
+from aws_plugin_common import executor
+from aws_plugin_common import metrics
+from ec2_plugin import inventory
+
+RUNNING = 'running'
+STOPPED = 'stopped'
+TERMINATED = 'terminated'
+
+# Target state -> states from which the target can no longer be reached
+UNREACHABLE_FROM = {
+    RUNNING: ('shutting-down', 'terminated'),
+    STOPPED: ('shutting-down', 'terminated'),
+    TERMINATED: (),
+}
+
+WAIT_TIMEOUT = 300
+WAIT_INITIAL_DELAY = 1
+WAIT_MAX_DELAY = 15
+WAIT_BACKOFF_MULTIPLIER = 2
+WAIT_JITTER = 0.3
+
+
+class _Waiter(object):
+
+    def __init__(self, instance_ids, state, timeout, state_waiter):
+        now = time.time()
+        self.instance_ids = list(instance_ids)
+        self.state = state
+        self.deadline = now + timeout
+        self.delay = state_waiter.initial_delay
+        self.next_poll = now + self.delay
+        self.result = None
+        self.error = None
+
+    @property
+    def done(self):
+        return self.result is not None or self.error is not None
+
+    def backoff(self, state_waiter, now):
+        self.delay = min(state_waiter.max_delay,
+                         self.delay * state_waiter.multiplier)
+        jitter = self.delay * state_waiter.jitter * random.random()
+        self.next_poll = now + self.delay - jitter
+
+
+class StateWaiter(object):
+    """
+    Waits for instances to reach a target state.
+
+    All instances being waited for in the process (per region and account)
+    are described with one call per tick, whichever waiting thread is due
+    first does the call for everybody. Each waiter polls with exponential
+    backoff and jitter, starting fast since instances often reach the
+    target state within seconds.
+    """
+
+    def __init__(self, initial_delay=None, max_delay=None, multiplier=None,
+                 jitter=None):
+        # Module defaults are looked up here so they can be tuned at runtime
+        self.initial_delay = initial_delay or WAIT_INITIAL_DELAY
+        self.max_delay = max_delay or WAIT_MAX_DELAY
+        self.multiplier = multiplier or WAIT_BACKOFF_MULTIPLIER
+        self.jitter = WAIT_JITTER if jitter is None else jitter
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._polling = False
+
+    def wait(self, ec2_client, instance_ids, state=RUNNING, timeout=None):
+        """Returns the instances once all of them are in state."""
+        if state not in UNREACHABLE_FROM:
+            raise ValueError("Can not wait for instance state '{0}', "
+                             "supported states are: {1}"
+                             .format(state, UNREACHABLE_FROM.keys()))
+        w = _Waiter(instance_ids, state, timeout or WAIT_TIMEOUT, self)
+        started = time.time()
+        try:
+            return self._wait(ec2_client, w)
+        finally:
+            metrics.record('wait_for_' + state, time.time() - started)
+
+    def _wait(self, ec2_client, w):
+        with self._cond:
+            self._waiters.append(w)
+            try:
+                while not w.done:
+                    executor.check_cancelled()
+                    now = time.time()
+                    if now >= w.deadline:
+                        raise RuntimeError(
+                            "Instances {0} failed to become {1} in time"
+                            .format(w.instance_ids, w.state))
+                    if self._polling:
+                        self._cond.wait(min(w.deadline - now,
+                                            executor.CANCEL_CHECK_INTERVAL))
+                        continue
+                    # Waiters done are removed by their own threads
+                    wake = min(x.next_poll for x in self._waiters
+                               if not x.done)
+                    if wake > now:
+                        self._cond.wait(min(min(wake, w.deadline) - now,
+                                            executor.CANCEL_CHECK_INTERVAL))
+                        continue
+                    self._poll(ec2_client)
+            finally:
+                self._waiters.remove(w)
+        if w.error:
+            raise w.error
+        return w.result
+
+    def _poll(self, ec2_client):
+        # Must be called with self._cond held, releases it for the call
+        ids = set()
+        for x in self._waiters:
+            if not x.done:
+                ids.update(x.instance_ids)
+        self._polling = True
+        self._cond.release()
+        try:
+            # Filtering by id rather than passing instance_ids, freshly
+            # launched instances may not be known to describe calls yet.
+            instances = list(aws_plugin_common.iter_instances_by(
+                ec2_client, 'instance-id', ids))
+            inventory.for_client(ec2_client).add(instances)
+        finally:
+            self._cond.acquire()
+            self._polling = False
+            self._cond.notify_all()
+        self._update(dict((i.id, i) for i in instances))
+
+    def _update(self, instances):
+        now = time.time()
+        for x in self._waiters:
+            if x.done:
+                continue
+            found = [instances.get(i) for i in x.instance_ids]
+            failed = [i.id for i in found
+                      if i is not None and i.state in UNREACHABLE_FROM[x.state]]
+            if failed:
+                x.error = RuntimeError(
+                    "Instances {0} can not become {1}"
+                    .format(failed, x.state))
+            elif all(i is not None and i.state == x.state for i in found):
+                x.result = found
+            else:
+                # Every pending waiter was refreshed by this call
+                x.backoff(self, now)
+
+
+_waiters = aws_plugin_common.PerClient(StateWaiter)
+
+
+def for_client(ec2_client):
+    """Returns the waiter for the region and account of ec2_client."""
+    return _waiters.get(ec2_client)
+
+
+def wait_for_state(ec2_client, instance_ids, state=RUNNING, timeout=None):
+    return for_client(ec2_client).wait(ec2_client, instance_ids, state,
+                                       timeout)
@@ -0,0 +1,341 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Warm pools of pre-launched, stopped instances.
+
+Nodes with a warm_pool_size property keep that many stopped instances
+of their launch profile, the hash of their run_instances parameters,
+tagged warm_pool=<profile>. Launching a node claims a pool member and
+starts it instead of running a new instance, then the pool is topped up
+in the background. Pool members must be EBS backed to be stoppable.
+
+Members are claimed under a host-wide lock, see WarmPool. Only one
+process of a host tops up a profile at a time when the shared inventory
+is configured. A top-up records its client token before launching, so
+the next one completes an interrupted launch instead of leaving its
+instances untagged.
+"""
+
+import os
+import time
+import uuid
+import hashlib
+import logging
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import aws_plugin_common
+
+from aws_plugin_common import metrics
+from ec2_plugin import shared_inventory
+from ec2_plugin import tagging
+from ec2_plugin import waiter
+
+WARM_POOL_TAG = 'warm_pool'
+# Prefix of the warm_pool tag of members claimed for a node
+CLAIMED_PREFIX = 'claimed:'
+# States of members, launched or waiting to be claimed
+MEMBER_STATES = ('pending', 'running', 'stopping', 'stopped')
+# Seconds a process may take topping up a profile before another may
+FILL_LEASE = 900
+# Seconds members claimed on the host are remembered, until describes
+# show their claim tag
+CLAIM_MEMORY = 300
+# Seconds a claim tag must hold before the member is started, claims of
+# the same member written meanwhile by another host win
+CLAIM_SETTLE_DELAY = 2
+
+logger = logging.getLogger(__name__)
+
+
+def profile_of(params):
+    """Returns the launch profile of run_instances params."""
+    items = sorted((k, repr(v)) for k, v in params.items()
+                   if k not in ('min_count', 'max_count', 'client_token'))
+    return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()[:16]
+
+
+class _ClaimLog(object):
+    # Members claimed lately. Kept in a file locked with flock when path
+    # is set, so that a member is reserved by a single process of the
+    # host, in this process otherwise.
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._claims = {}
+
+    def reserve(self, instance_ids, count):
+        """Reserves up to count of instance_ids not reserved lately."""
+        def reserve(claims, now):
+            ret = [i for i in instance_ids if i not in claims][:count]
+            for instance_id in ret:
+                claims[instance_id] = now
+            return ret
+        return self._update(reserve)
+
+    def forget(self, instance_ids):
+        def forget(claims, now):
+            for instance_id in instance_ids:
+                claims.pop(instance_id, None)
+        self._update(forget)
+
+    def _update(self, change):
+        with self._lock:
+            if self.path is None:
+                return self._change(self._claims, change)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                data = []
+                while True:
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        break
+                    data.append(chunk)
+                claims = {}
+                for line in b''.join(data).decode('utf-8').splitlines():
+                    instance_id, claimed_at = line.split(' ')
+                    claims[instance_id] = float(claimed_at)
+                ret = self._change(claims, change)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, ''.join(
+                    '{0} {1!r}\n'.format(i, claimed_at)
+                    for i, claimed_at in claims.items()).encode('utf-8'))
+                return ret
+            finally:
+                # Closing releases the lock
+                os.close(fd)
+
+    def _change(self, claims, change):
+        now = time.time()
+        for instance_id, claimed_at in list(claims.items()):
+            if now - claimed_at >= CLAIM_MEMORY:
+                del claims[instance_id]
+        return change(claims, now)
+
+
+class WarmPool(object):
+    """
+    Claims and tops up pool members of one region and account.
+
+    A process reserves the members it claims in the claim log at
+    claims_path, locked host-wide, so processes of a host never claim the
+    same member. It then overwrites their warm_pool tag with a claim
+    token and reads it back, right away and again after
+    CLAIM_SETTLE_DELAY seconds: of two hosts claiming the same member,
+    the one whose tag was overwritten drops it.
+    """
+
+    def __init__(self, store=None, claims_path=None):
+        self.store = store
+        self._lock = threading.Lock()
+        self._claims = _ClaimLog(claims_path)
+        # Profiles being topped up
+        self._filling = set()
+        # profile -> 'client token count' of launches not tagged yet, when
+        # there is no shared inventory to keep them
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.claim_time = 0.0
+
+    def stats(self):
+        """Returns the hit rate and the mean claim latency in seconds."""
+        claims = self.hits + self.misses
+        return {'hit_rate': float(self.hits) / claims if claims else 0.0,
+                'claim_latency': self.claim_time / claims if claims else 0.0}
+
+    def claim(self, ec2_client, profile, count=1):
+        """Claims up to count members of profile, returns their ids."""
+        started = time.time()
+        token = CLAIMED_PREFIX + uuid.uuid4().hex
+        candidates = self._claims.reserve(
+            [r.id for r in aws_plugin_common.iter_instances(
+                ec2_client, filters={'tag:' + WARM_POOL_TAG: profile,
+                                     'instance-state-name': 'stopped'})],
+            count)
+        claimed = []
+        if candidates:
+            try:
+                ec2_client.create_tags(candidates, {WARM_POOL_TAG: token})
+                claimed = _tagged(ec2_client, candidates, token)
+                if claimed and CLAIM_SETTLE_DELAY:
+                    time.sleep(CLAIM_SETTLE_DELAY)
+                    claimed = _tagged(ec2_client, claimed, token)
+            except Exception:
+                self._claims.forget(candidates)
+                raise
+
+        elapsed = time.time() - started
+        with self._lock:
+            self.hits += len(claimed)
+            self.misses += count - len(claimed)
+            self.claim_time += elapsed * count
+        tags = {'profile': profile}
+        metrics.record('warm_pool_claim', elapsed)
+        metrics.timing('ec2.warm_pool.claim_time', elapsed, tags)
+        metrics.increment('ec2.warm_pool.hits', len(claimed), tags)
+        metrics.increment('ec2.warm_pool.misses', count - len(claimed), tags)
+        return claimed
+
+    def release(self, ec2_client, profile, instance_ids):
+        """Returns claimed members that could not be used to the pool."""
+        try:
+            ec2_client.create_tags(instance_ids, {WARM_POOL_TAG: profile})
+        except Exception:
+            logger.exception("Failed returning instances {0} to the warm "
+                             "pool".format(instance_ids))
+            return
+        self._claims.forget(instance_ids)
+
+    def top_up(self, params, size, config=None):
+        """
+        Launches members of the profile of params in a background thread
+        until the pool has size of them. Returns the thread, None when
+        the pool is already being topped up.
+        """
+        profile = profile_of(params)
+        with self._lock:
+            if profile in self._filling:
+                return None
+            self._filling.add(profile)
+        if self.store is not None and \
+                not self.store.acquire_lease(_fill_key(profile), FILL_LEASE):
+            # Another process of the host is topping it up
+            with self._lock:
+                self._filling.discard(profile)
+            return None
+        thread = threading.Thread(target=self._top_up,
+                                  args=(params, size, config),
+                                  name='ec2-warm-pool')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _top_up(self, params, size, config):
+        acquirer = aws_plugin_common.EC2Client()
+        try:
+            client = acquirer.get(config=config)
+            try:
+                self.fill(aws_plugin_common.scheduled(client), params, size)
+            finally:
+                acquirer.release(client)
+        except Exception:
+            logger.exception("Failed topping up the warm pool")
+        finally:
+            profile = profile_of(params)
+            if self.store is not None:
+                self.store.release_lease(_fill_key(profile))
+            with self._lock:
+                self._filling.discard(profile)
+
+    def fill(self, ec2_client, params, size):
+        """
+        Launches missing members of the pool, returns their ids. A launch
+        interrupted before its instances were tagged is completed first,
+        in place of a new one.
+        """
+        profile = profile_of(params)
+        pending = self._get_pending(profile)
+        if pending is not None:
+            token, count = pending.split(' ')
+            count = int(count)
+        else:
+            members = sum(1 for _ in aws_plugin_common.iter_instances(
+                ec2_client,
+                filters={'tag:' + WARM_POOL_TAG: profile,
+                         'instance-state-name': list(MEMBER_STATES)}))
+            count = size - members
+            if count <= 0:
+                return []
+            token = uuid.uuid4().hex
+            self._set_pending(profile, '{0} {1}'.format(token, count))
+        # Launching again with the recorded token returns the instances
+        # of an interrupted launch
+        s = ec2_client.run_instances(**dict(
+            params, min_count=count, max_count=count, client_token=token))
+        instance_ids = [i.id for i in s.instances]
+        failures = tagging.tag_new_instances(
+            ec2_client,
+            dict((i, {WARM_POOL_TAG: profile}) for i in instance_ids))
+        if failures:
+            # The token stays recorded, the next fill tags them
+            raise RuntimeError("Failed tagging warm pool instances: {0}"
+                               .format(failures))
+        self._set_pending(profile, None)
+        booting = [i.id for i in s.instances
+                   if i.state in ('pending', 'running')]
+        if booting:
+            waiter.wait_for_state(ec2_client, booting, waiter.RUNNING)
+            ec2_client.stop_instances(booting)
+        return instance_ids
+
+    def _get_pending(self, profile):
+        if self.store is not None:
+            return self.store.get_value(_fill_key(profile))
+        return self._pending.get(profile)
+
+    def _set_pending(self, profile, value):
+        if self.store is not None:
+            self.store.set_value(_fill_key(profile), value)
+        elif value is None:
+            self._pending.pop(profile, None)
+        else:
+            self._pending[profile] = value
+
+
+def _tagged(ec2_client, instance_ids, token):
+    # instance_ids whose warm_pool tag is token
+    return [r.id for r in aws_plugin_common.iter_instances_by(
+        ec2_client, 'instance-id', instance_ids) if r.pool == token]
+
+
+def _fill_key(profile):
+    return 'warm_pool_fill:' + profile
+
+
+def claims_path(region, access_key_id):
+    """
+    Returns the claim log of the host for region and account, next to
+    the shared inventory when it is configured.
+    """
+    inventory_path = os.getenv(shared_inventory.INVENTORY_PATH_ENV)
+    directory = os.path.dirname(inventory_path) if inventory_path \
+        else tempfile.gettempdir()
+    scope = '{0}/{1}'.format(region, access_key_id)
+    return os.path.join(directory, 'ec2-warm-pool-{0}.claims'.format(
+        hashlib.sha1(scope.encode('utf-8')).hexdigest()[:16]))
+
+
+def _new_pool(region, access_key_id):
+    return WarmPool(store=shared_inventory.open_for(region, access_key_id),
+                    claims_path=claims_path(region, access_key_id))
+
+
+_pools = aws_plugin_common.PerClient(_new_pool, pass_key=True)
+
+
+def for_client(ec2_client):
+    """Returns the warm pool for the region and account of ec2_client."""
+    return _pools.get(ec2_client)